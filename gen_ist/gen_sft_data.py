@@ -1,6 +1,8 @@
 import json
 import json_repair
 import os
+import sys
+import time
 import random
 from dotenv import load_dotenv
 from openai import OpenAI
@@ -12,29 +14,56 @@ from prompt_en.visual_grounding import VisualGroundingTemplateEngine
 from prompt_en.VQA import VQATemplateEngine
 from prompt_en.conversation import ConversationTemplateEngine
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "meta_caption"))
+from result_store import open_result_store
+from llm_cache import ResponseCache
+from metrics import METRICS
+
 # 加载环境变量
 load_dotenv()
 
-# 配置 OpenAI 客户端
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=os.getenv("OPENAI_BASE_URL"))
+# 配置 OpenAI 客户端；设置 VLLM_SERVER_URL 时改连常驻 vllm serve (见 meta_caption/vllm_server.py)，与 meta_caption runner 共用同一个已加载的模型
+if os.getenv("VLLM_SERVER_URL"):
+    client = OpenAI(api_key=os.getenv("VLLM_API_KEY", "EMPTY"), base_url=os.getenv("VLLM_SERVER_URL"))
+    MODEL = os.getenv("VLLM_SERVER_MODEL", "Qwen/Qwen3-VL-32B-Instruct")
+else:
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=os.getenv("OPENAI_BASE_URL"))
+    MODEL = os.getenv("OPENAI_MODEL")
 
 class SFTDataGenerator:
-    def __init__(self, class_map):
+    def __init__(self, class_map, cache_path=None):
         self.class_map = class_map
+        # LLM 响应缓存：重启后相同 prompt 不再重复请求；None 不启用
+        self.cache = ResponseCache(cache_path) if cache_path else None
         self.caption_engine = CaptionTemplateEngine()
         self.det_engine = DetectionTemplateEngine()
         self.vg_engine = VisualGroundingTemplateEngine()
         self.vqa_engine = VQATemplateEngine()
         self.conv_engine = ConversationTemplateEngine()
 
-    def call_llm(self, sys_pt, user_pt):
-        """调用 OpenAI 接口"""
+    @staticmethod
+    def parse_content(content, task_type):
+        with METRICS.timer("parse_json"):
+            res = json_repair.loads(content)
+        METRICS.count_task(task_type, "ok" if isinstance(res, (dict, list)) else "parse_fail")
+        return res
+
+    def call_llm(self, sys_pt, user_pt, task_type="unknown"):
+        """调用 OpenAI 接口；task_type 用于 METRICS 按任务计数与 token 统计"""
         # 在系统提示词中明确告知模型：以 ship_type_{i} 格式引用船只类别
         enhanced_sys_pt = sys_pt + "\n\nNote: The categories are provided as 'ship_type_{i}' (e.g., 'ship_type_37', 'ship_type_10'). Please use this exact format 'ship_type_{i}' directly in your descriptions and answers whenever referring to a ship's category."
+        model = MODEL
+        cache_key = None
+        if self.cache is not None:
+            cache_key = ResponseCache.make_key(model, {"response_format": "json_object"}, enhanced_sys_pt, user_pt)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return self.parse_content(cached, task_type)
         try:
+            start = time.monotonic()
             response = client.chat.completions.create(
                 # model="deepseek-chat",
-                model=os.getenv("OPENAI_MODEL"),
+                model=model,
                 messages=[
                     {"role": "system", "content": enhanced_sys_pt},
                     {"role": "user", "content": user_pt}
@@ -42,8 +71,15 @@ class SFTDataGenerator:
                 response_format={"type": "json_object"},
                 stream=False
             )
-            return json_repair.loads(response.choices[0].message.content)
+            METRICS.observe("llm_request", time.monotonic() - start)
+            if response.usage is not None:
+                METRICS.add_tokens(task_type, response.usage.prompt_tokens, response.usage.completion_tokens)
+            content = response.choices[0].message.content
+            if cache_key is not None:
+                self.cache.put(cache_key, content)
+            return self.parse_content(content, task_type)
         except Exception as e:
+            METRICS.count_task(task_type, "exception")
             print(f"Error calling LLM: {e}")
             return None
 
@@ -53,7 +89,7 @@ class SFTDataGenerator:
 
         # 1. 生成 Caption 数据
         sys_pt, user_pt = self.caption_engine.get_prompts(self.caption_engine.flatten_data(raw_data))
-        caption_res = self.call_llm(sys_pt, user_pt)
+        caption_res = self.call_llm(sys_pt, user_pt, "caption")
         if caption_res:
             for style, content in caption_res.items():
                 sft_results.append({
@@ -79,7 +115,7 @@ class SFTDataGenerator:
 
         # 3. Visual Grounding (调用 LLM)
         sys_pt, user_pt = self.vg_engine.get_prompts(raw_data, self.class_map)
-        vg_res = self.call_llm(sys_pt, user_pt) # 返回的是列表
+        vg_res = self.call_llm(sys_pt, user_pt, "vg") # 返回的是列表
         if isinstance(vg_res, list):
             for i, item in enumerate(vg_res):
                 sft_results.append({
@@ -103,7 +139,7 @@ class SFTDataGenerator:
 
         # 4. VQA (调用 LLM)
         sys_pt, user_pt = self.vqa_engine.get_prompts(raw_data, self.class_map)
-        vqa_res = self.call_llm(sys_pt, user_pt)
+        vqa_res = self.call_llm(sys_pt, user_pt, "vqa")
         if isinstance(vqa_res, list):
             for i, item in enumerate(vqa_res):
                 sft_results.append({
@@ -117,7 +153,7 @@ class SFTDataGenerator:
 
         # 5. Conversation (调用 LLM)
         sys_pt, user_pt = self.conv_engine.get_prompts(raw_data, self.class_map)
-        conv_res = self.call_llm(sys_pt, user_pt)
+        conv_res = self.call_llm(sys_pt, user_pt, "conversation")
         if conv_res and "Conversation" in conv_res:
             conv_list = []
             for turn in conv_res["Conversation"]:
@@ -133,22 +169,24 @@ class SFTDataGenerator:
 
 if __name__ == "__main__":
     my_class_map = {str(i): f"ship_type_{i}" for i in range(100)}
-    generator = SFTDataGenerator(my_class_map)
+    generator = SFTDataGenerator(my_class_map, cache_path="data/cache/llm_cache.sqlite")
     
-    train_dir = "/root/autodl-fs/data/metadata/train"
+    train_dir = "/root/autodl-fs/data/metadata/train"  # result_{seq}.json 目录，或 SQLite 结果库 (.sqlite)
     out_dir = "data/train"
     os.makedirs(out_dir, exist_ok=True)
     
-    json_files = [f for f in os.listdir(train_dir) if f.endswith(".json")]
+    store = open_result_store(train_dir)
+    json_files = [f"result_{seq}.json" for seq in store.seqs()]
     json_files = json_files[50:100]
     
-    to_process = sorted([f for f in json_files if not os.path.exists(os.path.join(out_dir, f))])
+    # 输出目录只列一次，不对每个文件单独 stat
+    done_files = set(os.listdir(out_dir))
+    to_process = sorted([f for f in json_files if f not in done_files])
     def worker(filename):
         out_path = os.path.join(out_dir, filename)
-        with open(os.path.join(train_dir, filename), "r") as f:
-            raw_data = json.load(f)
+        raw_data = store.get(filename[len("result_"):-len(".json")])
         res = generator.process_image_data(filename.replace(".json", ""), raw_data)
-        with open(out_path, "w", encoding="utf-8") as f:
+        with METRICS.timer("save_result"), open(out_path, "w", encoding="utf-8") as f:
             json.dump(res, f, indent=4, ensure_ascii=False)
         return filename
     
@@ -164,3 +202,7 @@ if __name__ == "__main__":
                 for _ in as_completed(futures):
                     pbar.update(1)
                 pbar.close()
+    if generator.cache is not None:
+        print(f"LLM cache: {generator.cache.stats()}")
+    print(f"Metrics: {json.dumps(METRICS.summary(), ensure_ascii=False)}")
+    METRICS.write("data/metrics/gen_sft_data")
@@ -0,0 +1,179 @@
+"""
+端到端吞吐基准：合成数据集 -> SeqPipeline -> main_vllm 客户端模式 (OpenAIHandler) -> 进程内 mock_server，
+报告 images/s、tasks/s 及各阶段延迟分位数；默认 mock 零延迟，测得的是 pipeline 的 CPU 侧开销，任何 Linux 机器都能跑。
+
+    python bench_pipeline.py --num-images 50 --ships 10 --output bench.json
+    python bench_pipeline.py --num-images 50 --ships 10 --baseline bench.json --tolerance 0.15   # 吞吐下降超过 15% 时退出码为 1
+    python bench_pipeline.py --latency-ms 800 --latency-dist lognormal --tokens-per-s 40 --error-rate 0.02 --sft
+
+阶段:
+  prepare     worker 进程内 prepare_seq (解码、元数据、切片、prompt 文本)
+  queue_wait  准备完成到主线程取走
+  submit      主线程 submit_item (resume、构建任务、在途图像达到上限时的背压等待)
+  result      主线程取走到结果落盘
+报告的 metrics 字段为 METRICS 的细分阶段 (decode_jpeg / extract_meta / encode_jpeg / llm_request / parse_json ...)、任务计数与 token 合计
+"""
+import os, sys, json, time, shutil, argparse, tempfile, statistics
+
+from pipeline import SeqPipeline, prepare_seq
+from synth_data import generate_dataset
+from metrics import METRICS, percentile
+import mock_server
+import main_vllm
+from main_vllm import make_handler, submit_item, finish
+
+
+def timed_prepare(seq, tif, lbl, jpg):
+    """在 worker 中计时的 prepare_seq (模块级函数，可被 spawn 的子进程导入)"""
+    start = time.perf_counter()
+    item = prepare_seq(seq, tif, lbl, jpg)
+    item["prepare_s"] = time.perf_counter() - start
+    item["prepared_at"] = time.time()
+    return item
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {"n": len(values), "mean_ms": round(statistics.mean(values) * 1000, 2),
+            **{f"p{q}_ms": round(percentile(values, q) * 1000, 2) for q in (50, 90, 99)},
+            "max_ms": round(max(values) * 1000, 2)}
+
+
+def run_captions(args, img_root, out_dir, base_url):
+    seqs = sorted(os.path.splitext(f)[0] for f in os.listdir(os.path.join(img_root, "rgb_images")) if f.endswith(".jpg"))[:args.num_images]
+    handler = make_handler(base_url, data_dir=out_dir, journal_path=os.path.join(out_dir, "journal.jsonl"),
+                           store_path=os.path.join(out_dir, "results.sqlite"), cache_path=None)
+    stages = {"prepare": [], "queue_wait": [], "submit": [], "result": []}
+    consumed_at = {}
+
+    def on_saved(seq):
+        if seq in consumed_at:
+            stages["result"].append(time.monotonic() - consumed_at.pop(seq))
+    handler.on_saved = on_saved
+
+    jobs = [(seq, f"{img_root}/images/{seq}.tif", f"{img_root}/labels/{seq}.json", f"{img_root}/rgb_images/{seq}.jpg") for seq in seqs]
+    pipeline = SeqPipeline(jobs, prepare_fn=timed_prepare, num_workers=args.workers, max_ready=args.max_ready)
+    errors = 0
+    start = time.monotonic()
+    for item in pipeline:
+        if "error" in item:
+            errors += 1
+            print(f"Error preparing {item['seq']}: {item['error']}")
+            continue
+        stages["prepare"].append(item["prepare_s"])
+        stages["queue_wait"].append(max(0.0, time.time() - item["prepared_at"]))
+        consumed_at[item["seq"]] = time.monotonic()
+        t0 = time.perf_counter()
+        submit_item(handler, item, base_url)
+        stages["submit"].append(time.perf_counter() - t0)
+    finish(handler, base_url)
+    wall = time.monotonic() - start
+
+    counts = handler.limiter.counts
+    return {
+        "wall_s": round(wall, 3),
+        "images": len(handler.store),
+        "prepare_errors": errors,
+        "images_per_s": round(len(handler.store) / wall, 3),
+        "tasks": counts["ok"],
+        "tasks_per_s": round(counts["ok"] / wall, 3),
+        "retries": counts["retries"],
+        "stages": {name: summarize(values) for name, values in stages.items()},
+        "rate_control": handler.limiter.stats(),
+        "image_payload": handler.payloads.stats(),
+    }, handler.store
+
+
+def run_sft(store, base_url, limit):
+    """gen_ist 的 SFTDataGenerator 在同一后端上逐图生成 caption / VG / VQA / conversation"""
+    os.environ["VLLM_SERVER_URL"] = base_url
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "gen_ist"))
+    from gen_sft_data import SFTDataGenerator
+    generator = SFTDataGenerator({str(i): f"ship_type_{i}" for i in range(100)})
+    latencies, samples = [], 0
+    start = time.monotonic()
+    for seq in store.seqs()[:limit]:
+        t0 = time.perf_counter()
+        samples += len(generator.process_image_data(f"result_{seq}", store.get(seq)))
+        latencies.append(time.perf_counter() - t0)
+    wall = time.monotonic() - start
+    return {"wall_s": round(wall, 3), "images": len(latencies), "samples": samples,
+            "images_per_s": round(len(latencies) / wall, 3) if wall else None, "per_image": summarize(latencies)}
+
+
+def compare(report, baseline, tolerance):
+    """吞吐指标相对基线下降超过 tolerance 的列表"""
+    regressions = []
+    for key in ("images_per_s", "tasks_per_s"):
+        old, new = baseline["captions"].get(key), report["captions"].get(key)
+        if old and new is not None and new < old * (1 - tolerance):
+            regressions.append(f"{key}: {new} < {old} * (1 - {tolerance})")
+    return regressions
+
+
+def main(args):
+    work_dir = tempfile.mkdtemp(prefix="bench_meta_caption_")
+    img_root = args.img_root
+    if img_root is None:
+        img_root = os.path.join(work_dir, "imgs")
+        t0 = time.monotonic()
+        generate_dataset(img_root, args.num_images, args.ships, args.size, args.seed)
+        print(f"Generated {args.num_images} synthetic images in {time.monotonic() - t0:.1f}s")
+
+    server = None
+    base_url = args.base_url
+    if base_url is None:
+        server, base_url = mock_server.serve_in_thread(profile=mock_server.profile_from_args(args))
+    try:
+        captions, store = run_captions(args, img_root, os.path.join(work_dir, "out"), base_url)
+        report = {
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+            "captions": captions,
+        }
+        if args.sft:
+            report["sft"] = run_sft(store, base_url, args.num_images)
+        report["metrics"] = METRICS.summary()
+        if server is not None:
+            snap = server.stats.snapshot()
+            report["backend"] = {"requests": snap["requests"], "errors": snap["errors"],
+                                 "latency": {t: summarize(v) for t, v in snap["latency_s"].items()}}
+    finally:
+        if server is not None:
+            server.shutdown()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION {r}")
+        return 1 if regressions else 0
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="End-to-end meta_caption throughput benchmark against a mock LLM backend")
+    parser.add_argument("--num-images", type=int, default=50)
+    parser.add_argument("--ships", type=int, default=10, help="合成数据每张图的舰船数")
+    parser.add_argument("--size", type=int, default=1024, help="合成图像边长")
+    parser.add_argument("--img-root", default=None, help="使用已有数据集 (images / labels / rgb_images)，不生成合成数据")
+    parser.add_argument("--base-url", default=None, help="使用外部 OpenAI 兼容服务，不启动进程内 mock")
+    parser.add_argument("--workers", type=int, default=main_vllm.NUM_WORKERS)
+    parser.add_argument("--max-ready", type=int, default=main_vllm.MAX_READY)
+    parser.add_argument("--sft", action="store_true", help="同时对生成的结果跑 gen_ist SFTDataGenerator")
+    parser.add_argument("--output", default=None, help="报告写入该 JSON 文件")
+    parser.add_argument("--baseline", default=None, help="与之前的报告比较吞吐")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="允许的吞吐下降比例")
+    parser.add_argument("--keep", action="store_true", help="保留临时数据与结果")
+    mock_server.add_profile_args(parser)
+    return parser
+
+
+if __name__ == "__main__":
+    sys.exit(main(build_parser().parse_args()))
@@ -0,0 +1,94 @@
+"""
+融合场景任务基准：同一批图像分别以 split (general + position 两次全图请求) 与 fused (scene 一次全图请求) 调用，
+对比每张图的 prompt / completion token、端到端延迟以及 immediate_surroundings 覆盖率。
+走 OpenAI 兼容接口 (OPENAI_BASE_URL / OPENAI_MODEL)，本地 vllm serve 与远端 API 均可。
+
+    python bench_scene_fusion.py --data-dir data/metadata/train --rgb-dir data/imgs/train/rgb_images --num 20
+"""
+import os, time, argparse, asyncio, statistics
+from PIL import Image
+import dotenv
+
+from prompt.utils import format_ship_spatial_text, split_scene_result
+from prompt.prompt import (GENERAL_SYS_PROMPT, GENERAL_USER_PROMPT,
+                           POSITION_SYS_PROMPT, POSITION_USER_PROMPT,
+                           SCENE_SYS_PROMPT, SCENE_USER_PROMPT)
+from openai_handler import OpenAIHandler
+from metrics import percentile
+
+
+def build_prompts(meta):
+    objects = meta["objects_enrichment"]
+    ship_info = "\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in objects.items()])
+    ship_data = "\n".join(format_ship_spatial_text(objects, top_k=8).values())
+    md = meta["metadata"]
+    general = GENERAL_USER_PROMPT.format(imaging_time=md["imaging_time"], resolution=md["resolution"],
+                                         center_coords=md["center_coordinates"], ship_info=ship_info)
+    scene = SCENE_USER_PROMPT.format(imaging_time=md["imaging_time"], resolution=md["resolution"],
+                                     center_coords=md["center_coordinates"], ship_info=ship_info, ship_data=ship_data)
+    return general, POSITION_USER_PROMPT.format(ship_data=ship_data), scene
+
+
+async def run_mode(handler, items, mode):
+    """逐张图串行请求 (图内 split 的两个请求并发)，延迟即单张图的端到端耗时"""
+    before = dict(handler.limiter.counts)
+    latencies, covered, total_ships = [], 0, 0
+    for seq, meta, jpeg in items:
+        general_usr, position_usr, scene_usr = build_prompts(meta)
+        start = time.monotonic()
+        try:
+            if mode == "split":
+                _, position = await asyncio.gather(handler.call_openai(GENERAL_SYS_PROMPT, general_usr, jpeg),
+                                                   handler.call_openai(POSITION_SYS_PROMPT, position_usr, jpeg))
+            else:
+                _, position = split_scene_result(await handler.call_openai(SCENE_SYS_PROMPT, scene_usr, jpeg))
+        except Exception as e:
+            print(f"[{mode}] Error on {seq}: {e}")
+            continue
+        latencies.append(time.monotonic() - start)
+        ids = {item.get("ship_id") for item in position if isinstance(item, dict) and item.get("immediate_surroundings")} \
+            if isinstance(position, list) else set()
+        covered += len(ids & set(meta["objects_enrichment"]))
+        total_ships += len(meta["objects_enrichment"])
+
+    n = max(len(latencies), 1)
+    counts = handler.limiter.counts
+    return {
+        "images": len(latencies),
+        "requests": counts["ok"] - before["ok"],
+        "prompt_tokens_per_image": round((counts["prompt_tokens"] - before["prompt_tokens"]) / n, 1),
+        "completion_tokens_per_image": round((counts["completion_tokens"] - before["completion_tokens"]) / n, 1),
+        "latency_mean_s": round(statistics.mean(latencies), 3) if latencies else None,
+        "latency_p50_s": round(percentile(latencies, 50), 3) if latencies else None,
+        "latency_p90_s": round(percentile(latencies, 90), 3) if latencies else None,
+        "surroundings_coverage": round(covered / total_ships, 3) if total_ships else None,
+    }
+
+
+async def main(args):
+    # 不启用响应缓存，否则第二轮直接命中
+    handler = OpenAIHandler(data_dir=args.data_dir, store_path=args.store_path, max_concurrent=2)
+    items = []
+    for seq in handler.store.seqs():
+        jpg = os.path.join(args.rgb_dir, f"{seq}.jpg")
+        if not os.path.exists(jpg): continue
+        img = Image.open(jpg).convert("RGB")
+        items.append((seq, handler.store.get(seq), handler.payloads.encode(img, handler.payloads.max_pixels.get("scene"))))
+        if len(items) >= args.num: break
+    print(f"Benchmarking {len(items)} images against {handler.model}")
+
+    # --order 调换两种模式的先后，用于检查服务端预热对结果的影响
+    modes = ["split", "fused"] if args.order == "split-first" else ["fused", "split"]
+    for mode in modes:
+        print(f"{mode}: {await run_mode(handler, items, mode)}")
+
+
+if __name__ == "__main__":
+    dotenv.load_dotenv()
+    parser = argparse.ArgumentParser(description="Compare fused scene task vs split general + position requests")
+    parser.add_argument("--data-dir", default="data/metadata/train")
+    parser.add_argument("--store-path", default=None)
+    parser.add_argument("--rgb-dir", default="data/imgs/train/rgb_images")
+    parser.add_argument("--num", type=int, default=20)
+    parser.add_argument("--order", choices=["split-first", "fused-first"], default="split-first")
+    asyncio.run(main(parser.parse_args()))
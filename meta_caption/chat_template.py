@@ -0,0 +1,91 @@
+"""
+chat 模板缓存：同一 (系统 prompt, 用户内容布局) 的 apply_chat_template 结果只有用户文本不同。
+用哨兵文本渲染一次得到静态片段，之后每个任务只需把可变文本拼进片段 (fill_template)，不再逐任务跑 Jinja 模板。
+片段是普通字符串，可随 prepare_fn 传给 SeqPipeline 的 worker 进程，在解码图像的同时直接生成 prompt。
+
+    templates = ChatTemplateCache(lambda msg: processor.apply_chat_template(msg, tokenize=False, add_generation_prompt=True))
+    prompt = templates.prompt(sys_p, SINGLE_IMAGE, [usr_p])
+"""
+from metrics import METRICS
+
+SINGLE_IMAGE = ("image", "text")  # 全图 / 单切片任务：图像在前，用户文本在后
+SENTINEL = "\x00chat_text_{}\x00"
+# 校验文本：含首尾空白、换行与花括号，模板若会改写用户文本 (strip、转义等) 即可发现
+PROBE = " probe {}\n{{x}}\t"
+
+
+def multi_image_layout(n):
+    """多图外观任务：每张切片前一段标签文本，最后是用户文本"""
+    return ("text", "image") * n + ("text",)
+
+
+def layout_messages(sys_p, layout, texts):
+    """layout 为用户内容各部分的类型序列，texts 依次填入其中的 text 部分"""
+    texts = iter(texts)
+    content = [{"type": "image"} if kind == "image" else {"type": "text", "text": next(texts)} for kind in layout]
+    return [
+        {"role": "system", "content": [{"type": "text", "text": sys_p}]},
+        {"role": "user", "content": content}
+    ]
+
+
+def fill_template(segments, texts):
+    """segments 比 texts 多一段，交替拼接"""
+    parts = [segments[0]]
+    for text, segment in zip(texts, segments[1:]):
+        parts += [text, segment]
+    return "".join(parts)
+
+
+def split_rendered(rendered, n):
+    """按哨兵 0..n-1 的顺序切分渲染结果；哨兵缺失或乱序时返回 None"""
+    segments = []
+    for i in range(n):
+        head, sep, rendered = rendered.partition(SENTINEL.format(i))
+        if not sep:
+            return None
+        segments.append(head)
+    return segments + [rendered]
+
+
+class ChatTemplateCache:
+    """
+    按 (系统 prompt, layout) 缓存模板静态片段。首次遇到时用哨兵渲染并切分，再用 PROBE 文本与真实渲染结果比对，
+    不一致 (模板会改写用户文本) 时该组合退回逐任务 apply_chat_template，保证 prompt 与原始渲染逐字节相同 (响应缓存键不变)
+    """
+    def __init__(self, render):
+        """render(messages) -> prompt 字符串"""
+        self.render = render
+        self.segments = {}
+        self.counts = {"hits": 0, "misses": 0, "fallbacks": 0}
+
+    def get(self, sys_p, layout):
+        """返回静态片段列表；该组合无法缓存时返回 None"""
+        key = (sys_p, layout)
+        if key in self.segments:
+            self.counts["hits"] += 1
+            return self.segments[key]
+        self.counts["misses"] += 1
+        n = layout.count("text")
+        with METRICS.timer("apply_chat_template"):
+            segments = split_rendered(self.render(layout_messages(sys_p, layout, [SENTINEL.format(i) for i in range(n)])), n)
+            if segments is not None:
+                probes = [PROBE.format(i) for i in range(n)]
+                if fill_template(segments, probes) != self.render(layout_messages(sys_p, layout, probes)):
+                    segments = None
+        if segments is None:
+            self.counts["fallbacks"] += 1
+            print(f"Chat template rewrites user text for layout {layout}, rendering per task")
+        self.segments[key] = segments
+        return segments
+
+    def prompt(self, sys_p, layout, texts):
+        segments = self.get(sys_p, layout)
+        if segments is None:
+            with METRICS.timer("apply_chat_template"):
+                return self.render(layout_messages(sys_p, layout, texts))
+        with METRICS.timer("template_fill"):
+            return fill_template(segments, texts)
+
+    def stats(self):
+        return {**self.counts, "layouts": len(self.segments)}
@@ -1,63 +1,108 @@
-import os, json, base64, io, json_repair
+import os, time, asyncio, json_repair
 from google import genai
 from google.genai import types
-from PIL import Image
+from result_store import open_result_store
+from llm_cache import ResponseCache
+from image_payload import ImagePayloadEncoder
+from metrics import METRICS
+from prompt.utils import split_scene_result
 
 class GeminiSDKHandler:
-    def __init__(self, api_key=None, base_url="https://api.zhizengzeng.com/google", model="gemini-3-flash-preview", data_dir="data/metadata/train"):
+    def __init__(self, api_key=None, base_url="https://api.zhizengzeng.com/google", model="gemini-3-flash-preview", data_dir="data/metadata/train", store_path=None, cache_path=None, max_concurrent=10,
+                 max_pixels=None, jpeg_quality=90):
         self.client = genai.Client(
             api_key=api_key or os.getenv("GOOGLE_API_KEY"),
             http_options={"base_url": base_url or os.getenv("GOOGLE_BASE_URL")}
         )
         self.model = model or os.getenv("GOOGLE_MODEL")
         self.data_dir = data_dir
+        # 默认 data_dir 下逐文件 result_{seq}.json；store_path 以 .sqlite 结尾则写入 SQLite 结果库
+        self.store = open_result_store(store_path or data_dir)
+        # LLM 响应缓存：相同 prompt + 图像不再重复请求；None 不启用
+        self.cache = ResponseCache(cache_path) if cache_path else None
+        # 全局在途请求上限 (跨图像共享)，与 OpenAIHandler 相同的并发模型
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        # 图像载荷：按任务类型缩放到像素预算 (max_pixels 覆盖 image_payload.DEFAULT_MAX_PIXELS)，每张图每种尺寸只编码一次
+        self.payloads = ImagePayloadEncoder(max_pixels=max_pixels, quality=jpeg_quality)
         self.progress = None
 
     def set_progress_bar(self, progress_bar):
         self.progress = progress_bar
 
-    def call_gemini(self, sys_p, usr_p, img):
+    @staticmethod
+    def parse_content(content, task_type):
+        with METRICS.timer("parse_json"):
+            res = json_repair.loads(content)
+        METRICS.count_task(task_type, "ok" if isinstance(res, (dict, list)) else "parse_fail")
+        return res
+
+    async def call_gemini(self, sys_p, usr_p, img, task_type="unknown"):
         try:
-            # 将 PIL Image 转换为 bytes
-            buffered = io.BytesIO()
-            img.save(buffered, format="JPEG")
-            image_bytes = buffered.getvalue()
-
-            response = self.client.models.generate_content(
-                model=self.model,
-                contents=[
-                    types.Part.from_bytes(
-                        data=image_bytes,
-                        mime_type='image/jpeg',
-                    ),
-                    f"{sys_p}\n\n{usr_p}"
-                ],
-                config=types.GenerateContentConfig(
-                    temperature=0.01,
-                    response_mime_type="application/json"
+            # img 可以是 PIL 图像或 update_seq 预先编码好的 JPEG 字节
+            image_bytes = img if isinstance(img, bytes) else self.payloads.encode(img)
+
+            cache_key = None
+            if self.cache is not None:
+                cache_key = ResponseCache.make_key(self.model, {"temperature": 0.01, "response_mime_type": "application/json"}, sys_p, usr_p, [image_bytes])
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    return self.parse_content(cached, task_type)
+
+            async with self.semaphore:
+                start = time.monotonic()
+                response = await self.client.aio.models.generate_content(
+                    model=self.model,
+                    contents=[
+                        types.Part.from_bytes(
+                            data=image_bytes,
+                            mime_type='image/jpeg',
+                        ),
+                        f"{sys_p}\n\n{usr_p}"
+                    ],
+                    config=types.GenerateContentConfig(
+                        temperature=0.01,
+                        response_mime_type="application/json"
+                    )
                 )
-            )
-            return json_repair.loads(response.text)
+                METRICS.observe("llm_request", time.monotonic() - start)
+            usage = response.usage_metadata
+            if usage is not None:
+                METRICS.add_tokens(task_type, usage.prompt_token_count, usage.candidates_token_count)
+            if cache_key is not None:
+                self.cache.put(cache_key, response.text)
+            return self.parse_content(response.text, task_type)
         except Exception as e:
+            METRICS.count_task(task_type, "exception")
             print(f"Error calling Gemini SDK: {e}")
             return {}
 
-    def update_seq(self, seq, meta, tasks):
+    def apply_task_result(self, task, meta, res):
+        if task['type'] == 'scene':
+            # 融合场景任务：拆成 general + position 两部分分别回写
+            general, position = split_scene_result(res)
+            self.apply_task_result({'type': 'general'}, meta, general)
+            self.apply_task_result({'type': 'position'}, meta, position)
+        elif task['type'] == 'general':
+            meta.get("scene_context", {}).update(res.get("scene_context", {}))
+        elif task['type'] == 'position':
+            for item in (res if isinstance(res, list) else []):
+                s_id = item.get("ship_id")
+                if s_id in meta["objects_enrichment"]:
+                    meta["objects_enrichment"][s_id]["immediate_surroundings"] = item.get("immediate_surroundings", "")
+        elif task['type'] == 'appearance':
+            meta["objects_enrichment"][task['ship_id']]["visual_appearance"] = res.get("visual_appearance", "")
+
+    async def update_seq(self, seq, meta, tasks):
         try:
-            for task in tasks:
-                res = self.call_gemini(task['sys'], task['usr'], task['img'])
-                if task['type'] == 'general':
-                    meta.get("scene_context", {}).update(res.get("scene_context", {}))
-                elif task['type'] == 'position':
-                    for item in (res if isinstance(res, list) else []):
-                        s_id = item.get("ship_id")
-                        if s_id in meta["objects_enrichment"]:
-                            meta["objects_enrichment"][s_id]["immediate_surroundings"] = item.get("immediate_surroundings", "")
-                elif task['type'] == 'appearance':
-                    meta["objects_enrichment"][task['ship_id']]["visual_appearance"] = res.get("visual_appearance", "")
+            # 同一图像的各任务共用一份缩放后的 JPEG，编码在线程中进行，不阻塞事件循环
+            payloads = await asyncio.to_thread(self.payloads.encode_tasks, tasks)
+            # 并发执行该图像的所有子任务，总并发受 self.semaphore 限制
+            results = await asyncio.gather(*[self.call_gemini(task['sys'], task['usr'], payload, task['type']) for task, payload in zip(tasks, payloads)])
+            for task, res in zip(tasks, results):
+                self.apply_task_result(task, meta, res)
             
-            with open(os.path.join(self.data_dir, f"result_{seq}.json"), "w", encoding="utf-8") as f:
-                json.dump(meta, f, indent=4, ensure_ascii=False)
+            with METRICS.timer("save_result"):
+                self.store.put(seq, meta)
         except Exception as e:
             print(f"Error processing {seq}: {e}")
         if self.progress: self.progress.update(1)
@@ -0,0 +1,111 @@
+import io
+import math
+from PIL import Image
+from metrics import METRICS
+
+# 各任务类型上传图像的像素预算 (宽 x 高)，超出时等比缩小；远端模型本身也会下采样，更大的图只浪费带宽
+DEFAULT_MAX_PIXELS = {
+    "general": 1920 * 1920,
+    "position": 1920 * 1920,
+    "scene": 1920 * 1920,
+    "appearance": 768 * 768,
+}
+
+
+def fitted_size(size, max_pixels):
+    """fit_max_pixels 缩放后的 (宽, 高)"""
+    w, h = size
+    if max_pixels is None or w * h <= max_pixels:
+        return w, h
+    scale = (max_pixels / (w * h)) ** 0.5
+    return max(1, int(w * scale)), max(1, int(h * scale))
+
+
+def fit_max_pixels(img, max_pixels):
+    """等比缩放到不超过 max_pixels 像素；max_pixels 为 None 或图像已足够小时原样返回"""
+    size = fitted_size(img.size, max_pixels)
+    if size == img.size:
+        return img
+    return img.resize(size, Image.LANCZOS)
+
+
+# Qwen3-VL: patch 16 x spatial merge 2，每个视觉 token 对应 32x32 像素
+QWEN_VL_FACTOR = 32
+# 本地 Qwen3-VL 各任务类型的像素预算 (min_pixels, max_pixels)，以视觉 token 数 x 32 x 32 给出；
+# 全图 general / position / scene 最多 1536 个视觉 token，舰船切片至少 7x7 (224 像素) 最多 256 个
+QWEN_VL_PIXEL_BUDGETS = {
+    "general": (256 * QWEN_VL_FACTOR ** 2, 1536 * QWEN_VL_FACTOR ** 2),
+    "position": (256 * QWEN_VL_FACTOR ** 2, 1536 * QWEN_VL_FACTOR ** 2),
+    "scene": (256 * QWEN_VL_FACTOR ** 2, 1536 * QWEN_VL_FACTOR ** 2),
+    "appearance": (49 * QWEN_VL_FACTOR ** 2, 256 * QWEN_VL_FACTOR ** 2),
+}
+
+
+def smart_resize(height, width, factor=QWEN_VL_FACTOR, min_pixels=56 * 56, max_pixels=1280 * 28 * 28):
+    """与 Qwen-VL 图像处理器相同的取整规则：宽高对齐到 factor 的倍数，总像素落在 [min_pixels, max_pixels] 内"""
+    h_bar = max(factor, round(height / factor) * factor)
+    w_bar = max(factor, round(width / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt(height * width / max_pixels)
+        h_bar = max(factor, math.floor(height / beta / factor) * factor)
+        w_bar = max(factor, math.floor(width / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        h_bar = math.ceil(height * beta / factor) * factor
+        w_bar = math.ceil(width * beta / factor) * factor
+    return h_bar, w_bar
+
+
+def resize_to_grid(img, min_pixels, max_pixels, factor=QWEN_VL_FACTOR):
+    """按 smart_resize 缩放到 patch 网格对齐的尺寸，处理器端不再二次缩放"""
+    h, w = smart_resize(img.height, img.width, factor, min_pixels, max_pixels)
+    if (w, h) == img.size:
+        return img
+    return img.resize((w, h), Image.BICUBIC)
+
+
+class ImagePayloadEncoder:
+    """
+    API 后端的图像载荷层：按任务类型缩放到像素预算后编码为 JPEG，
+    同一张图中同一 (图像, 像素预算) 只编码一次，general / position 等任务复用同一份字节
+    """
+    def __init__(self, max_pixels=None, quality=90):
+        self.max_pixels = {**DEFAULT_MAX_PIXELS, **(max_pixels or {})}
+        self.quality = quality
+        self.counts = {"images": 0, "encoded": 0, "reused": 0, "bytes_uploaded": 0, "max_bytes_per_image": 0}
+
+    def encode(self, img, max_pixels=None):
+        with METRICS.timer("encode_jpeg"):
+            buffered = io.BytesIO()
+            fit_max_pixels(img, max_pixels).save(buffered, format="JPEG", quality=self.quality)
+            return buffered.getvalue()
+
+    def encode_tasks(self, tasks):
+        """返回与 tasks 一一对应的 JPEG 字节 (img 为列表时为字节列表)，并累计该图像的上传字节数"""
+        # 以 id(img) 去重：tasks 持有图像引用，调用期间 id 不会被复用
+        encoded = {}
+        payloads = []
+        for task in tasks:
+            # 多船外观任务的 img 为切片列表，按 appearance 预算逐张编码
+            t_type = "appearance" if task['type'] == "appearance_multi" else task['type']
+            budget = self.max_pixels.get(t_type)
+            imgs = task['img'] if isinstance(task['img'], list) else [task['img']]
+            for img in imgs:
+                key = (id(img), budget)
+                if key in encoded:
+                    self.counts["reused"] += 1
+                else:
+                    encoded[key] = self.encode(img, budget)
+                    self.counts["encoded"] += 1
+            jpegs = [encoded[(id(img), budget)] for img in imgs]
+            payloads.append(jpegs if isinstance(task['img'], list) else jpegs[0])
+
+        total = sum(sum(map(len, p)) if isinstance(p, list) else len(p) for p in payloads)
+        self.counts["images"] += 1
+        self.counts["bytes_uploaded"] += total
+        self.counts["max_bytes_per_image"] = max(self.counts["max_bytes_per_image"], total)
+        return payloads
+
+    def stats(self):
+        images = self.counts["images"]
+        return {**self.counts, "avg_bytes_per_image": round(self.counts["bytes_uploaded"] / images) if images else 0}
@@ -0,0 +1,56 @@
+import os, json, threading
+
+
+class TaskJournal:
+    """
+    追加写的子任务结果日志 (JSONL)，每个子任务完成后立即落盘，崩溃后可回放
+
+    记录格式:
+      {"seq": ..., "type": ..., "ship_id": ..., "data": <解析后的 LLM 输出>}
+      {"seq": ..., "saved": true}   # 该 seq 的结果文件已写出，之前的记录不再需要回放
+    """
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.entries = self.load()
+        self.f = open(path, "a", encoding="utf-8")
+
+    def load(self):
+        """读取日志，返回未保存 seq 的已完成子任务 {seq: {(type, ship_id): data}}"""
+        entries = {}
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 崩溃时写了一半的最后一行
+                if rec.get("saved"):
+                    entries.pop(rec["seq"], None)
+                else:
+                    entries.setdefault(rec["seq"], {})[(rec["type"], rec.get("ship_id"))] = rec["data"]
+        return entries
+
+    def _write(self, rec):
+        with self.lock:
+            self.f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self.f.flush()
+            if self.fsync:
+                os.fsync(self.f.fileno())
+
+    def record(self, seq, task_type, ship_id, data):
+        self._write({"seq": seq, "type": task_type, "ship_id": ship_id, "data": data})
+
+    def mark_saved(self, seq):
+        self.entries.pop(seq, None)
+        self._write({"seq": seq, "saved": True})
+
+    def completed(self, seq):
+        """启动时日志中该 seq 已完成的子任务 {(type, ship_id): data}"""
+        return self.entries.get(seq, {})
+
+    def close(self):
+        self.f.close()
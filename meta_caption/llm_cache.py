@@ -0,0 +1,68 @@
+import os, json, time, hashlib, sqlite3, threading
+
+
+def image_bytes(img):
+    """用于计算缓存键的图像内容：bytes 原样使用，PIL 图像取 mode/size + 像素"""
+    if isinstance(img, (bytes, bytearray)):
+        return bytes(img)
+    return f"{img.mode}:{img.size}".encode() + img.tobytes()
+
+
+class ResponseCache:
+    """
+    内容寻址的 LLM 响应缓存 (SQLite 单文件，多个后端/脚本共用)
+    键为 sha256(model, 采样参数, system prompt, user prompt, 图像字节)，值为模型原始输出文本
+    总大小超过 max_bytes 时按最近访问时间淘汰 (LRU)
+    """
+    def __init__(self, path="data/cache/llm_cache.sqlite", max_bytes=2 * 2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON cache (accessed)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, params, sys_p, usr_p, images=()):
+        h = hashlib.sha256()
+        h.update(json.dumps([model, params, sys_p, usr_p], ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+        for img in images:
+            h.update(image_bytes(img))
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, value):
+        size = len(value.encode("utf-8"))
+        with self.lock, self.conn:
+            old = self.conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO cache (key, value, size, accessed) VALUES (?, ?, ?, ?)", (key, value, size, time.time()))
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # 淘汰到 90% 以下，避免每次写入都触发淘汰
+        target = self.max_bytes * 0.9
+        for key, size in self.conn.execute("SELECT key, size FROM cache ORDER BY accessed").fetchall():
+            if self.total_bytes <= target:
+                break
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.total_bytes -= size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / total, 4) if total else 0.0, "bytes": self.total_bytes}
@@ -1,6 +1,7 @@
-from prompt.utils import extract_normalized_info, format_ship_spatial_text
+from prompt.utils import extract_normalized_info, format_ship_spatial_text, split_scene_result
 from prompt.prompt import (GENERAL_SYS_PROMPT, GENERAL_USER_PROMPT, 
                            POSITION_SYS_PROMPT, POSITION_USER_PROMPT, 
+                           SCENE_SYS_PROMPT, SCENE_USER_PROMPT,
                            APPEARANCE_SYS_PROMPT)
 
 import os, json, torch
@@ -49,6 +50,8 @@ def ask_qwen(system_prompt, user_content, pil_image):
         generated_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
     )[0]
 
+FUSE_SCENE = False  # general + position 合并为一次全图请求 (融合场景任务)，省去一次全图 prefill；默认关闭 (原有的 general + position 两次请求)，先用 bench_scene_fusion.py 比较两种模式再决定是否开启
+
 # 确保输出目录存在
 os.makedirs("data", exist_ok=True)
 seqs = ["00001", "00011", "00021", "00041", "00051", "00061", "00081", "00101"] # 待处理序列
@@ -65,39 +68,61 @@ for seq in seqs:
     # 1. 获取 Meta 数据
     meta = extract_normalized_info(tif, lbl)
 
-    # 2. General 描述 (全图场景 - 仅针对 scene_context)
     ship_info_text = "\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in meta["objects_enrichment"].items()])
-    general_user_content = GENERAL_USER_PROMPT.format(
-        imaging_time=meta["metadata"]["imaging_time"],
-        resolution=meta["metadata"]["resolution"],
-        center_coords=meta["metadata"]["center_coordinates"],
-        ship_info=ship_info_text
-    )
-    gen_res = ask_qwen(GENERAL_SYS_PROMPT, general_user_content, full_img)
-    try:
-        gen_data = json_repair.loads(gen_res)
-        if "scene_context" in gen_data:
+    spatial_dict = format_ship_spatial_text(meta["objects_enrichment"])
+    for s_id, s_text in spatial_dict.items():
+        meta["objects_enrichment"][s_id]["spatial_context"] = s_text
+    full_spatial_text = "\n".join(spatial_dict.values())
+
+    # 2+3. 融合场景任务：一次全图请求同时生成 scene_context / activity_status / immediate_surroundings
+    if FUSE_SCENE:
+        scene_user_content = SCENE_USER_PROMPT.format(
+            imaging_time=meta["metadata"]["imaging_time"],
+            resolution=meta["metadata"]["resolution"],
+            center_coords=meta["metadata"]["center_coordinates"],
+            ship_info=ship_info_text,
+            ship_data=full_spatial_text
+        )
+        scene_res = ask_qwen(SCENE_SYS_PROMPT, scene_user_content, full_img)
+        try:
+            gen_data, pos_data = split_scene_result(json_repair.loads(scene_res))
             meta["scene_context"].update(gen_data["scene_context"])
-        if "objects_enrichment" in gen_data:
             for s_id, ob in gen_data["objects_enrichment"].items():
                 if s_id in meta["objects_enrichment"]:
                     meta["objects_enrichment"][s_id].update(ob)
-    except Exception as e: print(f"General parse error for {seq}: {e}")
+            for item in pos_data:
+                if item["ship_id"] in meta["objects_enrichment"]:
+                    meta["objects_enrichment"][item["ship_id"]]["immediate_surroundings"] = item["immediate_surroundings"]
+        except Exception as e: print(f"Scene parse error for {seq}: {e}")
+    else:
+        # 2. General 描述 (全图场景 - 仅针对 scene_context)
+        general_user_content = GENERAL_USER_PROMPT.format(
+            imaging_time=meta["metadata"]["imaging_time"],
+            resolution=meta["metadata"]["resolution"],
+            center_coords=meta["metadata"]["center_coordinates"],
+            ship_info=ship_info_text
+        )
+        gen_res = ask_qwen(GENERAL_SYS_PROMPT, general_user_content, full_img)
+        try:
+            gen_data = json_repair.loads(gen_res)
+            if "scene_context" in gen_data:
+                meta["scene_context"].update(gen_data["scene_context"])
+            if "objects_enrichment" in gen_data:
+                for s_id, ob in gen_data["objects_enrichment"].items():
+                    if s_id in meta["objects_enrichment"]:
+                        meta["objects_enrichment"][s_id].update(ob)
+        except Exception as e: print(f"General parse error for {seq}: {e}")
 
-    # 3. 空间位置描述 (LLM 一起生成，量化文本分别储存)
-    spatial_dict = format_ship_spatial_text(meta["objects_enrichment"])
-    for s_id, s_text in spatial_dict.items():
-        meta["objects_enrichment"][s_id]["spatial_context"] = s_text
-    full_spatial_text = "\n".join(spatial_dict.values())
-    pos_res = ask_qwen(POSITION_SYS_PROMPT, POSITION_USER_PROMPT.format(ship_data=full_spatial_text), full_img)
-    try:
-        pos_data = json_repair.loads(pos_res)
-        for item in pos_data:
-            s_id = item["ship_id"]
-            immediate_surroundings = item["immediate_surroundings"]
-            if s_id in meta["objects_enrichment"]:
-                meta["objects_enrichment"][s_id]["immediate_surroundings"] = immediate_surroundings
-    except: print(f"Position parse error for {seq}")
+        # 3. 空间位置描述 (LLM 一起生成，量化文本分别储存)
+        pos_res = ask_qwen(POSITION_SYS_PROMPT, POSITION_USER_PROMPT.format(ship_data=full_spatial_text), full_img)
+        try:
+            pos_data = json_repair.loads(pos_res)
+            for item in pos_data:
+                s_id = item["ship_id"]
+                immediate_surroundings = item["immediate_surroundings"]
+                if s_id in meta["objects_enrichment"]:
+                    meta["objects_enrichment"][s_id]["immediate_surroundings"] = immediate_surroundings
+        except: print(f"Position parse error for {seq}")
 
     # 4. 切片外貌描述 (采用插值放大，保持主体地位)
     MIN_PATCH_SIZE = 224
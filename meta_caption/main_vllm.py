@@ -1,76 +1,185 @@
-from prompt.utils import extract_normalized_info, format_ship_spatial_text
-from prompt.prompt import (GENERAL_SYS_PROMPT, GENERAL_USER_PROMPT, 
-                           POSITION_SYS_PROMPT, POSITION_USER_PROMPT, 
-                           APPEARANCE_SYS_PROMPT)
+from prompt.prompt import GENERAL_SYS_PROMPT, POSITION_SYS_PROMPT, SCENE_SYS_PROMPT
 
 
 import os, json
+from functools import partial
 from tqdm import tqdm
-from PIL import Image
-from vllm_handler import VLLMTaskHandler
+from pipeline import SeqPipeline, prepare_seq
+from metrics import METRICS, SeqProfiler
+from vllm_server import server_url, server_handler
 
-# 1. 初始化任务处理器
+NUM_WORKERS = 8   # 解码/裁剪 worker 进程数
+MAX_READY = 16    # 已准备好、等待提交给 GPU 的图像上限
+MAX_INFLIGHT_BYTES = 8 * 2**30  # 已提交未完成任务的图像字节上限，超出时阻塞生产者
+FUSE_SCENE = False  # general + position 合并为一次全图请求 (融合场景任务)，省去一次全图 prefill；默认关闭 (原有的 general + position 两次请求)，先用 bench_scene_fusion.py 比较两种模式再决定是否开启
+APPEARANCE_GROUP_SIZE = 1  # 每个外观请求打包的舰船切片数；1 为逐船请求 (默认，原有行为)，设为 >1 (如 8) 启用多图打包，启用前先抽样对比两种输出的描述质量
+ORDER_WINDOW = 64  # 每攒够 N 个任务按类型排序后提交，使共享系统 prompt 的请求相邻 (配合 vLLM 前缀缓存)
+
+img_root = "/root/autodl-fs/data/imgs/train"
 data_dir = "data/metadata/train"
-handler = VLLMTaskHandler(data_dir=data_dir)
-
-# gather all image sequence ids from rgb_images folder
-rgb_dir = "/root/autodl-fs/data/imgs/train/rgb_images"
-try:
-    seqs_all = sorted([os.path.splitext(f)[0] for f in os.listdir(rgb_dir) if f.lower().endswith('.jpg')])
-except Exception as e:
-    print(f"Could not list rgb images in {rgb_dir}: {e}")
-    seqs_all = []
-
-# Only process sequences that don't already have a result file in data/
-seqs = [s for s in seqs_all if not os.path.exists(os.path.join(data_dir, f"result_{s}.json"))]
-if not seqs:
-    print("No new images to process (all results already exist in data/).")
-
-progress = tqdm(total=len(seqs), desc="Processing images")
-handler.set_progress_bar(progress)
-
-for seq in seqs:
-    print(f"--- Processing {seq} ---")
-    tif, lbl, jpg = f"/root/autodl-fs/data/imgs/train/images/{seq}.tif", f"/root/autodl-fs/data/imgs/train/labels/{seq}.json", f"/root/autodl-fs/data/imgs/train/rgb_images/{seq}.jpg"
-    if not os.path.exists(jpg): continue
-    
-    full_img = Image.open(jpg).convert("RGB")
-    W, H = full_img.size
-    meta = extract_normalized_info(tif, lbl)
+store_path = None  # 例如 "data/metadata/train.sqlite"；None 时沿用 data_dir 下逐文件 result_{seq}.json
+cache_path = "data/cache/llm_cache.sqlite"  # LLM 响应缓存，None 不启用
+metrics_path = "data/metrics/main_vllm"  # 各阶段耗时 / 任务计数 / token 统计写入 {metrics_path}.json 与 .prom，None 不写
+# 设置环境变量 PROFILE_SEQ=<seq> 时对该图像从提交到落盘做 cProfile (PROFILE_MODE=py-spy 改为 py-spy 火焰图)，见 metrics.SeqProfiler
+# 设置环境变量 VLLM_SERVER_URL (例如 http://localhost:8000/v1) 时作为客户端连接常驻 vllm serve (见 vllm_server.py)，本进程不加载模型
+
+
+def server_tasks(handler, item, done):
+    """客户端模式：与本地模式相同的子任务，按 OpenAIHandler 的任务格式构建"""
+    full_img = item["img"]
+    tasks = []
+    fused = FUSE_SCENE and ("general", None) not in done and ("position", None) not in done
+    if fused:
+        tasks.append({'type': 'scene', 'sys': SCENE_SYS_PROMPT, 'usr': item["scene_usr"], 'img': full_img})
+    if not fused and ("general", None) not in done:
+        tasks.append({'type': 'general', 'sys': GENERAL_SYS_PROMPT, 'usr': item["general_usr"], 'img': full_img})
+    if not fused and ("position", None) not in done:
+        tasks.append({'type': 'position', 'sys': POSITION_SYS_PROMPT, 'usr': item["position_usr"], 'img': full_img})
+    return tasks + handler.build_appearance_tasks({s_id: patch for s_id, patch in item["patches"].items() if ("appearance", s_id) not in done})
+
+
+def make_handler(server=None, **overrides):
+    """server 为 VLLM_SERVER_URL 时连接常驻服务，否则本进程加载模型；overrides 覆盖结果/日志路径等配置 (如分片 worker 各自的结果库)"""
+    paths = {"data_dir": data_dir, "journal_path": os.path.join(data_dir, "journal.jsonl"), "store_path": store_path, "cache_path": cache_path, **overrides}
+    if server:
+        handler = server_handler(base_url=server, appearance_group_size=APPEARANCE_GROUP_SIZE, max_pending_seqs=MAX_READY, **paths)
+        print(f"Client mode: {server} ({handler.model})")
+    else:
+        from vllm_handler import VLLMTaskHandler  # 客户端模式无需安装 vllm
+        handler = VLLMTaskHandler(scheduler="stream", max_inflight_bytes=MAX_INFLIGHT_BYTES, appearance_group_size=APPEARANCE_GROUP_SIZE,
+                                  order_window=ORDER_WINDOW, **paths)
+    return handler
+
+
+def make_prepare_fn(handler, server=None):
+    """
+    SeqPipeline 的 prepare_fn。本地模式下把全图任务的模板片段与像素预算交给 worker 进程，
+    缩放与 prompt 拼接和图像解码一起在 worker 中完成，主线程只剩外观任务的模板拼接与提交。
+    客户端模式不传像素预算：过小的切片在 worker 中按 MIN_PATCH_SIZE 放大，上传前再按 server_handler 的上限缩小
+    """
+    if server:
+        return prepare_seq
+    templates = handler.worker_templates({"scene": SCENE_SYS_PROMPT, "general": GENERAL_SYS_PROMPT, "position": POSITION_SYS_PROMPT})
+    return partial(prepare_seq, templates=templates, pixel_budgets=handler.pixel_budgets)
+
+
+def submit_item(handler, item, server=None):
+    """把 pipeline 准备好的一张图拆成子任务提交给 handler"""
+    seq = item["seq"]
+    meta, full_img = item["meta"], item["img"]
+
+    # 从 journal 回放上次中断前已完成的子任务，只重发缺失的部分
+    done = handler.resume(seq, meta)
+    if server:
+        handler.submit_seq(seq, meta, server_tasks(handler, item, done))
+        return
     handler.all_metas[seq] = meta
-    
-    # 记录该 seq 总任务数：1(general) + 1(position) + n(appearance)
-    handler.tasks_remaining[seq] = 2 + len(meta["objects_enrichment"])
+
+    # 记录该 seq 总任务数：1(general) + 1(position) + n(appearance)，扣除已完成的
+    handler.tasks_remaining[seq] = 2 + len(meta["objects_enrichment"]) - len(done)
+    if handler.tasks_remaining[seq] == 0:
+        handler.save_result(seq)
+        return
+
+    # make_prepare_fn 的 worker 已缩放的全图与拼好的 prompt (没有时由 make_input 现做)
+    task_imgs, prompts = item.get("task_imgs", {}), item.get("prompts", {})
+
+    def full_image_input(t_type, sys_p):
+        return handler.make_input(sys_p, item[f"{t_type}_usr"], task_imgs.get(t_type, full_img), t_type, prompt=prompts.get(t_type))
+
+    # 1+2. 融合场景任务：一次全图请求同时生成 scene_context / activity_status / immediate_surroundings
+    fused = FUSE_SCENE and ("general", None) not in done and ("position", None) not in done
+    if fused:
+        handler.add_task({"type": "scene", "seq": seq, "input": full_image_input("scene", SCENE_SYS_PROMPT)})
 
     # 1. General 描述任务 (仅针对 scene_context)
-    ship_info_text = "\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in meta["objects_enrichment"].items()])
-    general_user_content = GENERAL_USER_PROMPT.format(
-        imaging_time=meta["metadata"]["imaging_time"],
-        resolution=meta["metadata"]["resolution"],
-        center_coords=meta["metadata"]["center_coordinates"],
-        ship_info=ship_info_text
-    )
-    handler.add_task({"type": "general", "seq": seq, "input": handler.make_input(GENERAL_SYS_PROMPT, general_user_content, full_img)})
-    
+    if not fused and ("general", None) not in done:
+        handler.add_task({"type": "general", "seq": seq, "input": full_image_input("general", GENERAL_SYS_PROMPT)})
+
     # 2. 空间描述任务 (LLM 一起生成，量化文本分别储存)
-    spatial_dict_for_meta = format_ship_spatial_text(meta["objects_enrichment"], top_k=20)
-    for s_id, s_text in spatial_dict_for_meta.items():
-        meta["objects_enrichment"][s_id]["spatial_context"] = s_text
-    spatial_dict_for_llm = format_ship_spatial_text(meta["objects_enrichment"], top_k=8)
-    full_spatial_text = "\n".join(spatial_dict_for_llm.values())
-    handler.add_task({"type": "position", "seq": seq, "input": handler.make_input(POSITION_SYS_PROMPT, POSITION_USER_PROMPT.format(ship_data=full_spatial_text), full_img)})
-
-    for s_id, info in meta["objects_enrichment"].items():
-        xc, yc, w_norm, h_norm = info["position"]
-        side = max(w_norm * W, h_norm * H) * 1.15
-        patch = full_img.crop((max(0, xc*W-side/2), max(0, yc*H-side/2), min(W, xc*W+side/2), min(H, yc*H+side/2)))
-        if max(patch.size) < 224:
-            scale = 224 / max(patch.size)
-            patch = patch.resize((int(patch.width*scale), int(patch.height*scale)), Image.LANCZOS)
-        handler.add_task({"type": "appearance", "seq": seq, "ship_id": s_id, "input": handler.make_input(APPEARANCE_SYS_PROMPT, "Describe this ship", patch)})
-
-handler.flush_all()
-try:
-    progress.close()
-except Exception:
-    pass
\ No newline at end of file
+    if not fused and ("position", None) not in done:
+        handler.add_task({"type": "position", "seq": seq, "input": full_image_input("position", POSITION_SYS_PROMPT)})
+
+    # 3. 视觉外观描述任务 (每 APPEARANCE_GROUP_SIZE 艘船一个多图请求)
+    handler.add_appearance_tasks(seq, {s_id: patch for s_id, patch in item["patches"].items() if ("appearance", s_id) not in done})
+
+
+def finish(handler, server=None):
+    """等待所有在途任务完成 (可重复调用)"""
+    if server:
+        handler.drain()
+    else:
+        handler.flush_all()
+
+
+def print_stats(handler, server=None, metrics_path=None):
+    if handler.cache is not None:
+        print(f"LLM cache: {handler.cache.stats()}")
+    if server:
+        print(f"Rate control: {handler.limiter.stats()}")
+        print(f"Image payload: {handler.payloads.stats()}")
+    else:
+        print(f"Memory: {handler.memory_stats()}")
+        print(f"Vision tokens: {handler.vision_token_stats()}")
+        print(f"Prefix cache: {handler.prefix_cache_stats()}")
+        print(f"Chat templates: {handler.templates.stats()}")
+        if handler.quarantined:
+            print(f"Quarantined {handler.quarantined} tasks, see {handler.dead_letter_path}")
+    print(f"Metrics: {json.dumps(METRICS.summary(), ensure_ascii=False)}")
+    if metrics_path:
+        METRICS.write(metrics_path)
+        print(f"Metrics written to {metrics_path}.json / .prom")
+
+
+def main():
+    # 1. 初始化任务处理器
+    server = server_url()
+    handler = make_handler(server)
+
+    # gather all image sequence ids from rgb_images folder
+    rgb_dir = os.path.join(img_root, "rgb_images")
+    try:
+        seqs_all = sorted([os.path.splitext(f)[0] for f in os.listdir(rgb_dir) if f.lower().endswith('.jpg')])
+    except Exception as e:
+        print(f"Could not list rgb images in {rgb_dir}: {e}")
+        seqs_all = []
+
+    # Only process sequences that don't already have a result file in data/
+    seqs = [s for s in seqs_all if not handler.store.has(s)]
+    if not seqs:
+        print("No new images to process (all results already exist in data/).")
+
+    progress = tqdm(total=len(seqs), desc="Processing images")
+    handler.set_progress_bar(progress)
+
+    jobs = [(seq, f"{img_root}/images/{seq}.tif", f"{img_root}/labels/{seq}.json", f"{img_root}/rgb_images/{seq}.jpg") for seq in seqs]
+    pipeline = SeqPipeline(jobs, prepare_fn=make_prepare_fn(handler, server), num_workers=NUM_WORKERS, max_ready=MAX_READY)
+    profiler = SeqProfiler.from_env()
+    if profiler is not None:
+        handler.on_saved = profiler.stop
+
+    # 解码、元数据、切片、缩放及全图任务的 prompt 均在 worker 中完成，主线程只负责外观任务模板拼接与提交
+    for item in pipeline:
+        seq = item["seq"]
+        if "error" in item:
+            print(f"Error preparing {seq}: {item['error']}")
+            continue
+        print(f"--- Processing {seq} --- {pipeline.stats()}")
+        if profiler is not None:
+            profiler.start(seq)
+        with METRICS.timer("submit_item"):
+            submit_item(handler, item, server)
+
+    finish(handler, server)
+    if profiler is not None:
+        # 该 seq 处理出错未落盘时在收尾处结束剖析
+        profiler.stop(profiler.seq)
+    print_stats(handler, server, metrics_path)
+    try:
+        progress.close()
+    except Exception:
+        pass
+
+
+if __name__ == "__main__":
+    main()
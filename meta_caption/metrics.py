@@ -0,0 +1,199 @@
+"""
+轻量指标层：各阶段耗时直方图、按任务类型的结果计数 (ok / parse_fail / exception)、prompt / completion token 合计，
+输出 JSON 摘要与 Prometheus 文本格式；SeqProfiler 可对单个 seq 从提交到落盘的全过程做 cProfile 或 py-spy 采样。
+
+    from metrics import METRICS
+    with METRICS.timer("llm_generate"):
+        ...
+    METRICS.count_task("general", "ok")
+    METRICS.add_tokens("general", prompt_tokens, completion_tokens)
+    METRICS.write("data/metrics/run")   # run.json + run.prom
+
+SeqPipeline 的 worker 进程在各自的 item["timings"] 中记录耗时，由主进程汇总 (见 pipeline.py)。
+"""
+import os, json, time, random, signal, cProfile, pstats, threading, subprocess
+from contextlib import contextmanager
+
+# Prometheus 直方图桶 (秒)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RESERVOIR_SIZE = 4096  # 每个阶段保留的样本数 (蓄水池采样)，用于分位数
+TASK_OUTCOMES = ("ok", "parse_fail", "exception")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.samples = []
+        self.rng = random.Random(0)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        if len(self.samples) < RESERVOIR_SIZE:
+            self.samples.append(value)
+        else:
+            j = self.rng.randrange(self.count)
+            if j < RESERVOIR_SIZE:
+                self.samples[j] = value
+
+    def summary(self):
+        if not self.count:
+            return {"count": 0}
+        return {"count": self.count, "total_s": round(self.sum, 4), "mean_ms": round(self.sum / self.count * 1000, 3),
+                **{f"p{q}_ms": round(percentile(self.samples, q) * 1000, 3) for q in (50, 90, 99)},
+                "max_ms": round(self.max * 1000, 3)}
+
+
+class Metrics:
+    """进程内指标注册表，线程安全；进程级单例见 METRICS"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.monotonic()
+            self.stages = {}
+            self.tasks = {}
+            self.tokens = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            hist = self.stages.get(stage)
+            if hist is None:
+                hist = self.stages[stage] = Histogram()
+            hist.observe(seconds)
+
+    def observe_many(self, timings):
+        """timings: {stage: 秒} (worker 进程带回的耗时)"""
+        for stage, seconds in timings.items():
+            self.observe(stage, seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count_task(self, task_type, outcome, n=1):
+        assert outcome in TASK_OUTCOMES, f"Unknown outcome: {outcome}"
+        with self.lock:
+            counts = self.tasks.setdefault(task_type, dict.fromkeys(TASK_OUTCOMES, 0))
+            counts[outcome] += n
+
+    def add_tokens(self, task_type, prompt_tokens=0, completion_tokens=0):
+        with self.lock:
+            tokens = self.tokens.setdefault(task_type, {"prompt": 0, "completion": 0})
+            tokens["prompt"] += prompt_tokens or 0
+            tokens["completion"] += completion_tokens or 0
+
+    def summary(self):
+        with self.lock:
+            tokens = {t: dict(v) for t, v in self.tokens.items()}
+            return {
+                "elapsed_s": round(time.monotonic() - self.started, 3),
+                "stages": {stage: hist.summary() for stage, hist in sorted(self.stages.items())},
+                "tasks": {t: dict(v) for t, v in sorted(self.tasks.items())},
+                "tokens": {**tokens, "total": {"prompt": sum(v["prompt"] for v in tokens.values()),
+                                               "completion": sum(v["completion"] for v in tokens.values())}},
+            }
+
+    def prometheus(self, prefix="meta_caption"):
+        """Prometheus 文本格式 (exposition format 0.0.4)"""
+        lines = [f"# HELP {prefix}_stage_seconds Wall time per pipeline stage", f"# TYPE {prefix}_stage_seconds histogram"]
+        with self.lock:
+            for stage, hist in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, n in zip(BUCKETS, hist.counts):
+                    cumulative += n
+                    lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+                lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {hist.sum:.6f}')
+                lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+            lines += [f"# HELP {prefix}_tasks_total LLM tasks by type and outcome", f"# TYPE {prefix}_tasks_total counter"]
+            for t_type, counts in sorted(self.tasks.items()):
+                for outcome, n in counts.items():
+                    lines.append(f'{prefix}_tasks_total{{task_type="{t_type}",outcome="{outcome}"}} {n}')
+            lines += [f"# HELP {prefix}_tokens_total Prompt/completion tokens by task type", f"# TYPE {prefix}_tokens_total counter"]
+            for t_type, tokens in sorted(self.tokens.items()):
+                for kind, n in tokens.items():
+                    lines.append(f'{prefix}_tokens_total{{task_type="{t_type}",kind="{kind}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path_prefix):
+        """写出 {path_prefix}.json 与 {path_prefix}.prom"""
+        os.makedirs(os.path.dirname(path_prefix) or ".", exist_ok=True)
+        with open(f"{path_prefix}.json", "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2, ensure_ascii=False)
+        with open(f"{path_prefix}.prom", "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+
+
+METRICS = Metrics()
+
+
+class SeqProfiler:
+    """
+    对单个 seq 从 start() (提交) 到 stop() (落盘) 做剖析：
+      mode="cprofile": 主线程 cProfile (vLLM 引擎推进与 OpenAI 事件循环都在主线程)，写出 {out_dir}/{seq}.prof 并打印前 30 项
+      mode="py-spy":   py-spy record 采样整个进程 (含 worker 线程)，写出 {out_dir}/{seq}.svg 火焰图
+    环境变量 PROFILE_SEQ / PROFILE_MODE / PROFILE_DIR 配置，见 from_env()
+    """
+    def __init__(self, seq, mode="cprofile", out_dir="data/profile"):
+        assert mode in ("cprofile", "py-spy"), f"Unknown profile mode: {mode}"
+        self.seq = seq
+        self.mode = mode
+        self.out_dir = out_dir
+        self.profiler = None
+        self.proc = None
+
+    @classmethod
+    def from_env(cls):
+        seq = os.getenv("PROFILE_SEQ")
+        if not seq:
+            return None
+        return cls(seq, os.getenv("PROFILE_MODE", "cprofile"), os.getenv("PROFILE_DIR", "data/profile"))
+
+    def start(self, seq):
+        if seq != self.seq or self.profiler is not None or self.proc is not None:
+            return
+        os.makedirs(self.out_dir, exist_ok=True)
+        print(f"Profiling {seq} ({self.mode})")
+        if self.mode == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.proc = subprocess.Popen(["py-spy", "record", "--pid", str(os.getpid()), "--rate", "200",
+                                          "-o", os.path.join(self.out_dir, f"{seq}.svg")])
+
+    def stop(self, seq):
+        if seq != self.seq:
+            return
+        if self.profiler is not None:
+            self.profiler.disable()
+            path = os.path.join(self.out_dir, f"{seq}.prof")
+            self.profiler.dump_stats(path)
+            pstats.Stats(self.profiler).sort_stats("cumulative").print_stats(30)
+            print(f"Profile of {seq} written to {path}")
+            self.profiler = None
+        elif self.proc is not None:
+            # py-spy 收到 SIGINT 后写出火焰图
+            self.proc.send_signal(signal.SIGINT)
+            self.proc.wait(timeout=60)
+            print(f"Flame graph of {seq} written to {os.path.join(self.out_dir, f'{seq}.svg')}")
+            self.proc = None
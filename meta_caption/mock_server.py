@@ -0,0 +1,273 @@
+"""
+最小 OpenAI 兼容假服务 (仅标准库)：在无 GPU / 无 API key 的环境下跑通客户端模式的完整流程，也用作基准测试后端。
+支持 /v1/models 与 /v1/chat/completions：
+  - 带 json_schema 的请求返回符合 schema 的 JSON (general / position / scene / appearance / appearance_multi)
+  - json_object 请求按系统 prompt 识别任务，返回该任务 OUTPUT FORMAT 对应的结构，包括 gen_ist 的 caption / VG / VQA / conversation
+MockProfile 控制延迟分布、生成速度 (tokens/s) 与错误率 (429 / 500)，stats() 记录各任务的请求数与服务端延迟。
+
+    python mock_server.py --port 8000 --latency-ms 800 --latency-dist lognormal --tokens-per-s 40 --error-rate 0.01
+    VLLM_SERVER_URL=http://localhost:8000/v1 python main_vllm.py
+"""
+import re, json, time, math, random, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from prompt.schema import SCENE_CONTEXT_SCHEMA
+
+SHIP_HEADER_RE = re.compile(r"^--- (\S+) ---$", re.M)
+SHIP_ID_RE = re.compile(r"\bShip_\d+\b")
+LABEL_RE = re.compile(r"^ship_id: (\S+)$", re.M)
+
+# 系统 prompt 中的特征片段 -> 任务类型 (按顺序匹配)
+TASK_MARKERS = [
+    ("caption", "Style_1_Summary"),
+    ("vg", "Visual Grounding"),
+    ("vqa", "Visual Question Answering"),
+    ("conversation", '"Conversation"'),
+    ("appearance_multi", "several ship image patches"),
+    ("scene", "all in one response"),
+    ("position", "Maritime Intelligence Analyst"),
+    ("general", "scene_context"),
+    ("appearance", "visual_appearance"),
+]
+
+
+class MockProfile:
+    """
+    延迟模型：首 token 延迟按 latency_dist 采样 (fixed / uniform [0, 2·mean] / lognormal，均值 latency_ms)，
+    再加上 completion_tokens / tokens_per_s 的生成时间 (tokens_per_s=0 表示不计)；error_rate 的请求返回 429 或 500。
+    fail_first: 前 N 个请求固定返回 429 (可复现的限流，用于测试)；retry_after: 429 响应附带的 Retry-After 秒数，None 不附带
+    """
+    def __init__(self, latency_ms=0.0, latency_dist="fixed", latency_sigma=0.5, tokens_per_s=0.0, error_rate=0.0, seed=None,
+                 fail_first=0, retry_after=None):
+        assert latency_dist in ("fixed", "uniform", "lognormal"), f"Unknown latency_dist: {latency_dist}"
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.tokens_per_s = tokens_per_s
+        self.error_rate = error_rate
+        self.fail_first = fail_first
+        self.retry_after = retry_after
+        self.failed_first = 0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def first_token_delay(self):
+        mean = self.latency_ms / 1000
+        if mean <= 0:
+            return 0.0
+        with self.lock:
+            if self.latency_dist == "uniform":
+                return self.rng.uniform(0, 2 * mean)
+            if self.latency_dist == "lognormal":
+                # 取 mu 使分布均值为 mean
+                return self.rng.lognormvariate(math.log(mean) - self.latency_sigma ** 2 / 2, self.latency_sigma)
+        return mean
+
+    def delay(self, completion_tokens):
+        gen = completion_tokens / self.tokens_per_s if self.tokens_per_s > 0 else 0.0
+        return self.first_token_delay() + gen
+
+    def error_status(self):
+        """按 fail_first / error_rate 返回 429 / 500，否则 None"""
+        with self.lock:
+            if self.failed_first < self.fail_first:
+                self.failed_first += 1
+                return 429
+            if self.error_rate <= 0 or self.rng.random() >= self.error_rate:
+                return None
+            return self.rng.choice((429, 500))
+
+
+def sample_from_schema(schema, key="value"):
+    """按 JSON Schema 生成一个合法样例；数组元素含 enum 字段时为每个枚举值生成一项 (如 position 的 ship_id)"""
+    if "enum" in schema:
+        return schema["enum"][0]
+    t_type = schema.get("type")
+    if t_type == "object":
+        return {k: sample_from_schema(v, k) for k, v in schema.get("properties", {}).items()}
+    if t_type == "array":
+        items = schema.get("items", {})
+        enum_key = next((k for k, v in items.get("properties", {}).items() if "enum" in v), None)
+        if enum_key is not None:
+            return [{**sample_from_schema(items, key), enum_key: e} for e in items["properties"][enum_key]["enum"]]
+        return [sample_from_schema(items, key)]
+    if t_type == "string":
+        return f"mock {key}"
+    if t_type in ("number", "integer"):
+        return 0
+    if t_type == "boolean":
+        return False
+    return None
+
+
+def message_text(message):
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+
+
+def detect_task(sys_p):
+    for t_type, marker in TASK_MARKERS:
+        if marker in sys_p:
+            return t_type
+    return None
+
+
+def qa_pairs(kind, n=3):
+    return [{"Instruction": f"mock {kind} question {i + 1}", "Answer": f"mock {kind} answer {i + 1}"} for i in range(n)]
+
+
+def mock_task_output(t_type, user_text):
+    """无 schema 时按任务类型构造与 prompt OUTPUT FORMAT 一致的结构"""
+    ship_ids = list(dict.fromkeys(SHIP_ID_RE.findall(user_text)))
+    if t_type == "caption":
+        return {style: {"Instruction": f"mock {style} instruction", "Answer": f"mock {style} answer"}
+                for style in ("Style_1_Summary", "Style_2_Detailed_Analysis", "Style_3_Spatial_Layout")}
+    if t_type == "vg":
+        return [{"Instruction": f"mock grounding question {i + 1}", "Answer": "[0.5, 0.5, 0.1, 0.05]"} for i in range(3)]
+    if t_type == "vqa":
+        return qa_pairs("vqa")
+    if t_type == "conversation":
+        return {"Conversation": [{"user": f"mock user turn {i + 1}", "assistant": f"mock assistant turn {i + 1}"} for i in range(3)]}
+    if t_type == "appearance_multi":
+        return {s_id: f"mock visual_appearance of {s_id}" for s_id in LABEL_RE.findall(user_text)}
+    if t_type in ("position", "scene"):
+        headers = list(dict.fromkeys(SHIP_HEADER_RE.findall(user_text))) or ship_ids
+        if t_type == "position":
+            return [{"ship_id": s_id, "immediate_surroundings": f"mock surroundings of {s_id}"} for s_id in headers]
+        return {"scene_context": sample_from_schema(SCENE_CONTEXT_SCHEMA),
+                "objects_enrichment": {s_id: {"activity_status": "mock activity_status", "immediate_surroundings": f"mock surroundings of {s_id}"}
+                                       for s_id in headers}}
+    if t_type == "general":
+        return {"scene_context": sample_from_schema(SCENE_CONTEXT_SCHEMA),
+                "objects_enrichment": {s_id: {"activity_status": "mock activity_status"} for s_id in ship_ids}}
+    return {"visual_appearance": "mock visual_appearance"}
+
+
+def mock_content(body):
+    """根据请求生成回复文本，返回 (任务类型, 文本)"""
+    messages = body.get("messages", [])
+    sys_p = "\n".join(message_text(m) for m in messages if m.get("role") == "system")
+    user_text = "\n".join(message_text(m) for m in messages if m.get("role") == "user")
+    t_type = detect_task(sys_p)
+    response_format = body.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return t_type or "schema", json.dumps(sample_from_schema(response_format["json_schema"]["schema"]), ensure_ascii=False)
+    if t_type is None and SHIP_HEADER_RE.search(user_text):
+        t_type = "position"
+    return t_type or "unknown", json.dumps(mock_task_output(t_type, user_text), ensure_ascii=False)
+
+
+class MockStats:
+    """服务端统计：各任务类型的请求数与服务延迟 (含模拟的排队外延迟)，错误数"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.errors = {}
+
+    def record(self, t_type, latency):
+        with self.lock:
+            self.tasks.setdefault(t_type, []).append(latency)
+
+    def record_error(self, status):
+        with self.lock:
+            self.errors[status] = self.errors.get(status, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": {t: len(v) for t, v in self.tasks.items()}, "errors": dict(self.errors),
+                    "latency_s": {t: list(v) for t, v in self.tasks.items()}}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    model = "mock-model"
+    profile = MockProfile()
+    stats = MockStats()
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": self.model, "object": "model"}]})
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+        start = time.monotonic()
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        status = self.profile.error_status()
+        if status is not None:
+            self.stats.record_error(status)
+            headers = {"Retry-After": str(self.profile.retry_after)} if status == 429 and self.profile.retry_after is not None else None
+            self.send_json(status, {"error": {"message": f"mock error {status}", "type": "mock"}}, headers)
+            return
+        t_type, content = mock_content(body)
+        prompt_tokens = sum(len(message_text(m)) for m in body.get("messages", [])) // 4
+        completion_tokens = len(content) // 4
+        time.sleep(self.profile.delay(completion_tokens))
+        self.stats.record(t_type, time.monotonic() - start)
+        self.send_json(200, {
+            "id": f"chatcmpl-mock-{time.time_ns()}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", self.model),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+
+def make_server(host="127.0.0.1", port=0, profile=None):
+    """每个服务有独立的 profile 与 stats (MockHandler 子类)"""
+    handler = type("BoundMockHandler", (MockHandler,), {"profile": profile or MockProfile(), "stats": MockStats()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.stats = handler.stats
+    return server
+
+
+def serve_in_thread(host="127.0.0.1", port=0, profile=None):
+    """在后台线程启动假服务，返回 (server, base_url)；server.stats 为服务端统计，用完调用 server.shutdown()"""
+    server = make_server(host, port, profile)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def add_profile_args(parser):
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="首 token 平均延迟 (毫秒)")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "lognormal"], default="fixed")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="lognormal 分布的 sigma")
+    parser.add_argument("--tokens-per-s", type=float, default=0.0, help="每个请求的生成速度，0 表示不模拟")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 429 / 500 的请求比例")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--fail-first", type=int, default=0, help="前 N 个请求固定返回 429")
+    parser.add_argument("--retry-after", type=float, default=None, help="429 响应附带的 Retry-After 秒数")
+
+
+def profile_from_args(args):
+    return MockProfile(args.latency_ms, args.latency_dist, args.latency_sigma, args.tokens_per_s, args.error_rate, args.seed,
+                       args.fail_first, args.retry_after)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Minimal OpenAI-compatible mock server for meta_caption client mode")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    print(f"Mock OpenAI server on http://{args.host}:{args.port}/v1")
+    make_server(args.host, args.port, profile_from_args(args)).serve_forever()
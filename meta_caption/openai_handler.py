@@ -1,45 +1,171 @@
 import os
-import json
+import math
 import base64
-import io
+import time
 import asyncio
 import json_repair
-from openai import AsyncOpenAI
-from PIL import Image
+from openai import AsyncOpenAI, RateLimitError, InternalServerError, APIConnectionError
+from journal import TaskJournal
+from result_store import open_result_store
+from llm_cache import ResponseCache
+from rate_control import AdaptiveLimiter, retry_after_seconds, backoff_delay
+from image_payload import ImagePayloadEncoder, QWEN_VL_FACTOR, fitted_size
+from metrics import METRICS
+from prompt.prompt import APPEARANCE_SYS_PROMPT, APPEARANCE_MULTI_SYS_PROMPT, APPEARANCE_MULTI_USER_PROMPT
+from prompt.utils import parse_appearance_map, split_scene_result
+from prompt.schema import task_schema, task_max_tokens, CHARS_PER_TOKEN
+
+# 聊天模板 (角色标记、图像起止标记等) 的 prompt token 开销估计
+PROMPT_TEMPLATE_TOKENS = 64
 
 class OpenAIHandler:
-    def __init__(self, api_key=None, base_url=None, model=None, data_dir="data/metadata/train", max_concurrent=10):
-        self.client = AsyncOpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"), base_url=base_url or os.getenv("OPENAI_BASE_URL"))
+    def __init__(self, api_key=None, base_url=None, model=None, data_dir="data/metadata/train", max_concurrent=10, journal_path=None, store_path=None, cache_path=None,
+                 max_concurrent_limit=64, max_retries=5, max_pixels=None, jpeg_quality=90,
+                 appearance_group_size=1, structured_output=True, max_pending_seqs=16, context_length=None,
+                 max_tokens_param="max_completion_tokens"):
+        # 重试由本类负责 (需要感知 429 以调整并发)，关闭 SDK 自带重试
+        self.client = AsyncOpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"), base_url=base_url or os.getenv("OPENAI_BASE_URL"), max_retries=0)
         self.model = model or os.getenv("OPENAI_MODEL")
         self.data_dir = data_dir
+        # 默认 data_dir 下逐文件 result_{seq}.json；store_path 以 .sqlite 结尾则写入 SQLite 结果库
+        self.store = open_result_store(store_path or data_dir)
         self.all_metas = {}
         self.progress = None
-        self.semaphore = asyncio.Semaphore(max_concurrent)
+        # 结果落盘后的回调 on_saved(seq)，例如守护进程统计入库延迟
+        self.on_saved = None
+        # 自适应并发：以 max_concurrent 为初始值，按延迟与 429/5xx 在 [1, max_concurrent_limit] 内 AIMD 调整
+        self.limiter = AdaptiveLimiter(initial=max_concurrent, max_limit=max_concurrent_limit)
+        self.max_retries = max_retries
+        # 子任务结果日志：完成即落盘，重启后 resume() 回放，只重发缺失的子任务
+        self.journal = TaskJournal(journal_path) if journal_path else None
+        # LLM 响应缓存：相同 prompt + 图像不再重复请求；None 不启用
+        self.cache = ResponseCache(cache_path) if cache_path else None
+        # 图像载荷：按任务类型缩放到像素预算 (max_pixels 覆盖 image_payload.DEFAULT_MAX_PIXELS)，每张图每种尺寸只编码一次
+        self.payloads = ImagePayloadEncoder(max_pixels=max_pixels, quality=jpeg_quality)
+        # 每个外观请求打包的舰船切片数 (多图输入，返回 {ship_id: visual_appearance})，1 为逐船请求
+        self.appearance_group_size = max(1, appearance_group_size)
+        # 按 prompt/schema.py 的任务 schema 发送 response_format=json_schema，max_tokens 取 schema 最长合法输出的上界
+        self.structured_output = structured_output
+        # 模型上下文长度 (如常驻 vLLM 的 max_model_len)；给出时 max_tokens 不超过其减去 prompt token 估计值的余量
+        self.context_length = context_length
+        # 输出 token 上限的请求参数名：新版 OpenAI 模型只接受 max_completion_tokens，旧网关可改为 "max_tokens"
+        self.max_tokens_param = max_tokens_param
+        # 同步调用方接口 (submit_seq / drain) 的内部事件循环与在途图像上限
+        self.max_pending_seqs = max_pending_seqs
+        self._loop = None
+        self._pending = set()
 
     def set_progress_bar(self, progress_bar):
         self.progress = progress_bar
 
     def encode_image(self, img):
-        buffered = io.BytesIO()
-        img.save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
-
-    async def call_openai(self, sys_p, usr_p, img):
-        async with self.semaphore:
-            base64_image = self.encode_image(img)
-            response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": sys_p},
-                {"role": "user", "content": [
-                    {"type": "text", "text": usr_p},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
-                ]}
-            ],
-            temperature=0.01,
-            response_format={"type": "json_object"}
-        )
-        return json_repair.loads(response.choices[0].message.content)
+        """img 可以是 PIL 图像或 update_seq 预先编码好的 JPEG 字节"""
+        jpeg = img if isinstance(img, bytes) else self.payloads.encode(img)
+        return base64.b64encode(jpeg).decode('utf-8')
+
+    def output_constraints(self, task, meta):
+        """任务的输出 schema 与 max_tokens (call_openai 的关键字参数)"""
+        if not self.structured_output:
+            return {}
+        t_type = task['type']
+        if t_type == 'appearance_multi':
+            ship_ids = task['ship_ids']
+        elif t_type in ('general', 'position', 'scene'):
+            ship_ids = list(meta["objects_enrichment"])
+        else:
+            ship_ids = None
+        context_tokens = None if self.context_length is None else self.context_length - self.prompt_token_estimate(task)
+        return {"schema": task_schema(t_type, ship_ids), "max_tokens": task_max_tokens(t_type, ship_ids, context_tokens)}
+
+    def prompt_token_estimate(self, task):
+        """prompt token 数的上界估计：文本按 CHARS_PER_TOKEN 字符/token (偏多)，图像按上传尺寸每 32x32 像素一个视觉 token，另加模板开销"""
+        budget = self.payloads.max_pixels.get("appearance" if task['type'] == "appearance_multi" else task['type'])
+        imgs = task['img'] if isinstance(task['img'], list) else [task['img']]
+        chars = len(task['sys']) + len(task['usr']) + sum(len(f"ship_id: {s_id}") for s_id in task.get('ship_ids') or [])
+        vision = sum(math.ceil(w / QWEN_VL_FACTOR) * math.ceil(h / QWEN_VL_FACTOR) for w, h in (fitted_size(img.size, budget) for img in imgs))
+        return math.ceil(chars / CHARS_PER_TOKEN) + vision + PROMPT_TEMPLATE_TOKENS
+
+    @staticmethod
+    def parse_content(content, task_type):
+        """解析模型输出并按 task_type 计数：得到 JSON 对象或数组为 ok，否则 parse_fail"""
+        with METRICS.timer("parse_json"):
+            res = json_repair.loads(content)
+        METRICS.count_task(task_type, "ok" if isinstance(res, (dict, list)) else "parse_fail")
+        return res
+
+    async def call_openai(self, sys_p, usr_p, img, labels=None, schema=None, max_tokens=None, task_type="unknown"):
+        """
+        img 为单张图像或图像列表；给出 labels 时每张图前插入其标签文本 (多船外观请求)。
+        schema 根节点为对象时使用 response_format=json_schema (非 strict，兼容第三方网关)，
+        否则 (如 position 的数组输出) 退回 json_object。task_type 仅用于 METRICS 的计数与 token 统计
+        """
+        base64_images = [self.encode_image(i) for i in (img if isinstance(img, list) else [img])]
+        request_kwargs = {"response_format": {"type": "json_object"}}
+        cache_params = {"temperature": 0.01, "response_format": "json_object"}
+        if schema is not None and schema.get("type") == "object":
+            request_kwargs["response_format"] = {"type": "json_schema", "json_schema": {"name": "task_output", "schema": schema, "strict": False}}
+            cache_params["response_format"] = request_kwargs["response_format"]
+        if max_tokens is not None:
+            request_kwargs[self.max_tokens_param] = cache_params["max_tokens"] = max_tokens
+        cache_key = None
+        if self.cache is not None:
+            cache_key = ResponseCache.make_key(self.model, cache_params, sys_p, usr_p, [b.encode() for b in base64_images])
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return self.parse_content(cached, task_type)
+        if labels is None:
+            content = [{"type": "text", "text": usr_p}]
+            content += [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b}"}} for b in base64_images]
+        else:
+            content = []
+            for label, b in zip(labels, base64_images):
+                content += [{"type": "text", "text": f"ship_id: {label}"},
+                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b}"}}]
+            content.append({"type": "text", "text": usr_p})
+        messages = [
+            {"role": "system", "content": sys_p},
+            {"role": "user", "content": content}
+        ]
+
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=0.01,
+                    **request_kwargs
+                )
+            except (RateLimitError, InternalServerError, APIConnectionError) as e:
+                # 429 / 5xx / 连接错误：收缩并发并重试；其余错误 (如 400) 直接抛出
+                if isinstance(e, APIConnectionError):
+                    self.limiter.on_error()
+                else:
+                    self.limiter.on_throttle()
+                if attempt == self.max_retries:
+                    METRICS.count_task(task_type, "exception")
+                    raise
+                delay = retry_after_seconds(e) or backoff_delay(attempt)
+                self.limiter.counts["retries"] += 1
+            except Exception:
+                METRICS.count_task(task_type, "exception")
+                raise
+            else:
+                elapsed = time.monotonic() - start
+                self.limiter.on_success(elapsed, response.usage, task_type)
+                METRICS.observe("llm_request", elapsed)
+                if response.usage is not None:
+                    METRICS.add_tokens(task_type, response.usage.prompt_tokens, response.usage.completion_tokens)
+                break
+            finally:
+                await self.limiter.release()
+            await asyncio.sleep(delay)
+
+        content = response.choices[0].message.content
+        if cache_key is not None:
+            self.cache.put(cache_key, content)
+        return self.parse_content(content, task_type)
 
     def apply_task_result(self, task, meta, res):
         if task['type'] == 'general':
@@ -52,23 +178,100 @@ class OpenAIHandler:
         elif task['type'] == 'appearance':
             meta["objects_enrichment"][task['ship_id']]["visual_appearance"] = res.get("visual_appearance", "")
 
-    async def process_single_task(self, task, meta):
-        res = await self.call_openai(task['sys'], task['usr'], task['img'])
+    def resume(self, seq, meta):
+        """把 journal 中该 seq 已完成的子任务结果回放到 meta，返回已完成的 {(type, ship_id)}"""
+        if self.journal is None:
+            return set()
+        done = self.journal.completed(seq)
+        for (t_type, s_id), res in done.items():
+            self.apply_task_result({"type": t_type, "ship_id": s_id}, meta, res)
+        return set(done)
+
+    def appearance_task(self, s_id, patch):
+        return {'type': 'appearance', 'sys': APPEARANCE_SYS_PROMPT, 'usr': "Describe this ship", 'img': patch, 'ship_id': s_id}
+
+    def build_appearance_tasks(self, patches):
+        """patches: {ship_id: 切片}；每 appearance_group_size 艘船打包为一个多图任务"""
+        items = list(patches.items())
+        n = self.appearance_group_size
+        tasks = []
+        for i in range(0, len(items), n):
+            group = dict(items[i:i + n])
+            if len(group) == 1:
+                tasks.append(self.appearance_task(*items[i]))
+                continue
+            ship_ids = list(group)
+            tasks.append({'type': 'appearance_multi', 'sys': APPEARANCE_MULTI_SYS_PROMPT,
+                          'usr': APPEARANCE_MULTI_USER_PROMPT.format(num_ships=len(ship_ids), ship_ids=", ".join(ship_ids)),
+                          'img': list(group.values()), 'ship_ids': ship_ids, 'patches': group})
+        return tasks
+
+    async def process_multi_task(self, task, meta, seq=None, payload=None):
+        """多船外观结果按船拆成单船结果记入 journal；缺失或无法解析的舰船回退为单切片请求"""
+        res = await self.call_openai(task['sys'], task['usr'], payload if payload is not None else task['img'], labels=task['ship_ids'],
+                                     task_type=task['type'], **self.output_constraints(task, meta))
+        found, missing = parse_appearance_map(res, task['ship_ids'])
+        for s_id, text in found.items():
+            single = {'type': 'appearance', 'ship_id': s_id}
+            self.apply_task_result(single, meta, {"visual_appearance": text})
+            if self.journal is not None and seq is not None:
+                self.journal.record(seq, 'appearance', s_id, {"visual_appearance": text})
+        if missing:
+            print(f"Multi-ship appearance for {seq} missing {missing}, falling back to single patches")
+            fallback = [self.appearance_task(s_id, task['patches'][s_id]) for s_id in missing]
+            budget = self.payloads.max_pixels.get('appearance')
+            await asyncio.gather(*[self.process_single_task(t, meta, seq, self.payloads.encode(t['img'], budget)) for t in fallback])
+        return res
+
+    async def process_single_task(self, task, meta, seq=None, payload=None):
+        if task['type'] == 'appearance_multi':
+            return await self.process_multi_task(task, meta, seq, payload)
+        res = await self.call_openai(task['sys'], task['usr'], payload if payload is not None else task['img'],
+                                     task_type=task['type'], **self.output_constraints(task, meta))
+        if task['type'] == 'scene':
+            # 融合场景任务拆成 general + position 两条结果回写并记入 journal
+            for t_type, part in zip(('general', 'position'), split_scene_result(res)):
+                self.apply_task_result({'type': t_type}, meta, part)
+                if self.journal is not None and seq is not None:
+                    self.journal.record(seq, t_type, None, part)
+            return res
         self.apply_task_result(task, meta, res)
+        if self.journal is not None and seq is not None:
+            self.journal.record(seq, task['type'], task.get('ship_id'), res)
         return res
 
     async def update_seq(self, seq, meta, tasks):
         try:
-            # 并发执行所有子任务
-            coros = [self.call_openai(task['sys'], task['usr'], task['img']) for task in tasks]
-            results = await asyncio.gather(*coros)
-            
-            for task, res in zip(tasks, results):
-                self.apply_task_result(task, meta, res)
+            # 同一图像的各任务共用一份缩放后的 JPEG，编码在线程中进行，不阻塞事件循环
+            payloads = await asyncio.to_thread(self.payloads.encode_tasks, tasks)
+            # 并发执行所有子任务，每个子任务完成即回写并记入 journal
+            await asyncio.gather(*[self.process_single_task(task, meta, seq, payload) for task, payload in zip(tasks, payloads)])
             
-            output_path = os.path.join(self.data_dir, f"result_{seq}.json")
-            with open(output_path, "w", encoding="utf-8") as f:
-                json.dump(meta, f, indent=4, ensure_ascii=False)
+            with METRICS.timer("save_result"):
+                self.store.put(seq, meta)
+            if self.journal is not None:
+                self.journal.mark_saved(seq)
+            if self.on_saved is not None:
+                self.on_saved(seq)
         except Exception as e:
             print(f"Error processing {seq}: {e}")
-        if self.progress: self.progress.update(1)
+        if self.progress:
+            self.progress.set_postfix(self.limiter.stats(), refresh=False)
+            self.progress.update(1)
+
+    def submit_seq(self, seq, meta, tasks):
+        """
+        供同步 runner 使用：在内部事件循环上调度 update_seq，在途图像达到 max_pending_seqs 时推进循环直到有图像完成。
+        调用方全部提交后需调用 drain()
+        """
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        self._pending.add(self._loop.create_task(self.update_seq(seq, meta, tasks)))
+        while len(self._pending) >= self.max_pending_seqs:
+            _, self._pending = self._loop.run_until_complete(asyncio.wait(self._pending, return_when=asyncio.FIRST_COMPLETED))
+
+    def drain(self):
+        """等待 submit_seq 提交的全部图像完成"""
+        if self._pending:
+            self._loop.run_until_complete(asyncio.wait(self._pending))
+            self._pending.clear()
@@ -0,0 +1,199 @@
+import time, queue, threading, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from metrics import METRICS
+from chat_template import fill_template
+from image_payload import resize_to_grid
+from prompt.utils import extract_normalized_info, format_ship_spatial_views
+from prompt.prompt import GENERAL_USER_PROMPT, POSITION_USER_PROMPT, SCENE_USER_PROMPT
+
+MIN_PATCH_SIZE = 224
+
+
+def crop_ship_patch(full_img, position, min_size=MIN_PATCH_SIZE):
+    """按归一化框裁出舰船切片 (15% padding)，过小则插值放大到 min_size"""
+    W, H = full_img.size
+    xc, yc, w_norm, h_norm = position
+    side = max(w_norm * W, h_norm * H) * 1.15
+    patch = full_img.crop((max(0, xc*W-side/2), max(0, yc*H-side/2), min(W, xc*W+side/2), min(H, yc*H+side/2)))
+    if max(patch.size) < min_size:
+        scale = min_size / max(patch.size)
+        patch = patch.resize((int(patch.width*scale), int(patch.height*scale)), Image.LANCZOS)
+    return patch
+
+
+def prepare_seq(seq, tif, lbl, jpg, templates=None, pixel_budgets=None):
+    """
+    在 worker 进程中完成 GPU 之前的全部 CPU 工作：
+    JPEG 解码、元数据提取、空间量化文本、prompt 文本与舰船切片；各步耗时记入 item["timings"]，由主进程汇总到 METRICS。
+    本地 vLLM 模式 (用 functools.partial 绑定参数) 还在此完成：
+      pixel_budgets: {任务类型: (min_pixels, max_pixels)}，全图按各全图任务的预算缩放到 patch 网格 (item["task_imgs"])，切片按 appearance 预算缩放
+    不给 appearance 预算时切片按 MIN_PATCH_SIZE 放大 (与 crop_ship_patch 默认一致)
+      templates: VLLMTaskHandler.worker_templates() 的模板片段，直接拼出各全图任务的完整 prompt (item["prompts"])
+    """
+    timings = {}
+    t0 = time.perf_counter()
+    full_img = Image.open(jpg).convert("RGB")
+    t1 = time.perf_counter()
+    timings["decode_jpeg"] = t1 - t0
+    meta = extract_normalized_info(tif, lbl)
+    t0 = time.perf_counter()
+    timings["extract_meta"] = t0 - t1
+    objects = meta["objects_enrichment"]
+
+    ship_info_text = "\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in objects.items()])
+    general_usr = GENERAL_USER_PROMPT.format(
+        imaging_time=meta["metadata"]["imaging_time"],
+        resolution=meta["metadata"]["resolution"],
+        center_coords=meta["metadata"]["center_coordinates"],
+        ship_info=ship_info_text
+    )
+
+    # 量化文本写入 meta (top_k=20)，送给 LLM 的版本更精简 (top_k=8)，共用一次近邻计算
+    t1 = time.perf_counter()
+    spatial_views = format_ship_spatial_views(objects, top_ks=(20, 8))
+    t2 = time.perf_counter()
+    timings["spatial_text"] = t2 - t1
+    for s_id, s_text in spatial_views[20].items():
+        objects[s_id]["spatial_context"] = s_text
+    ship_data = "\n".join(spatial_views[8].values())
+    position_usr = POSITION_USER_PROMPT.format(ship_data=ship_data)
+    # 融合场景任务 (general + position 合为一次全图请求) 的用户 prompt
+    scene_usr = SCENE_USER_PROMPT.format(
+        imaging_time=meta["metadata"]["imaging_time"],
+        resolution=meta["metadata"]["resolution"],
+        center_coords=meta["metadata"]["center_coordinates"],
+        ship_info=ship_info_text,
+        ship_data=ship_data
+    )
+
+    # 给出 appearance 像素预算时不在此放大：放大及 patch 网格对齐按预算一次完成 (下方 pixel_budgets 或 VLLMTaskHandler.make_input)；
+    # 否则 (客户端模式等) 切片上传前只会缩小不会放大，在此按 MIN_PATCH_SIZE 放大过小的切片
+    t3 = time.perf_counter()
+    timings["format_prompts"] = (t3 - t2) + (t1 - t0)
+    min_size = 0 if pixel_budgets and pixel_budgets.get("appearance") is not None else MIN_PATCH_SIZE
+    patches = {s_id: crop_ship_patch(full_img, info["position"], min_size=min_size) for s_id, info in objects.items()}
+    t0 = time.perf_counter()
+    timings["crop_patches"] = t0 - t3
+    item = {"seq": seq, "meta": meta, "img": full_img, "general_usr": general_usr, "position_usr": position_usr, "scene_usr": scene_usr,
+            "patches": patches, "timings": timings}
+
+    if pixel_budgets:
+        # 预算相同的任务共用一张缩放图
+        by_budget = {}
+        item["task_imgs"] = {}
+        for t_type in ("scene", "general", "position"):
+            budget = pixel_budgets.get(t_type)
+            if budget is not None:
+                if budget not in by_budget:
+                    by_budget[budget] = resize_to_grid(full_img, *budget)
+                item["task_imgs"][t_type] = by_budget[budget]
+        budget = pixel_budgets.get("appearance")
+        if budget is not None:
+            item["patches"] = {s_id: resize_to_grid(patch, *budget) for s_id, patch in patches.items()}
+        t1 = time.perf_counter()
+        timings["resize"] = t1 - t0
+        t0 = t1
+    if templates:
+        usr = {"scene": scene_usr, "general": general_usr, "position": position_usr}
+        item["prompts"] = {t_type: fill_template(segments, [usr[t_type]]) for t_type, segments in templates.items() if t_type in usr}
+        timings["template_fill_worker"] = time.perf_counter() - t0
+    return item
+
+
+class SeqPipeline:
+    """
+    生产者/消费者流水线：worker 进程池提前准备好每张图的输入，
+    主线程 (GPU 侧) 只需迭代取结果并提交任务。
+
+    同时存在的已提交 + 已就绪条目不超过 num_workers + max_ready，
+    消费者跟不上时生产者阻塞 (背压)，避免解码后的图像堆积在内存中。
+
+    streaming=True 时任务可在迭代过程中经 put() 持续追加，close() 后消费完即结束；
+    等待超过 idle_timeout 秒没有就绪条目时产出 None，消费者可借此收尾在途任务。
+    """
+    def __init__(self, jobs=(), prepare_fn=prepare_seq, num_workers=4, max_ready=8, streaming=False, idle_timeout=1.0):
+        self.jobs = queue.Queue()
+        self.prepare_fn = prepare_fn
+        self.num_workers = num_workers
+        self.streaming = streaming
+        self.idle_timeout = idle_timeout
+        self.ready = queue.Queue()
+        self.slots = threading.BoundedSemaphore(num_workers + max_ready)
+        self.lock = threading.Lock()
+        self.counts = {"pending": 0, "in_workers": 0, "consumed": 0}
+        self.submitted = 0
+        self.closed = False
+        for job in jobs:
+            self.put(job)
+        if not streaming:
+            self.close()
+
+    def put(self, job):
+        """追加一个 (seq, tif, lbl, jpg) 任务"""
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("SeqPipeline is closed")
+            self.counts["pending"] += 1
+            self.submitted += 1
+        self.jobs.put(job)
+
+    def close(self):
+        """不再接受新任务；已提交的任务全部产出后迭代结束"""
+        with self.lock:
+            if self.closed: return
+            self.closed = True
+        self.jobs.put(None)
+
+    def stats(self):
+        """各阶段队列深度：pending 等待提交，in_workers 正在准备，ready 等待 GPU 侧消费"""
+        with self.lock:
+            return {**self.counts, "ready": self.ready.qsize()}
+
+    def _on_done(self, job, future):
+        with self.lock:
+            self.counts["in_workers"] -= 1
+        try:
+            self.ready.put(future.result())
+        except Exception as e:
+            self.ready.put({"seq": job[0], "error": e})
+
+    def _feed(self, executor):
+        while True:
+            job = self.jobs.get()
+            if job is None: break
+            self.slots.acquire()
+            with self.lock:
+                self.counts["pending"] -= 1
+                self.counts["in_workers"] += 1
+            try:
+                future = executor.submit(self.prepare_fn, *job)
+            except Exception as e:
+                # 进程池已损坏等：作为错误条目产出，避免消费者一直等待
+                with self.lock:
+                    self.counts["in_workers"] -= 1
+                self.ready.put({"seq": job[0], "error": e})
+                continue
+            future.add_done_callback(lambda f, job=job: self._on_done(job, f))
+
+    def __iter__(self):
+        # spawn: 避免 fork 已初始化 CUDA 的主进程
+        with ProcessPoolExecutor(self.num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            feeder = threading.Thread(target=self._feed, args=(executor,), daemon=True)
+            feeder.start()
+            while True:
+                with self.lock:
+                    if self.closed and self.counts["consumed"] == self.submitted:
+                        break
+                try:
+                    item = self.ready.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    if self.streaming:
+                        yield None
+                    continue
+                with self.lock:
+                    self.counts["consumed"] += 1
+                self.slots.release()
+                METRICS.observe_many(item.pop("timings", {}))
+                yield item
+            feeder.join()
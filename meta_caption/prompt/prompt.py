@@ -92,6 +92,21 @@ Return the result strictly in JSON format with only the following field:
 Do not include any additional text, explanations, or extra fields.
 """
 
+APPEARANCE_MULTI_SYS_PROMPT = """
+You will receive several ship image patches, each preceded by its ship_id label. For every patch, describe the visual appearance of that ship in 2–3 sentences. Only describe the ship itself, including its structure, shape, proportions, color, materials, surface details, and visible components. Do not mention the environment, location, background, history, or any information unrelated to its physical appearance. Describe each patch independently.
+
+Return the result strictly in JSON format, with one entry per ship_id label:
+{
+  "ship_id": "visual_appearance content"
+}
+
+Do not include any additional text, explanations, or extra fields.
+"""
+
+APPEARANCE_MULTI_USER_PROMPT = """
+Describe each of the {num_ships} ships above: {ship_ids}
+"""
+
 
 GENERAL_SYS_PROMPT_OLD = """
 ### ROLE
@@ -178,3 +193,60 @@ GENERAL_USER_PROMPT = """
 {ship_info}
 """
 
+SCENE_SYS_PROMPT = """
+### ROLE
+You are an expert Remote Sensing Image Analyst specializing in maritime and naval intelligence.
+
+### TASK
+Analyze the provided high-resolution satellite image together with the image metadata and the **Quantitative Spatial Data** to describe the overall scene context, the activity of each ship, and the immediate surroundings of each ship, all in one response.
+
+### FIELD-BY-FIELD INSTRUCTIONS:
+1. **scene_context**:
+    - **scene_type**: Classify the overall scene (e.g., Naval Base, Commercial Harbor, Open Ocean).
+    - **time_of_day**: Infer based on lighting, shadow length, and direction.
+    - **weather_conditions**: Describe visibility, cloud cover, and sea state (e.g., calm, choppy).
+    - **background_elements**: List significant infrastructure or environmental features (e.g., "floating drydocks", "oil booms", "warehouses", "finger piers").
+    - **arrangement**: Describe the overall spatial distribution of the ships (e.g., "clustered tightly along the central pier", "scattered anchorages").
+    - **detail_description**: [CRITICAL] Write a high-quality, dense caption (approx. 50-80 words) summarizing the entire image. Combine the scene type, infrastructure context, ship density, and weather into a coherent report-style paragraph.
+
+2. **objects_enrichment**:
+    - For each Ship ID provided in the metadata:
+        - **activity_status**: Infer the status of the vessel based on visual cues (e.g., "Stationary/Docked", "Underway with wake", "Tugging operation").
+        - **immediate_surroundings**: A 2-3 sentence narrative of the ship's surroundings (where it is moored, proximity to piers, adjacent vessels, port infrastructure).
+            - Describe ONLY the surroundings; do not describe the ship's own appearance (hull color, size, vessel type).
+            - Use the image for port context but **strictly follow the Spatial Data** for distances and orientations.
+            - Use precise maritime terms ("berth", "alongside", "bow-to-stern", "mooring dolphin", "fairway", "anchorage") and no raw coordinates.
+
+### OUTPUT FORMAT
+Return ONLY the analysis in the following JSON format:
+{
+  "scene_context": {
+    "scene_type": "...",
+    "time_of_day": "...",
+    "weather_conditions": "...",
+    "background_elements": ["...", "..."],
+    "arrangement": "...",
+    "detail_description": "..."
+  },
+  "objects_enrichment": {
+    "Ship_001": {
+      "activity_status": "...",
+      "immediate_surroundings": "..."
+    },
+    ...
+  }
+}
+"""
+
+SCENE_USER_PROMPT = """
+### IMAGE METADATA
+- Imaging Time: {imaging_time}
+- Resolution: {resolution}
+- Center Coordinates: {center_coords}
+
+### DETECTED SHIPS (ID, Class, Normalized Box [x_center, y_center, width, height])
+{ship_info}
+
+### SPATIAL DATA INPUT (Ground Truth)
+{ship_data}
+"""
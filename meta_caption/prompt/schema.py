@@ -0,0 +1,148 @@
+"""
+各任务输出的 JSON Schema (字段取自 metaformat.json 与各 prompt 的 OUTPUT FORMAT)，
+用于 vLLM 结构化解码与 OpenAI response_format=json_schema。
+每个任务的 max_tokens 由 schema 本身推出 (所有字符串取满 maxLength、数组取满 maxItems 时的序列化长度)，
+保证任何合法的最长输出都不会被截断
+"""
+import json, math
+
+# 单句约 30 token；2-3 句描述留出余量
+SENTENCE_FIELD = {"type": "string", "maxLength": 800}
+CAPTION_FIELD = {"type": "string", "maxLength": 1200}
+ACTIVITY_FIELD = {"type": "string", "maxLength": 200}
+
+SCENE_CONTEXT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "scene_type": {"type": "string", "maxLength": 100},
+        "time_of_day": {"type": "string", "maxLength": 200},
+        "weather_conditions": {"type": "string", "maxLength": 300},
+        "background_elements": {"type": "array", "items": {"type": "string", "maxLength": 100}, "maxItems": 12},
+        "arrangement": {"type": "string", "maxLength": 400},
+        "detail_description": CAPTION_FIELD,
+    },
+    "required": ["scene_type", "time_of_day", "weather_conditions", "background_elements", "arrangement", "detail_description"],
+    "additionalProperties": False,
+}
+
+# 字符 -> token 换算：英文描述约 4 字符/token，按 3 估算留出余量；另加结束符等少量 token
+CHARS_PER_TOKEN = 3
+TOKEN_MARGIN = 16
+# 按 indent=2 的缩进格式估算长度 (模型常输出带缩进的 JSON，紧凑格式只会更短)
+JSON_INDENT = 2
+# 船数较多、最长合法输出超过 MAX_TOKENS_CAP 时，按比例收紧每艘船字段的 maxLength (不低于 MIN_FIELD_LENGTH) 使其放得下
+MAX_TOKENS_CAP = 4096
+# vLLM 上下文长度 (VLLMTaskHandler 与 vllm_server.serve_command 共用)，max_tokens 不超过其减去 prompt token 数的余量
+MAX_MODEL_LEN = 9216
+MIN_FIELD_LENGTH = 80
+NUMBER_CHARS = 24
+
+
+def schema_max_chars(schema, depth=0):
+    """
+    schema 所允许的最长 JSON 值按 indent=JSON_INDENT 序列化后的字符数上界 (起始于缩进层级 depth)；
+    字符串按不含转义的自然文本计，schema 不限长度 (无 maxLength / maxItems / 任意键对象) 时返回 None
+    """
+    if "enum" in schema:
+        return max(len(json.dumps(v, ensure_ascii=False)) for v in schema["enum"])
+    t = schema.get("type")
+    if t == "string":
+        return schema["maxLength"] + 2 if "maxLength" in schema else None
+    if t == "object":
+        if schema.get("additionalProperties", True) is not False:
+            return None
+        total = 0
+        for key, sub in schema.get("properties", {}).items():
+            child = schema_max_chars(sub, depth + 1)
+            if child is None:
+                return None
+            # 缩进 + "key": + 值 + ",\n"
+            total += JSON_INDENT * (depth + 1) + len(json.dumps(key, ensure_ascii=False)) + 2 + child + 2
+        return total + JSON_INDENT * depth + 2
+    if t == "array":
+        child = schema_max_chars(schema.get("items", {}), depth + 1)
+        if child is None or "maxItems" not in schema:
+            return None
+        return schema["maxItems"] * (JSON_INDENT * (depth + 1) + child + 2) + JSON_INDENT * depth + 2
+    return NUMBER_CHARS
+
+
+def schema_max_tokens(schema):
+    """schema 最长合法输出的 token 上界；不限长度时返回 None"""
+    chars = schema_max_chars(schema)
+    return None if chars is None else math.ceil(chars / CHARS_PER_TOKEN) + TOKEN_MARGIN
+
+
+def _ship_map(ship_ids, value_schema):
+    """以 ship_id 为键的对象；给出 ship_ids 时每艘船都必须出现"""
+    if not ship_ids:
+        return {"type": "object", "additionalProperties": value_schema}
+    return {
+        "type": "object",
+        "properties": {s_id: value_schema for s_id in ship_ids},
+        "required": list(ship_ids),
+        "additionalProperties": False,
+    }
+
+
+def _scaled(field, percent):
+    """每艘船字段按百分比收紧后的 schema"""
+    if percent >= 100:
+        return field
+    return {**field, "maxLength": max(MIN_FIELD_LENGTH, field["maxLength"] * percent // 100)}
+
+
+def _build_schema(task_type, ship_ids, percent=100):
+    if task_type == "general":
+        activity = {"type": "object", "properties": {"activity_status": _scaled(ACTIVITY_FIELD, percent)},
+                    "required": ["activity_status"], "additionalProperties": False}
+        return {"type": "object", "properties": {"scene_context": SCENE_CONTEXT_SCHEMA, "objects_enrichment": _ship_map(ship_ids, activity)},
+                "required": ["scene_context", "objects_enrichment"], "additionalProperties": False}
+    if task_type == "scene":
+        ship = {"type": "object",
+                "properties": {"activity_status": _scaled(ACTIVITY_FIELD, percent), "immediate_surroundings": _scaled(SENTENCE_FIELD, percent)},
+                "required": ["activity_status", "immediate_surroundings"], "additionalProperties": False}
+        return {"type": "object", "properties": {"scene_context": SCENE_CONTEXT_SCHEMA, "objects_enrichment": _ship_map(ship_ids, ship)},
+                "required": ["scene_context", "objects_enrichment"], "additionalProperties": False}
+    if task_type == "position":
+        item = {"type": "object",
+                "properties": {"ship_id": {"enum": list(ship_ids)} if ship_ids else {"type": "string"}, "immediate_surroundings": _scaled(SENTENCE_FIELD, percent)},
+                "required": ["ship_id", "immediate_surroundings"], "additionalProperties": False}
+        return {"type": "array", "items": item, "maxItems": len(ship_ids)} if ship_ids else {"type": "array", "items": item}
+    if task_type == "appearance":
+        return {"type": "object", "properties": {"visual_appearance": SENTENCE_FIELD},
+                "required": ["visual_appearance"], "additionalProperties": False}
+    if task_type == "appearance_multi":
+        return _ship_map(ship_ids, _scaled(SENTENCE_FIELD, percent))
+    return None
+
+
+def task_schema(task_type, ship_ids=None):
+    """
+    返回任务输出的 JSON Schema；未知任务类型返回 None (不做约束)。
+    最长合法输出超过 MAX_TOKENS_CAP 时，二分查找每艘船字段 maxLength 的最大收紧比例使其放得下
+    """
+    schema = _build_schema(task_type, ship_ids)
+    tokens = None if schema is None else schema_max_tokens(schema)
+    if tokens is None or tokens <= MAX_TOKENS_CAP or not ship_ids:
+        return schema
+    lo, hi = 0, 99  # lo: 已知放得下 (或已到下限) 的比例
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if schema_max_tokens(_build_schema(task_type, ship_ids, mid)) <= MAX_TOKENS_CAP:
+            lo = mid
+        else:
+            hi = mid - 1
+    return _build_schema(task_type, ship_ids, lo)
+
+
+def task_max_tokens(task_type, ship_ids=None, context_tokens=None):
+    """
+    任务的 max_tokens：取自 task_schema 最长合法输出的 token 上界，schema 限长时合法输出不会被截断；无法定界时为 MAX_TOKENS_CAP。
+    结果不超过 min(MAX_TOKENS_CAP, context_tokens)，context_tokens 为上下文长度减去 prompt token 数 (None 时不限)；
+    船数过多、字段收紧到 MIN_FIELD_LENGTH 仍超过上限时按上限截断
+    """
+    schema = task_schema(task_type, ship_ids)
+    tokens = None if schema is None else schema_max_tokens(schema)
+    limit = MAX_TOKENS_CAP if context_tokens is None else min(MAX_TOKENS_CAP, context_tokens)
+    return max(1, min(limit, MAX_TOKENS_CAP if tokens is None else tokens))
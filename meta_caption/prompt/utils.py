@@ -1,15 +1,22 @@
-import os, json, re, math
+import os, json, re, functools
+import numpy as np
 import rasterio
+import rasterio.transform
+from concurrent.futures import ThreadPoolExecutor
+
+@functools.lru_cache(maxsize=4096)
+def read_geo_header(tif_path):
+    """只读取 GeoTIFF 头信息 (仿射变换与尺寸)，不读取像素，按路径缓存"""
+    with rasterio.open(tif_path) as ds:
+        return ds.transform, ds.width, ds.height
 
 def extract_normalized_info(tif_path, json_path):
     # 1. 获取地理变换参数
-    with rasterio.open(tif_path) as ds:
-        gt = ds.transform
-        width, height = ds.width, ds.height
-        # rasterio transform: (a, b, c, d, e, f) 对应 GDAL: (c, a, b, f, d, e)
-        # gt[2] 是左上角 x, gt[0] 是 x 分辨率, gt[1] 是旋转
-        # gt[5] 是左上角 y, gt[3] 是旋转, gt[4] 是 y 分辨率
-        center_lon, center_lat = ds.xy(height // 2, width // 2)
+    gt, width, height = read_geo_header(tif_path)
+    # rasterio transform: (a, b, c, d, e, f) 对应 GDAL: (c, a, b, f, d, e)
+    # gt[2] 是左上角 x, gt[0] 是 x 分辨率, gt[1] 是旋转
+    # gt[5] 是左上角 y, gt[3] 是旋转, gt[4] 是 y 分辨率
+    center_lon, center_lat = rasterio.transform.xy(gt, height // 2, width // 2)
 
     # 2. 解析 JSON 标签
     with open(json_path, 'r', encoding='utf-8') as f:
@@ -17,7 +24,7 @@ def extract_normalized_info(tif_path, json_path):
 
     img_w, img_h = data.get('imageWidth', 1024), data.get('imageHeight', 1024)
     dates = re.findall(r'(\d{8})', data.get('imagePath', ''))
-    
+
     result = {
         "metadata": {
             "imaging_time": dates[-1] if dates else "Unknown",
@@ -35,16 +42,20 @@ def extract_normalized_info(tif_path, json_path):
         "objects_enrichment": {}
     }
 
-    # 3. 转换坐标
-    for i, shape in enumerate(data['shapes']):
-        pts = shape['points']
-        xs, ys = [p[0] for p in pts], [p[1] for p in pts]
-        min_x, max_x, min_y, max_y = min(xs), max(xs), min(ys), max(ys)
-        x_c, y_c = (min_x + max_x) / 2, (min_y + max_y) / 2
-        
-        # 计算绝对经纬度
-        lon, lat = ds.xy(y_c, x_c)
-        
+    # 3. 转换坐标：所有多边形顶点拼接后按 shape 分段求 bbox，再一次性做仿射变换
+    shapes = data['shapes']
+    counts = [len(shape['points']) for shape in shapes]
+    pts = np.array([p[:2] for shape in shapes for p in shape['points']], dtype=np.float64).reshape(-1, 2)
+    starts = np.cumsum([0] + counts[:-1])
+    min_xy = np.minimum.reduceat(pts, starts, axis=0)
+    max_xy = np.maximum.reduceat(pts, starts, axis=0)
+    center = (min_xy + max_xy) / 2
+
+    # 计算绝对经纬度
+    lons, lats = rasterio.transform.xy(gt, center[:, 1], center[:, 0])
+
+    for i, (shape, (min_x, min_y), (max_x, max_y), (x_c, y_c), lon, lat) in enumerate(
+            zip(shapes, min_xy.tolist(), max_xy.tolist(), center.tolist(), np.ravel(lons).tolist(), np.ravel(lats).tolist())):
         ship_id = f"Ship_{i+1:03d}"
         result["objects_enrichment"][ship_id] = {
             "class": shape.get('label', 'Unknown'),
@@ -54,17 +65,96 @@ def extract_normalized_info(tif_path, json_path):
         }
     return result
 
-def format_ship_spatial_text(analysis_results, top_k=8):
+def extract_normalized_infos(tif_dir, label_dir, seqs=None, num_workers=8):
+    """
+    批量提取整个标签目录的元数据，返回 {seq: meta}
+    seqs 为空时处理 label_dir 下所有 .json；缺少 tif 或解析失败的 seq 会打印并跳过
+    """
+    if seqs is None:
+        seqs = sorted(os.path.splitext(f)[0] for f in os.listdir(label_dir) if f.endswith('.json'))
+
+    def work(seq):
+        try:
+            return seq, extract_normalized_info(os.path.join(tif_dir, f"{seq}.tif"), os.path.join(label_dir, f"{seq}.json"))
+        except Exception as e:
+            print(f"Error extracting {seq}: {e}")
+            return seq, None
+
+    # 以文件 I/O 为主 (网络盘)，线程池即可
+    with ThreadPoolExecutor(num_workers) as ex:
+        return {seq: meta for seq, meta in ex.map(work, seqs) if meta is not None}
+
+# 距离分档边界与标签，区间左闭右开
+DIST_EDGES = np.array([0.1, 0.3, 0.6])
+DIST_LABELS = ["Very Close", "Close", "Moderate", "Far"]
+# 8 方向扇区边界 (度)，区间左闭右开，两端 (angle < -168 或 >= 168) 均为 Left
+DIR_EDGES = np.array([-168, -102, -78, -12, 12, 78, 102, 168])
+DIR_LABELS = ["Left", "Up-Left", "Up", "Up-Right", "Right", "Down-Right", "Down", "Down-Left", "Left"]
+
+def compute_ship_neighbors(analysis_results, max_k=None):
+    """
+    批量计算所有舰船的近邻关系 (NumPy 向量化)
+    返回 {ship_id: [(other_id, dist, d_label, dir_label), ...]}，按距离升序，最多 max_k 个
+    距离相同时保持原始顺序 (稳定排序)，与逐对计算的结果一致
+    """
+    ids = list(analysis_results.keys())
+    n = len(ids)
+    if n == 0:
+        return {}
+    k = n - 1 if max_k is None else min(max_k, n - 1)
+
+    pos = np.array([info['position'][:2] for info in analysis_results.values()], dtype=np.float64)
+    # dx[i, j] / dy[i, j]: other ship j 相对于当前 ship i 的偏移
+    dx = pos[None, :, 0] - pos[:, None, 0]
+    dy = pos[None, :, 1] - pos[:, None, 1]
+    sq = dx ** 2 + dy ** 2
+    np.fill_diagonal(sq, np.inf)
+    rows = np.arange(n)[:, None]
+
+    # 候选集：按平方距离用 argpartition 取每行前 k 个，再放宽一个相对余量，把开方后可能与第 k 个并列的也包含进来；
+    # 候选集之外的距离严格大于第 k 近的距离，只需在候选集上开方并稳定排序
+    if k == 0:
+        cand = np.empty((n, 0), dtype=np.intp)
+    elif k < n - 1:
+        kth = sq[rows[:, 0], np.argpartition(sq, k - 1, axis=1)[:, k - 1]]
+        m = int((sq <= kth[:, None] * (1 + 1e-9)).sum(axis=1).max())
+        cand = np.argpartition(sq, m - 1, axis=1)[:, :m]
+    else:
+        cand = np.broadcast_to(np.arange(n), (n, n))
+    # 候选按原始下标排列，稳定排序在距离相同时即保持原始顺序
+    cand = np.sort(cand, axis=1)
+    # 开方须与逐对实现的 float ** 0.5 (libm pow) 逐位一致，np.sqrt / np.power 与其差 1 ulp 时会改变并列近邻的顺序，
+    # 因此只对候选 (n x 约 k 个) 逐元素用 Python 计算
+    cand_sq = sq[rows, cand]
+    cand_dist = np.array([v ** 0.5 for v in cand_sq.ravel().tolist()]).reshape(cand_sq.shape)
+    sel = np.argsort(cand_dist, axis=1, kind='stable')[:, :k]
+    order = cand[rows, sel]
+    near_dist = cand_dist[rows, sel]
+    angle = np.degrees(np.arctan2(dy[rows, order], dx[rows, order]))
+    d_idx = np.searchsorted(DIST_EDGES, near_dist, side='right')
+    dir_idx = np.searchsorted(DIR_EDGES, angle, side='right')
+
+    neighbors = {}
+    for i, ship_id in enumerate(ids):
+        neighbors[ship_id] = [
+            (ids[j], d, DIST_LABELS[di], DIR_LABELS[ai])
+            for j, d, di, ai in zip(order[i].tolist(), near_dist[i].tolist(), d_idx[i].tolist(), dir_idx[i].tolist())
+        ]
+    return neighbors
+
+def format_ship_spatial_text(analysis_results, top_k=8, neighbors=None):
     """
     根据 position [x, y] 计算空间量化结果
     每艘船只仅保留距离最近的 top_k 艘船
     明确方向语义：other ship 相对于当前 ship（无歧义）
+    neighbors 可传入 compute_ship_neighbors 的结果 (max_k >= top_k) 以复用计算
     返回 {ship_id: 单船量化文本} 字典
     """
+    if neighbors is None:
+        neighbors = compute_ship_neighbors(analysis_results, max_k=top_k)
     ship_spatial_dict = {}
-    items = list(analysis_results.items())
 
-    for i, (ship_id, info) in enumerate(items):
+    for ship_id, info in analysis_results.items():
         x, y = info['position'][0], info['position'][1]
 
         # 计算绝对位置
@@ -75,48 +165,7 @@ def format_ship_spatial_text(analysis_results, top_k=8):
         line += f"Global Position: {h_pos}-{v_pos}\n"
         line += f"Relative Relations (Top-{top_k} Neighbors):\n"
 
-        # 计算与其他所有舰船的距离
-        relations = []
-        for j, (other_id, other_info) in enumerate(items):
-            if i == j:
-                continue
-
-            ox, oy = other_info['position'][0], other_info['position'][1]
-            dx, dy = ox - x, oy - y
-            dist = (dx ** 2 + dy ** 2) ** 0.5
-
-            relations.append((dist, other_id, dx, dy))
-
-        # 按距离排序并取前 top_k
-        relations.sort(key=lambda x: x[0])
-
-        for dist, other_id, dx, dy in relations[:top_k]:
-            d_label = (
-                "Very Close" if dist < 0.1 else
-                "Close" if dist < 0.3 else
-                "Moderate" if dist < 0.6 else
-                "Far"
-            )
-
-            # Determine 8-direction label using degrees (45-degree sectors)
-            angle = math.degrees(math.atan2(dy, dx))
-            if -12 <= angle < 12:
-                dir_label = "Right"
-            elif 12 <= angle < 78:
-                dir_label = "Down-Right"
-            elif 78 <= angle < 102:
-                dir_label = "Down"
-            elif 102 <= angle < 168:
-                dir_label = "Down-Left"
-            elif angle >= 168 or angle < -168:
-                dir_label = "Left"
-            elif -168 <= angle < -102:
-                dir_label = "Up-Left"
-            elif -102 <= angle < -78:
-                dir_label = "Up"
-            else: # -78 <= angle < -12:
-                dir_label = "Up-Right"
-
+        for other_id, dist, d_label, dir_label in neighbors[ship_id][:top_k]:
             # ⭐ 核心修改：显式写 relative to
             line += (
                 f"  - Relative to {ship_id}, "
@@ -127,3 +176,43 @@ def format_ship_spatial_text(analysis_results, top_k=8):
         ship_spatial_dict[ship_id] = line
 
     return ship_spatial_dict
+
+def format_ship_spatial_views(analysis_results, top_ks=(20, 8)):
+    """一次近邻计算，同时生成多个 top_k 视图：返回 {top_k: {ship_id: 文本}}"""
+    neighbors = compute_ship_neighbors(analysis_results, max_k=max(top_ks))
+    return {k: format_ship_spatial_text(analysis_results, top_k=k, neighbors=neighbors) for k in top_ks}
+
+
+def parse_appearance_map(data, ship_ids):
+    """
+    解析多船外观响应 {ship_id: visual_appearance}，值也可以是 {"visual_appearance": ...}。
+    返回 ({ship_id: 描述}, 缺失或为空的 ship_id 列表)
+    """
+    found = {}
+    if isinstance(data, dict):
+        for s_id in ship_ids:
+            value = data.get(s_id)
+            if isinstance(value, dict):
+                value = value.get("visual_appearance")
+            if isinstance(value, str) and value.strip():
+                found[s_id] = value
+    return found, [s_id for s_id in ship_ids if s_id not in found]
+
+
+def split_scene_result(data):
+    """
+    把融合场景任务的响应拆成 general 与 position 两个任务各自的结果格式：
+    ({"scene_context", "objects_enrichment" (不含 immediate_surroundings)}, [{"ship_id", "immediate_surroundings"}])
+    """
+    data = data if isinstance(data, dict) else {}
+    objects = data.get("objects_enrichment")
+    objects = objects if isinstance(objects, dict) else {}
+    general = {"scene_context": data.get("scene_context") or {}, "objects_enrichment": {}}
+    position = []
+    for s_id, ob in objects.items():
+        if not isinstance(ob, dict): continue
+        ob = dict(ob)
+        if "immediate_surroundings" in ob:
+            position.append({"ship_id": s_id, "immediate_surroundings": ob.pop("immediate_surroundings")})
+        general["objects_enrichment"][s_id] = ob
+    return general, position
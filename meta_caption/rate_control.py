@@ -0,0 +1,104 @@
+import time, random, asyncio
+from email.utils import parsedate_to_datetime
+
+
+class AdaptiveLimiter:
+    """
+    AIMD 自适应并发控制：
+    - 每个成功请求使上限增加 increase / limit (约每轮 +increase)
+    - 收到 429 / 5xx 时上限乘以 decrease；延迟超过最小观测延迟的 latency_factor 倍时乘以 0.9。
+      延迟按任务类型分别取基线，有 completion token 数时比较每个输出 token 的耗时，
+      输出长的 general / position 与输出短的 appearance 混跑时不会被误判为过载
+    - 收缩之间至少间隔 cooldown 秒，避免同一波失败把上限一路压到底
+    同时统计实际达到的 requests/s 与 tokens/s
+    """
+    def __init__(self, initial=6, min_limit=1, max_limit=64, increase=1.0, decrease=0.5, latency_factor=3.0, cooldown=2.0):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.inflight = 0
+        self.cond = asyncio.Condition()
+        self.min_latency = {}  # (任务类型, 是否按 token 归一化) -> 最小观测值
+        self.last_decrease = 0.0
+        self.start = time.monotonic()
+        self.counts = {"ok": 0, "throttled": 0, "errors": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    async def release(self):
+        async with self.cond:
+            self.inflight -= 1
+            self.cond.notify_all()
+
+    def _shrink(self, factor):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * factor)
+
+    def on_success(self, latency, usage=None, task_type=None):
+        self.counts["ok"] += 1
+        completion_tokens = 0
+        if usage is not None:
+            completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+            self.counts["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+            self.counts["completion_tokens"] += completion_tokens
+        key = (task_type, completion_tokens > 0)
+        value = latency / completion_tokens if completion_tokens else latency
+        baseline = self.min_latency[key] = min(self.min_latency.get(key, value), value)
+        if value > baseline * self.latency_factor:
+            self._shrink(0.9)
+        else:
+            self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+
+    def on_throttle(self):
+        self.counts["throttled"] += 1
+        self._shrink(self.decrease)
+
+    def on_error(self):
+        self.counts["errors"] += 1
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        tokens = self.counts["prompt_tokens"] + self.counts["completion_tokens"]
+        return {
+            **self.counts,
+            "limit": round(self.limit, 2),
+            "inflight": self.inflight,
+            "requests_per_s": round(self.counts["ok"] / elapsed, 3),
+            "tokens_per_s": round(tokens / elapsed, 1),
+        }
+
+
+def retry_after_seconds(exc):
+    """从异常携带的响应头解析 Retry-After (秒数或 HTTP 日期)，没有则返回 None"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """指数退避 + full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
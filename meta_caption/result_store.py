@@ -0,0 +1,117 @@
+import os, json, time, sqlite3, threading, argparse
+
+
+class DirResultStore:
+    """
+    现有布局：每张图一个 {data_dir}/result_{seq}.json
+    启动时只 listdir 一次，has() 为内存查找；写入先写临时文件再 os.replace，保证原子性
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        self._seqs = {f[len("result_"):-len(".json")] for f in os.listdir(data_dir)
+                      if f.startswith("result_") and f.endswith(".json")}
+
+    def path(self, seq):
+        return os.path.join(self.data_dir, f"result_{seq}.json")
+
+    def has(self, seq):
+        return seq in self._seqs
+
+    def get(self, seq):
+        with open(self.path(seq), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def put(self, seq, meta):
+        path = self.path(seq)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, indent=4, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._seqs.add(seq)
+
+    def seqs(self):
+        return sorted(self._seqs)
+
+    def items(self):
+        for seq in self.seqs():
+            yield seq, self.get(seq)
+
+    def __len__(self):
+        return len(self._seqs)
+
+
+class SQLiteResultStore:
+    """
+    单文件 SQLite 结果库，替代成千上万个小 JSON 文件 (网络盘上 listdir/open 开销大)
+    每次 put 为一个事务 (原子)；has() 为内存查找；items() 单游标顺序读取
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results (seq TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)")
+        self.conn.commit()
+        self._seqs = {row[0] for row in self.conn.execute("SELECT seq FROM results")}
+
+    def has(self, seq):
+        return seq in self._seqs
+
+    def get(self, seq):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM results WHERE seq = ?", (seq,)).fetchone()
+        if row is None:
+            raise KeyError(seq)
+        return json.loads(row[0])
+
+    def put(self, seq, meta):
+        data = json.dumps(meta, ensure_ascii=False)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO results (seq, data, updated) VALUES (?, ?, ?)", (seq, data, time.time()))
+        self._seqs.add(seq)
+
+    def seqs(self):
+        return sorted(self._seqs)
+
+    def items(self):
+        # 独立的只读连接逐行读取，不占用写连接，也不一次性载入全部结果
+        conn = sqlite3.connect(self.db_path)
+        try:
+            for seq, data in conn.execute("SELECT seq, data FROM results ORDER BY seq"):
+                yield seq, json.loads(data)
+        finally:
+            conn.close()
+
+    def __len__(self):
+        return len(self._seqs)
+
+    def close(self):
+        self.conn.close()
+
+
+def open_result_store(path):
+    """以 .sqlite / .db 结尾使用 SQLite 结果库，否则视为 result_{seq}.json 目录"""
+    if path.endswith((".sqlite", ".db")):
+        return SQLiteResultStore(path)
+    return DirResultStore(path)
+
+
+def copy_results(src, dst):
+    """在两种布局之间整体拷贝，返回拷贝条数"""
+    src_store, dst_store = open_result_store(src), open_result_store(dst)
+    n = 0
+    for seq, meta in src_store.items():
+        dst_store.put(seq, meta)
+        n += 1
+    return n
+
+
+if __name__ == "__main__":
+    # 例: python result_store.py data/metadata/train data/metadata/train.sqlite   (导入)
+    #     python result_store.py data/metadata/train.sqlite data/export/train   (导出为逐文件布局)
+    parser = argparse.ArgumentParser(description="在 result_{seq}.json 目录与 SQLite 结果库之间转换")
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    args = parser.parse_args()
+    print(f"Copied {copy_results(args.src, args.dst)} results: {args.src} -> {args.dst}")
@@ -0,0 +1,401 @@
+"""
+多 GPU / 多节点数据并行：seq 按稳定哈希分到 num_shards 个分片，共享目录 (NFS 等) 上的租约队列协调各 worker，
+自己的分片做完后从其他分片窃取剩余 seq；每个 worker 写独立的结果库，最后 merge 合并并校验每个 seq 恰有一份完整结果。
+
+    python sharding.py init   --queue-dir data/queue/train --num-shards 4
+    CUDA_VISIBLE_DEVICES=0 python sharding.py work --queue-dir data/queue/train --worker-id 0   # 每张卡 / 每个节点一个
+    python sharding.py status --queue-dir data/queue/train
+    python sharding.py merge  --queue-dir data/queue/train --dst data/metadata/train.sqlite
+
+--backend mock 在进程内启动 mock_server，无 GPU 也可多 worker 跑通整个流程。
+"""
+import os, sys, json, glob, time, socket, hashlib, argparse, threading
+
+from pipeline import SeqPipeline
+from result_store import open_result_store
+from vllm_server import server_url
+import main_vllm
+from main_vllm import make_handler, make_prepare_fn, submit_item, finish, print_stats
+
+LEASE_TTL = 900  # 租约有效期 (秒)，持有者每 LEASE_TTL/3 续约一次；过期的租约可被其他 worker 接管
+CLAIM_BATCH = 16  # 每次从本分片领取的 seq 数上限
+STEAL_BATCH = 4  # 本分片领完且空闲时，每次从其他分片窃取的 seq 数
+MAX_ATTEMPTS = 3  # 同一 seq 失败达到该次数后不再领取，留待 merge 报告
+
+
+def shard_of(seq, num_shards):
+    """稳定哈希 (与进程、机器、Python 版本无关) 决定 seq 的默认分片"""
+    return int.from_bytes(hashlib.sha1(seq.encode("utf-8")).digest()[:8], "big") % num_shards
+
+
+def write_atomic(path, text):
+    tmp = f"{path}.tmp.{os.getpid()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class LeaseQueue:
+    """
+    基于文件的租约队列，目录布局:
+      manifest.json     {"num_shards": N, "seqs": [...]}
+      leases/{seq}      O_EXCL 创建即持有，mtime 为最近续约时间
+      done/{seq}        完成标记 (内容为 worker_id)
+      failed/{seq}      失败次数
+
+    接管过期租约时先 rename 为墓碑 (只有一个 worker 能成功) 再重新创建；极端竞态下同一 seq 可能被处理两次，由 merge 检出并去重
+    """
+    def __init__(self, queue_dir, worker_id=None, lease_ttl=LEASE_TTL):
+        self.queue_dir = queue_dir
+        self.worker_id = str(worker_id) if worker_id is not None else f"{socket.gethostname()}-{os.getpid()}"
+        self.lease_ttl = lease_ttl
+        self.dirs = {kind: os.path.join(queue_dir, kind) for kind in ("leases", "done", "failed")}
+        for d in self.dirs.values():
+            os.makedirs(d, exist_ok=True)
+        with open(os.path.join(queue_dir, "manifest.json"), "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.num_shards = manifest["num_shards"]
+        self.seqs = manifest["seqs"]
+        self.lock = threading.Lock()
+        self.held = set()
+        self._order = {}
+
+    @staticmethod
+    def create(queue_dir, seqs, num_shards):
+        """写入 manifest；已存在时不覆盖 (避免运行中改变分片)，返回实际生效的 manifest"""
+        os.makedirs(queue_dir, exist_ok=True)
+        path = os.path.join(queue_dir, "manifest.json")
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        manifest = {"num_shards": num_shards, "seqs": sorted(seqs), "created": time.time()}
+        write_atomic(path, json.dumps(manifest))
+        return manifest
+
+    def path(self, kind, seq):
+        return os.path.join(self.dirs[kind], seq)
+
+    def attempts(self, seq):
+        try:
+            with open(self.path("failed", seq), "r") as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def claim_order(self, shard, steal=False):
+        """steal=False 为本分片的 seq；steal=True 为其他分片的 seq (从下一个分片起轮转，分散各 worker 的窃取目标)"""
+        if (shard, steal) in self._order:
+            return self._order[(shard, steal)]
+        by_shard = [[] for _ in range(self.num_shards)]
+        for seq in self.seqs:
+            by_shard[shard_of(seq, self.num_shards)].append(seq)
+        order = [seq for i in range(1, self.num_shards) for seq in by_shard[(shard + i) % self.num_shards]] if steal else by_shard[shard]
+        self._order[(shard, steal)] = order
+        return order
+
+    def _steal_expired(self, lease):
+        try:
+            if time.time() - os.stat(lease).st_mtime < self.lease_ttl:
+                return False
+            tomb = f"{lease}.expired.{self.worker_id}.{time.time_ns()}"
+            os.rename(lease, tomb)
+        except OSError:
+            return False
+        os.remove(tomb)
+        return True
+
+    def try_acquire(self, seq):
+        lease = self.path("leases", seq)
+        for _ in range(2):
+            try:
+                fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._steal_expired(lease):
+                    return False
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(self.worker_id)
+            # 领取与他人完成之间的竞态：拿到租约后再确认一次
+            if os.path.exists(self.path("done", seq)):
+                os.remove(lease)
+                return False
+            with self.lock:
+                self.held.add(seq)
+            return True
+        return False
+
+    def claim(self, shard, n=CLAIM_BATCH, steal=False):
+        """领取至多 n 个未完成、未被持有 (或租约已过期)、失败次数未超限的 seq"""
+        done = set(os.listdir(self.dirs["done"]))
+        failed = set(os.listdir(self.dirs["failed"]))
+        claimed = []
+        for seq in self.claim_order(shard, steal):
+            if len(claimed) >= n: break
+            if seq in done or seq in self.held: continue
+            if seq in failed and self.attempts(seq) >= MAX_ATTEMPTS: continue
+            if self.try_acquire(seq):
+                claimed.append(seq)
+        return claimed
+
+    def renew(self):
+        with self.lock:
+            held = list(self.held)
+        for seq in held:
+            try:
+                os.utime(self.path("leases", seq))
+            except OSError:
+                pass
+
+    def release(self, seq):
+        with self.lock:
+            self.held.discard(seq)
+        try:
+            os.remove(self.path("leases", seq))
+        except OSError:
+            pass
+
+    def complete(self, seq):
+        write_atomic(self.path("done", seq), self.worker_id)
+        self.release(seq)
+
+    def fail(self, seq):
+        write_atomic(self.path("failed", seq), str(self.attempts(seq) + 1))
+        self.release(seq)
+
+    def others_active(self):
+        """其他 worker 持有的未过期租约数；为 0 且无可领取 seq 时 worker 可退出"""
+        now = time.time()
+        with self.lock:
+            held = set(self.held)
+        n = 0
+        for name in os.listdir(self.dirs["leases"]):
+            if ".expired." in name or name in held: continue
+            try:
+                if now - os.stat(os.path.join(self.dirs["leases"], name)).st_mtime < self.lease_ttl:
+                    n += 1
+            except OSError:
+                pass
+        return n
+
+    def status(self):
+        done = set(os.listdir(self.dirs["done"]))
+        gave_up = {seq for seq in os.listdir(self.dirs["failed"]) if seq not in done and self.attempts(seq) >= MAX_ATTEMPTS}
+        now = time.time()
+        leased, expired = 0, 0
+        for name in os.listdir(self.dirs["leases"]):
+            if ".expired." in name: continue
+            try:
+                fresh = now - os.stat(os.path.join(self.dirs["leases"], name)).st_mtime < self.lease_ttl
+            except OSError:
+                continue
+            leased += fresh
+            expired += not fresh
+        shards = [{"total": 0, "done": 0} for _ in range(self.num_shards)]
+        for seq in self.seqs:
+            shard = shards[shard_of(seq, self.num_shards)]
+            shard["total"] += 1
+            shard["done"] += seq in done
+        return {"total": len(self.seqs), "done": len(done & set(self.seqs)), "leased": leased, "expired": expired,
+                "gave_up": len(gave_up), "remaining": len(self.seqs) - len(done & set(self.seqs)) - len(gave_up), "shards": shards}
+
+
+class ShardWorker:
+    """
+    领取 seq -> SeqPipeline 准备输入 -> handler 推理 -> on_saved 时标记完成；后台线程续约并按需补充领取。
+    结果写入 {out_dir}/worker_{worker_id}.sqlite，journal 与 metrics_{worker_id}.json / .prom 同目录
+    """
+    def __init__(self, queue, shard, img_root, out_dir, server=None, num_workers=8, max_ready=16, poll_interval=2.0):
+        self.queue = queue
+        self.shard = shard
+        self.img_root = img_root
+        self.out_dir = out_dir
+        self.server = server
+        self.max_ready = max_ready
+        self.poll_interval = poll_interval
+        os.makedirs(out_dir, exist_ok=True)
+        self.handler = make_handler(server, data_dir=out_dir,
+                                    journal_path=os.path.join(out_dir, f"journal_{queue.worker_id}.jsonl"),
+                                    store_path=os.path.join(out_dir, f"worker_{queue.worker_id}.sqlite"))
+        self.handler.on_saved = self.on_saved
+        self.pipeline = SeqPipeline(prepare_fn=make_prepare_fn(self.handler, server), num_workers=num_workers, max_ready=max_ready, streaming=True)
+        self.stop = threading.Event()
+        self.submitted = set()  # 已交给 handler、尚未确认落盘的 seq
+        self.counts = {"claimed": 0, "saved": 0, "failed": 0}
+
+    def job(self, seq):
+        return (seq, f"{self.img_root}/images/{seq}.tif", f"{self.img_root}/labels/{seq}.json", f"{self.img_root}/rgb_images/{seq}.jpg")
+
+    def claim_loop(self):
+        """pipeline 中排队不足时补充领取；没有可领取的 seq 且其他 worker 也没有活跃租约时关闭 pipeline"""
+        last_renew = 0.0
+        while not self.stop.is_set():
+            if time.monotonic() - last_renew > self.queue.lease_ttl / 3:
+                self.queue.renew()
+                last_renew = time.monotonic()
+            stats = self.pipeline.stats()
+            backlog = stats["pending"] + stats["in_workers"] + stats["ready"]
+            seqs = []
+            if backlog < self.max_ready:
+                seqs = self.queue.claim(self.shard, min(CLAIM_BATCH, self.max_ready - backlog))
+                # 本分片已领完且输入流水线已空：小批量窃取其他分片剩余的 seq
+                if not seqs and backlog == 0:
+                    seqs = self.queue.claim(self.shard, STEAL_BATCH, steal=True)
+                for seq in seqs:
+                    self.pipeline.put(self.job(seq))
+                self.counts["claimed"] += len(seqs)
+                if not seqs and backlog == 0 and not self.queue.held and not self.queue.others_active():
+                    break
+            if not seqs:
+                self.stop.wait(self.poll_interval)
+        self.pipeline.close()
+
+    def on_saved(self, seq):
+        self.queue.complete(seq)
+        self.counts["saved"] += 1
+
+    def settle(self):
+        """跑完已提交的任务；仍持有租约的 seq 即未能落盘，记一次失败并释放租约 (未超过 MAX_ATTEMPTS 时可被重新领取)"""
+        if not self.submitted:
+            return
+        finish(self.handler, self.server)
+        for seq in self.submitted:
+            if seq in self.queue.held:
+                self.counts["failed"] += 1
+                self.queue.fail(seq)
+        self.submitted.clear()
+
+    def run(self):
+        claimer = threading.Thread(target=self.claim_loop, daemon=True)
+        claimer.start()
+        for item in self.pipeline:
+            # None: 暂无就绪输入，先把已提交的任务跑完并释放租约
+            if item is None:
+                self.settle()
+                continue
+            seq = item["seq"]
+            if "error" in item:
+                print(f"Error preparing {seq}: {item['error']}")
+                self.counts["failed"] += 1
+                self.queue.fail(seq)
+                continue
+            self.submitted.add(seq)
+            submit_item(self.handler, item, self.server)
+        self.settle()
+        self.stop.set()
+        claimer.join()
+        print_stats(self.handler, self.server, os.path.join(self.out_dir, f"metrics_{self.queue.worker_id}"))
+        print(f"Worker {self.queue.worker_id} (shard {self.shard}): {self.counts}")
+
+
+def missing_fields(meta):
+    """结果中仍为空的 LLM 字段；空列表表示完整"""
+    missing = []
+    scene = meta.get("scene_context") or {}
+    if not scene.get("detail_description"):
+        missing.append("scene_context")
+    for s_id, ob in (meta.get("objects_enrichment") or {}).items():
+        for field in ("visual_appearance", "immediate_surroundings"):
+            if not ob.get(field):
+                missing.append(f"{s_id}.{field}")
+    return missing
+
+
+def merge_results(queue_dir, out_dir, dst=None, allow_duplicates=False):
+    """
+    合并 {out_dir}/worker_*.sqlite 到 dst (None 时只校验)。
+    每个 seq 取第一份完整结果 (worker 名排序)；报告缺失、重复 (多个 worker 都产出)、不完整及 manifest 之外的 seq。
+    重复说明租约曾被接管 (同一 seq 重复推理)，默认判为不通过；allow_duplicates=True 时只报告不影响 ok
+    """
+    with open(os.path.join(queue_dir, "manifest.json"), "r", encoding="utf-8") as f:
+        expected = json.load(f)["seqs"]
+    stores = {os.path.basename(p): open_result_store(p) for p in sorted(glob.glob(os.path.join(out_dir, "worker_*.sqlite")))}
+    owners = {}
+    for name, store in stores.items():
+        for seq in store.seqs():
+            owners.setdefault(seq, []).append(name)
+
+    dst_store = open_result_store(dst) if dst else None
+    report = {"expected": len(expected), "merged": 0, "complete": 0, "missing": [], "duplicates": {}, "incomplete": {},
+              "unexpected": sorted(set(owners) - set(expected))}
+    for seq in expected:
+        names = owners.get(seq)
+        if not names:
+            report["missing"].append(seq)
+            continue
+        if len(names) > 1:
+            report["duplicates"][seq] = names
+        best, best_missing = None, None
+        for name in names:
+            meta = stores[name].get(seq)
+            gaps = missing_fields(meta)
+            if best is None or len(gaps) < len(best_missing):
+                best, best_missing = meta, gaps
+            if not gaps: break
+        if best_missing:
+            report["incomplete"][seq] = best_missing
+        else:
+            report["complete"] += 1
+        if dst_store is not None:
+            dst_store.put(seq, best)
+        report["merged"] += 1
+    report["ok"] = not report["missing"] and not report["incomplete"] and (allow_duplicates or not report["duplicates"])
+    return report
+
+
+def list_seqs(img_root):
+    rgb_dir = os.path.join(img_root, "rgb_images")
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(rgb_dir) if f.lower().endswith(".jpg"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shard meta_caption across GPUs/nodes with a shared lease queue")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("init", help="写入分片 manifest")
+    p.add_argument("--queue-dir", required=True)
+    p.add_argument("--num-shards", type=int, required=True)
+    p.add_argument("--img-root", default=main_vllm.img_root)
+    p.add_argument("--existing", default=None, help="跳过该结果库中已有的 seq (默认 main_vllm 的 store_path 或 data_dir)")
+
+    p = sub.add_parser("work", help="运行一个 worker")
+    p.add_argument("--queue-dir", required=True)
+    p.add_argument("--worker-id", default=None, help="默认 hostname-pid")
+    p.add_argument("--shard", type=int, default=None, help="默认 worker-id (整数) 对分片数取模")
+    p.add_argument("--img-root", default=main_vllm.img_root)
+    p.add_argument("--out-dir", default=None, help="worker 结果库目录 (默认 {queue-dir}/results)")
+    p.add_argument("--backend", choices=["vllm", "server", "mock"], default=None,
+                   help="vllm: 本进程加载模型；server: VLLM_SERVER_URL；mock: 进程内假服务 (CPU)。默认有 VLLM_SERVER_URL 用 server，否则 vllm")
+    p.add_argument("--lease-ttl", type=float, default=LEASE_TTL)
+
+    p = sub.add_parser("status", help="查看队列进度")
+    p.add_argument("--queue-dir", required=True)
+
+    p = sub.add_parser("merge", help="合并并校验各 worker 结果")
+    p.add_argument("--queue-dir", required=True)
+    p.add_argument("--out-dir", default=None, help="worker 结果库目录 (默认 {queue-dir}/results)")
+    p.add_argument("--dst", default=None, help="合并目标结果库；不给则只校验")
+    p.add_argument("--allow-duplicates", action="store_true", help="多个 worker 产出同一 seq 时仍判为通过 (默认不通过)")
+
+    args = parser.parse_args()
+    if args.cmd == "init":
+        existing = open_result_store(args.existing or main_vllm.store_path or main_vllm.data_dir)
+        seqs = [s for s in list_seqs(args.img_root) if not existing.has(s)]
+        manifest = LeaseQueue.create(args.queue_dir, seqs, args.num_shards)
+        print(f"Queue {args.queue_dir}: {len(manifest['seqs'])} seqs in {manifest['num_shards']} shards")
+    elif args.cmd == "work":
+        queue = LeaseQueue(args.queue_dir, args.worker_id, lease_ttl=args.lease_ttl)
+        shard = args.shard if args.shard is not None else (int(args.worker_id) if str(args.worker_id).isdigit() else 0)
+        backend = args.backend or ("server" if server_url() else "vllm")
+        server = server_url() if backend == "server" else None
+        if backend == "mock":
+            import mock_server
+            _, server = mock_server.serve_in_thread()
+        worker = ShardWorker(queue, shard % queue.num_shards, args.img_root, args.out_dir or os.path.join(args.queue_dir, "results"),
+                             server=server, num_workers=main_vllm.NUM_WORKERS, max_ready=main_vllm.MAX_READY)
+        worker.run()
+    elif args.cmd == "status":
+        print(json.dumps(LeaseQueue(args.queue_dir).status(), indent=2))
+    elif args.cmd == "merge":
+        report = merge_results(args.queue_dir, args.out_dir or os.path.join(args.queue_dir, "results"), args.dst, args.allow_duplicates)
+        print(json.dumps({k: (v if not isinstance(v, (list, dict)) or len(v) <= 20 else f"{len(v)} items") for k, v in report.items()}, indent=2))
+        sys.exit(0 if report["ok"] else 1)
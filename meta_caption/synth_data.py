@@ -0,0 +1,94 @@
+"""
+合成数据集：按 img_root 布局写出 images/{seq}.tif (GeoTIFF)、labels/{seq}.json (labelme 多边形) 与 rgb_images/{seq}.jpg，
+每张图含 N 艘随机朝向的舰船，用于无真实数据时跑通 main_vllm / sharding / 基准测试。
+
+    python synth_data.py --out /tmp/synth --num-images 200 --ships 12
+"""
+import os, json, math, random, argparse
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from PIL import Image, ImageDraw
+
+SEA = (24, 58, 84)
+LAND = (128, 120, 104)
+HULLS = [(200, 200, 200), (120, 120, 128), (60, 70, 80), (170, 60, 50), (220, 210, 180)]
+
+
+def ship_polygon(rng, size, length_range=(20, 90)):
+    """随机位置与朝向的舰船外接矩形 (四个顶点，像素坐标)"""
+    length = rng.uniform(*length_range)
+    width = length * rng.uniform(0.15, 0.3)
+    cx, cy = rng.uniform(length, size - length), rng.uniform(length, size - length)
+    angle = rng.uniform(0, math.pi)
+    dx, dy = math.cos(angle), math.sin(angle)
+    corners = [(-length / 2, -width / 2), (length / 2, -width / 2), (length / 2, width / 2), (-length / 2, width / 2)]
+    return [[round(cx + x * dx - y * dy, 2), round(cy + x * dy + y * dx, 2)] for x, y in corners]
+
+
+def render(rng, size, polygons):
+    """海面噪声 + 一侧陆地/码头 + 舰船多边形"""
+    noise = np.random.default_rng(rng.randrange(2**32)).integers(-8, 9, (size, size, 3))
+    pixels = np.clip(np.array(SEA, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+    img = Image.fromarray(pixels)
+    draw = ImageDraw.Draw(img)
+    shore = rng.randrange(size // 10, size // 5)
+    draw.rectangle([0, 0, shore, size], fill=LAND)
+    for y in range(rng.randrange(40, 120), size, rng.randrange(150, 300)):
+        draw.rectangle([shore, y, shore + size // 4, y + 12], fill=LAND)
+    for poly in polygons:
+        draw.polygon([tuple(p) for p in poly], fill=rng.choice(HULLS))
+    return img
+
+
+def write_sample(root, seq, rng, size=1024, num_ships=10, res=0.5, num_classes=100):
+    polygons = [ship_polygon(rng, size) for _ in range(num_ships)]
+    img = render(rng, size, polygons)
+    img.save(os.path.join(root, "rgb_images", f"{seq}.jpg"), quality=90)
+
+    # 地理参考：随机原点，像元大小 res 米 (按赤道近似换算为度)
+    lon, lat = rng.uniform(100, 140), rng.uniform(5, 40)
+    deg = res / 111320
+    with rasterio.open(os.path.join(root, "images", f"{seq}.tif"), "w", driver="GTiff", width=size, height=size, count=3,
+                       dtype="uint8", crs="EPSG:4326", transform=from_origin(lon, lat, deg, deg)) as ds:
+        ds.write(np.asarray(img).transpose(2, 0, 1))
+
+    date = f"20{rng.randrange(18, 25)}{rng.randrange(1, 13):02d}{rng.randrange(1, 29):02d}"
+    label = {
+        "version": "5.2.1",
+        "flags": {},
+        "shapes": [{"label": str(rng.randrange(num_classes)), "points": poly, "group_id": None, "shape_type": "polygon",
+                    "flags": {}, "RES": str(res)} for poly in polygons],
+        "imagePath": f"{seq}_{date}.tif",
+        "imageData": None,
+        "imageHeight": size,
+        "imageWidth": size,
+    }
+    with open(os.path.join(root, "labels", f"{seq}.json"), "w", encoding="utf-8") as f:
+        json.dump(label, f)
+
+
+def generate_dataset(root, num_images=100, num_ships=10, size=1024, seed=0, prefix="SYN"):
+    """写出 num_images 组 (tif, json, jpg)，返回 seq 列表；已存在的样本不重写"""
+    for d in ("images", "labels", "rgb_images"):
+        os.makedirs(os.path.join(root, d), exist_ok=True)
+    seqs = []
+    for i in range(num_images):
+        seq = f"{prefix}{i:06d}"
+        seqs.append(seq)
+        if os.path.exists(os.path.join(root, "rgb_images", f"{seq}.jpg")):
+            continue
+        write_sample(root, seq, random.Random(f"{seed}-{i}"), size=size, num_ships=num_ships)
+    return seqs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic GeoTIFF + labelme + JPEG dataset")
+    parser.add_argument("--out", required=True, help="img_root (写入 images / labels / rgb_images)")
+    parser.add_argument("--num-images", type=int, default=100)
+    parser.add_argument("--ships", type=int, default=10, help="每张图的舰船数")
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    seqs = generate_dataset(args.out, args.num_images, args.ships, args.size, args.seed)
+    print(f"Wrote {len(seqs)} samples to {args.out}")
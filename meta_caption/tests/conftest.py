@@ -0,0 +1,4 @@
+import os, sys
+
+# meta_caption 下的模块以扁平方式互相导入 (from metrics import METRICS)，测试同样从该目录导入
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,57 @@
+import json
+import pytest
+
+import bench_pipeline
+import mock_server
+from metrics import METRICS
+from synth_data import generate_dataset
+
+NUM_IMAGES, NUM_SHIPS = 4, 5
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    img_root = str(tmp_path / "imgs")
+    return img_root, generate_dataset(img_root, num_images=NUM_IMAGES, num_ships=NUM_SHIPS, size=384)
+
+
+def test_bench_captions_against_mock_server(tmp_path, dataset):
+    img_root, seqs = dataset
+    args = bench_pipeline.build_parser().parse_args(["--num-images", str(NUM_IMAGES), "--workers", "2", "--max-ready", "4"])
+    METRICS.reset()
+    server, base_url = mock_server.serve_in_thread()
+    try:
+        report, store = bench_pipeline.run_captions(args, img_root, str(tmp_path / "out"), base_url)
+    finally:
+        server.shutdown()
+
+    assert report["images"] == NUM_IMAGES
+    assert report["prepare_errors"] == 0
+    assert sorted(store.seqs()) == seqs
+    for seq in seqs:
+        meta = store.get(seq)
+        assert meta["scene_context"]["detail_description"]
+        assert len(meta["objects_enrichment"]) == NUM_SHIPS
+        for info in meta["objects_enrichment"].values():
+            assert info["visual_appearance"] and info["immediate_surroundings"]
+    # 每张图 general + position + 每船一次 appearance，均按 schema 生成并解析成功
+    tasks = METRICS.summary()["tasks"]
+    assert sum(counts["ok"] for counts in tasks.values()) == report["tasks"] == NUM_IMAGES * (2 + NUM_SHIPS)
+    assert all(counts["parse_fail"] == 0 and counts["exception"] == 0 for counts in tasks.values())
+    assert server.stats.snapshot()["errors"] == {}
+
+
+def test_bench_main_writes_report(tmp_path, dataset):
+    img_root, _ = dataset
+    output = tmp_path / "bench.json"
+    args = bench_pipeline.build_parser().parse_args(["--num-images", str(NUM_IMAGES), "--workers", "2", "--img-root", img_root,
+                                                     "--output", str(output)])
+    assert bench_pipeline.main(args) == 0
+    with open(output, encoding="utf-8") as f:
+        report = json.load(f)
+    assert report["captions"]["images"] == NUM_IMAGES
+    assert report["backend"]["requests"] == {"general": NUM_IMAGES, "position": NUM_IMAGES, "appearance": NUM_IMAGES * NUM_SHIPS}
+    # 以自身为基线时不应报告回退
+    args.output, args.baseline = None, str(output)
+    args.tolerance = 1.0
+    assert bench_pipeline.main(args) == 0
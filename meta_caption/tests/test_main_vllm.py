@@ -0,0 +1,55 @@
+import json
+import pytest
+
+import image_payload
+import main_vllm
+import mock_server
+from image_payload import QWEN_VL_PIXEL_BUDGETS
+from pipeline import MIN_PATCH_SIZE
+from synth_data import generate_dataset
+
+
+@pytest.fixture
+def mock_url():
+    server, base_url = mock_server.serve_in_thread()
+    yield base_url
+    server.shutdown()
+
+
+def test_client_mode_end_to_end(tmp_path, mock_url, monkeypatch):
+    img_root = tmp_path / "imgs"
+    seqs = generate_dataset(str(img_root), num_images=3, num_ships=6, size=512)
+    data_dir = tmp_path / "metadata"
+    monkeypatch.setenv("VLLM_SERVER_URL", mock_url)
+    monkeypatch.setattr(main_vllm, "img_root", str(img_root))
+    monkeypatch.setattr(main_vllm, "data_dir", str(data_dir))
+    monkeypatch.setattr(main_vllm, "cache_path", None)
+    monkeypatch.setattr(main_vllm, "metrics_path", None)
+    monkeypatch.setattr(main_vllm, "NUM_WORKERS", 2)
+
+    # 记录上传前实际编码的图像尺寸
+    uploaded = []
+    fit_max_pixels = image_payload.fit_max_pixels
+
+    def recording_fit(img, max_pixels):
+        out = fit_max_pixels(img, max_pixels)
+        uploaded.append((max_pixels, out.size))
+        return out
+    monkeypatch.setattr(image_payload, "fit_max_pixels", recording_fit)
+
+    main_vllm.main()
+
+    for seq in seqs:
+        with open(data_dir / f"result_{seq}.json", encoding="utf-8") as f:
+            result = json.load(f)
+        assert len(result["objects_enrichment"]) == 6
+        for info in result["objects_enrichment"].values():
+            assert info["visual_appearance"]
+            assert info["immediate_surroundings"]
+            assert info["spatial_context"]
+        assert result["scene_context"]["detail_description"]
+
+    # 合成舰船远小于 224 像素，切片应按 MIN_PATCH_SIZE 放大后再上传
+    patch_sizes = [size for budget, size in uploaded if budget == QWEN_VL_PIXEL_BUDGETS["appearance"][1]]
+    assert len(patch_sizes) == 3 * 6
+    assert all(max(size) >= MIN_PATCH_SIZE - 1 for size in patch_sizes)
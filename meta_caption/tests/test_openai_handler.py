@@ -0,0 +1,51 @@
+import asyncio
+from types import SimpleNamespace
+from PIL import Image
+
+from openai_handler import OpenAIHandler
+from prompt.schema import MAX_MODEL_LEN, MAX_TOKENS_CAP, task_max_tokens
+from vllm_server import server_handler
+
+
+def fake_create(requests):
+    async def create(**kwargs):
+        requests.append(kwargs)
+        message = SimpleNamespace(content='{"visual_appearance": "ok"}')
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)],
+                               usage=SimpleNamespace(prompt_tokens=10, completion_tokens=5))
+    return create
+
+
+def appearance_request(handler):
+    requests = []
+    handler.client.chat.completions.create = fake_create(requests)
+    task = handler.appearance_task("Ship_001", Image.new("RGB", (224, 224)))
+    asyncio.run(handler.call_openai(task['sys'], task['usr'], task['img'], task_type="appearance",
+                                    **handler.output_constraints(task, {"objects_enrichment": {}})))
+    return requests[0]
+
+
+def test_max_tokens_param_is_configurable(tmp_path):
+    handler = OpenAIHandler(api_key="EMPTY", base_url="http://127.0.0.1:9/v1", model="m", data_dir=str(tmp_path))
+    request = appearance_request(handler)
+    assert request["max_completion_tokens"] == task_max_tokens("appearance")
+    assert "max_tokens" not in request
+
+    handler = OpenAIHandler(api_key="EMPTY", base_url="http://127.0.0.1:9/v1", model="m", data_dir=str(tmp_path), max_tokens_param="max_tokens")
+    request = appearance_request(handler)
+    assert request["max_tokens"] == task_max_tokens("appearance")
+    assert "max_completion_tokens" not in request
+
+
+def test_max_tokens_clamped_to_server_context(tmp_path):
+    handler = server_handler(base_url="http://127.0.0.1:9/v1", data_dir=str(tmp_path))
+    assert handler.context_length == MAX_MODEL_LEN
+    ids = [f"Ship_{i:03d}" for i in range(40)]
+    meta = {"objects_enrichment": {s_id: {} for s_id in ids}}
+    task = {'type': 'scene', 'sys': "s" * 3000, 'usr': "u" * 12000, 'img': Image.new("RGB", (2048, 2048))}
+    estimate = handler.prompt_token_estimate(task)
+    # 1536 个视觉 token 上限附近 + 文本 15000 / 3 + 模板开销
+    assert 5000 + 1400 < estimate < 5000 + 1600 + 100
+    constraints = handler.output_constraints(task, meta)
+    assert constraints["max_tokens"] == min(MAX_TOKENS_CAP, MAX_MODEL_LEN - estimate)
+    assert constraints["max_tokens"] + estimate <= MAX_MODEL_LEN
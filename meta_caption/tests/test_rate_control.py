@@ -0,0 +1,133 @@
+import time, asyncio, random
+import pytest
+from PIL import Image
+
+import mock_server
+import openai_handler
+from openai_handler import OpenAIHandler
+from rate_control import AdaptiveLimiter, backoff_delay, retry_after_seconds
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(**profile):
+        server, base_url = mock_server.serve_in_thread(profile=mock_server.MockProfile(**profile))
+        servers.append(server)
+        return server, base_url
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+def make_handler(tmp_path, base_url, **kwargs):
+    return OpenAIHandler(api_key="EMPTY", base_url=base_url, model="mock-model", data_dir=str(tmp_path), structured_output=False, **kwargs)
+
+
+def call(handler, n=1):
+    img = Image.new("RGB", (64, 64), (24, 58, 84))
+
+    async def run():
+        return await asyncio.gather(*[handler.call_openai("Describe the visual_appearance", "Describe this ship", img, task_type="appearance")
+                                      for _ in range(n)])
+    return asyncio.run(run())
+
+
+def test_backoff_is_jittered_and_capped():
+    random.seed(0)
+    for attempt in range(8):
+        delays = [backoff_delay(attempt, base=1.0, cap=10.0) for _ in range(200)]
+        assert all(0 <= d <= min(10.0, 2 ** attempt) for d in delays)
+        assert len(set(delays)) > 1
+
+
+def test_limiter_shrinks_on_throttle_and_recovers():
+    limiter = AdaptiveLimiter(initial=8, max_limit=16, cooldown=2.0)
+    limiter.on_throttle()
+    assert limiter.limit == 4
+    # 冷却期内的连续限流不再继续收缩
+    limiter.on_throttle()
+    assert limiter.limit == 4
+    for _ in range(100):
+        limiter.on_success(0.01)
+    assert limiter.limit >= 8
+    assert limiter.limit <= 16
+
+
+class Usage:
+    def __init__(self, completion_tokens, prompt_tokens=100):
+        self.completion_tokens = completion_tokens
+        self.prompt_tokens = prompt_tokens
+
+
+def test_mixed_task_latencies_do_not_shrink_limit():
+    limiter = AdaptiveLimiter(initial=8, max_limit=16, cooldown=0.0)
+    # 长输出的全图任务比短输出的外观任务慢一个数量级，但并未过载
+    for _ in range(20):
+        limiter.on_success(0.2, Usage(40), task_type="appearance")
+        limiter.on_success(3.0, Usage(600), task_type="general")
+        limiter.on_success(2.0, None, task_type="position")
+    assert limiter.last_decrease == 0.0
+    assert limiter.limit > 8
+
+
+def test_slowdown_within_task_type_shrinks_limit():
+    limiter = AdaptiveLimiter(initial=8, max_limit=16, cooldown=0.0)
+    limiter.on_success(0.2, Usage(40), task_type="appearance")
+    limit = limiter.limit
+    limiter.on_success(2.0, Usage(40), task_type="appearance")
+    assert limiter.limit < limit
+
+
+def test_retry_after_header_is_honoured(tmp_path, serve, monkeypatch):
+    # 去掉随机退避，等待时间只可能来自 Retry-After
+    monkeypatch.setattr(openai_handler, "backoff_delay", lambda attempt: 0.0)
+    server, base_url = serve(fail_first=1, retry_after=0.5)
+    handler = make_handler(tmp_path, base_url, max_concurrent=8)
+    start = time.monotonic()
+    (res,) = call(handler)
+    assert time.monotonic() - start >= 0.5
+    assert res == {"visual_appearance": "mock visual_appearance"}
+    assert handler.limiter.counts["throttled"] == 1
+    assert handler.limiter.counts["retries"] == 1
+    assert server.stats.snapshot()["errors"] == {429: 1}
+
+
+def test_retry_after_parsing():
+    class Response:
+        def __init__(self, headers):
+            self.headers = headers
+
+    class Error(Exception):
+        def __init__(self, headers):
+            self.response = Response(headers)
+    assert retry_after_seconds(Error({"retry-after": "3"})) == 3.0
+    assert retry_after_seconds(Error({"retry-after-ms": "250"})) == 0.25
+    assert retry_after_seconds(Error({})) is None
+
+
+def test_limit_shrinks_under_throttling_and_recovers(tmp_path, serve, monkeypatch):
+    monkeypatch.setattr(openai_handler, "backoff_delay", lambda attempt: 0.0)
+    _, base_url = serve(fail_first=1)
+    handler = make_handler(tmp_path, base_url, max_concurrent=8)
+    # 零延迟假服务的延迟抖动不应触发基于延迟的收缩，只观察限流的影响
+    handler.limiter.latency_factor = float("inf")
+    call(handler)
+    assert handler.limiter.counts["throttled"] == 1
+    assert handler.limiter.limit < 5
+    call(handler, n=60)
+    assert handler.limiter.limit >= 8
+
+
+def test_random_errors_are_retried(tmp_path, serve, monkeypatch):
+    monkeypatch.setattr(openai_handler, "backoff_delay", lambda attempt: 0.0)
+    server, base_url = serve(error_rate=0.3, seed=0)
+    handler = make_handler(tmp_path, base_url, max_concurrent=8, max_retries=20)
+    results = call(handler, n=40)
+    assert all(res == {"visual_appearance": "mock visual_appearance"} for res in results)
+    errors = sum(server.stats.snapshot()["errors"].values())
+    assert errors > 0
+    assert handler.limiter.counts["retries"] == errors
+    assert handler.limiter.counts["ok"] == 40
+    assert handler.limiter.last_decrease > 0
@@ -0,0 +1,62 @@
+import json, math
+import pytest
+
+from prompt.schema import CHARS_PER_TOKEN, MAX_TOKENS_CAP, task_schema, task_max_tokens, schema_max_chars, schema_max_tokens
+
+
+def longest_value(schema):
+    """构造 schema 允许的最长合法值：字符串取满 maxLength，数组取满 maxItems，enum 取最长项"""
+    if "enum" in schema:
+        return max(schema["enum"], key=lambda v: len(json.dumps(v)))
+    t = schema["type"]
+    if t == "string":
+        return "x" * schema["maxLength"]
+    if t == "object":
+        return {key: longest_value(sub) for key, sub in schema["properties"].items()}
+    if t == "array":
+        return [longest_value(schema["items"]) for _ in range(schema["maxItems"])]
+    raise AssertionError(f"unexpected schema type {t}")
+
+
+def ship_ids(n):
+    return [f"Ship_{i + 1:03d}" for i in range(n)]
+
+
+CASES = [("appearance", None)] + [(t, n) for t in ("general", "scene", "position", "appearance_multi") for n in (1, 3, 8, 20, 60)]
+
+
+@pytest.mark.parametrize("task_type,n", CASES)
+def test_longest_valid_output_fits_max_tokens(task_type, n):
+    ids = ship_ids(n) if n else None
+    schema = task_schema(task_type, ids)
+    max_tokens = task_max_tokens(task_type, ids)
+    value = longest_value(schema)
+    assert len(json.dumps(value, ensure_ascii=False, indent=2)) == schema_max_chars(schema)
+    if schema_max_tokens(schema) > MAX_TOKENS_CAP:
+        # 字段收紧到下限仍放不下 (如 60 艘船的 scene)：按上限截断
+        assert max_tokens == MAX_TOKENS_CAP
+        return
+    for text in (json.dumps(value, ensure_ascii=False), json.dumps(value, ensure_ascii=False, indent=2)):
+        assert math.ceil(len(text) / CHARS_PER_TOKEN) <= max_tokens
+
+
+@pytest.mark.parametrize("task_type", ["general", "scene", "position", "appearance_multi"])
+def test_many_ships_tighten_fields_to_fit_cap(task_type):
+    assert task_max_tokens(task_type, ship_ids(30)) <= MAX_TOKENS_CAP
+    # 船少时保持原始字段长度，船多时收紧每艘船的字段
+    assert json.dumps(task_schema(task_type, ship_ids(1))).count('"maxLength": 800') == (task_type != "general")
+    assert '"maxLength": 800' not in json.dumps(task_schema(task_type, ship_ids(30)))
+
+
+def test_max_tokens_clamped_to_context():
+    ids = ship_ids(8)
+    full = task_max_tokens("scene", ids)
+    assert task_max_tokens("scene", ids, context_tokens=full + 100) == full
+    assert task_max_tokens("scene", ids, context_tokens=500) == 500
+    assert task_max_tokens("general", context_tokens=1000) == 1000
+    assert task_max_tokens("scene", ids, context_tokens=-5) == 1
+
+
+def test_unbounded_schema_falls_back_to_cap():
+    assert task_max_tokens("general") == MAX_TOKENS_CAP
+    assert task_max_tokens("unknown") == MAX_TOKENS_CAP
@@ -0,0 +1,48 @@
+import os, time
+import pytest
+
+import main_vllm
+import mock_server
+from sharding import LeaseQueue, ShardWorker, merge_results
+from synth_data import generate_dataset
+
+
+@pytest.fixture
+def mock_url():
+    server, base_url = mock_server.serve_in_thread()
+    yield base_url
+    server.shutdown()
+
+
+def make_worker(queue_dir, worker_id, img_root, out_dir, server):
+    queue = LeaseQueue(queue_dir, worker_id, lease_ttl=60)
+    return ShardWorker(queue, 0, img_root, out_dir, server=server, num_workers=1, max_ready=4, poll_interval=0.1)
+
+
+def test_overlapping_lease_is_reported_as_duplicate(tmp_path, mock_url, monkeypatch):
+    monkeypatch.setattr(main_vllm, "cache_path", None)
+    img_root, queue_dir, out_dir = str(tmp_path / "imgs"), str(tmp_path / "queue"), str(tmp_path / "results")
+    seqs = generate_dataset(img_root, num_images=4, num_ships=3, size=256)
+    LeaseQueue.create(queue_dir, seqs, num_shards=1)
+
+    # worker a 领取一个 seq 后停顿，租约过期被 worker b 接管并完成；a 恢复后也完成了同一个 seq
+    overlap = seqs[0]
+    worker_a = make_worker(queue_dir, "a", img_root, out_dir, mock_url)
+    assert worker_a.queue.try_acquire(overlap)
+    stale = time.time() - 120
+    os.utime(worker_a.queue.path("leases", overlap), (stale, stale))
+
+    worker_b = make_worker(queue_dir, "b", img_root, out_dir, mock_url)
+    worker_b.run()
+    assert worker_b.counts["saved"] == len(seqs)
+
+    worker_a.pipeline.put(worker_a.job(overlap))
+    worker_a.run()
+    assert worker_a.counts["saved"] == 1
+
+    report = merge_results(queue_dir, out_dir, dst=str(tmp_path / "merged.sqlite"))
+    assert report["duplicates"] == {overlap: ["worker_a.sqlite", "worker_b.sqlite"]}
+    assert report["complete"] == report["merged"] == len(seqs)
+    assert not report["missing"] and not report["incomplete"]
+    assert report["ok"] is False
+    assert merge_results(queue_dir, out_dir, allow_duplicates=True)["ok"] is True
@@ -0,0 +1,91 @@
+import math, random
+import pytest
+from prompt.utils import format_ship_spatial_text, format_ship_spatial_views
+
+
+def baseline_spatial_text(analysis_results, top_k=8):
+    """向量化之前的逐对实现，作为输出逐字节一致的参照"""
+    ship_spatial_dict = {}
+    items = list(analysis_results.items())
+    for i, (ship_id, info) in enumerate(items):
+        x, y = info['position'][0], info['position'][1]
+        h_pos = "Left" if x < 0.33 else "Right" if x > 0.66 else "Center"
+        v_pos = "Top" if y < 0.33 else "Bottom" if y > 0.66 else "Middle"
+        line = f"--- {ship_id} ---\n"
+        line += f"Global Position: {h_pos}-{v_pos}\n"
+        line += f"Relative Relations (Top-{top_k} Neighbors):\n"
+        relations = []
+        for j, (other_id, other_info) in enumerate(items):
+            if i == j:
+                continue
+            ox, oy = other_info['position'][0], other_info['position'][1]
+            dx, dy = ox - x, oy - y
+            relations.append(((dx ** 2 + dy ** 2) ** 0.5, other_id, dx, dy))
+        relations.sort(key=lambda x: x[0])
+        for dist, other_id, dx, dy in relations[:top_k]:
+            d_label = "Very Close" if dist < 0.1 else "Close" if dist < 0.3 else "Moderate" if dist < 0.6 else "Far"
+            angle = math.degrees(math.atan2(dy, dx))
+            if -12 <= angle < 12:
+                dir_label = "Right"
+            elif 12 <= angle < 78:
+                dir_label = "Down-Right"
+            elif 78 <= angle < 102:
+                dir_label = "Down"
+            elif 102 <= angle < 168:
+                dir_label = "Down-Left"
+            elif angle >= 168 or angle < -168:
+                dir_label = "Left"
+            elif -168 <= angle < -102:
+                dir_label = "Up-Left"
+            elif -102 <= angle < -78:
+                dir_label = "Up"
+            else:
+                dir_label = "Up-Right"
+            line += f"  - Relative to {ship_id}, {other_id} is {d_label} (dist: {dist:.2f}) at the {dir_label}.\n"
+        ship_spatial_dict[ship_id] = line
+    return ship_spatial_dict
+
+
+def ships(positions):
+    return {f"Ship_{i}": {"position": [x, y, 0.01, 0.01]} for i, (x, y) in enumerate(positions)}
+
+
+def grid_layout(rng, step):
+    cells = [(i * step, j * step) for i in range(int(1 / step) + 1) for j in range(int(1 / step) + 1)]
+    return rng.sample(cells, min(len(cells), rng.randrange(2, 40)))
+
+
+def tied_layout(rng):
+    # 以中心船为圆心的对称点：距离完全相同，只能按原始顺序区分
+    cx, cy, r = rng.random(), rng.random(), rng.choice([0.05, 0.1, 0.25, 0.3])
+    return [(cx, cy)] + [(cx + dx * r, cy + dy * r) for dx, dy in [(1, 0), (0, 1), (-1, 0), (0, -1), (1, 1), (-1, -1), (1, -1), (-1, 1)]]
+
+
+LAYOUTS = {
+    "grid_0.1": lambda rng: grid_layout(rng, 0.1),
+    "grid_0.05": lambda rng: grid_layout(rng, 0.05),
+    "grid_1/3": lambda rng: grid_layout(rng, 1 / 3),
+    "tied": tied_layout,
+    "random": lambda rng: [(rng.random(), rng.random()) for _ in range(rng.randrange(1, 40))],
+}
+
+
+@pytest.mark.parametrize("layout", list(LAYOUTS))
+def test_spatial_text_matches_baseline(layout):
+    rng = random.Random(layout)
+    for _ in range(300):
+        objects = ships(LAYOUTS[layout](rng))
+        views = format_ship_spatial_views(objects, top_ks=(20, 8))
+        for top_k in (20, 8):
+            expected = baseline_spatial_text(objects, top_k)
+            assert format_ship_spatial_text(objects, top_k) == expected
+            assert views[top_k] == expected
+        # 小 top_k 时第 k 近处常有并列，覆盖候选集的余量
+        for top_k in (3, 1):
+            assert format_ship_spatial_text(objects, top_k) == baseline_spatial_text(objects, top_k)
+
+
+def test_spatial_text_empty_and_single():
+    assert format_ship_spatial_text({}) == {}
+    objects = ships([(0.5, 0.5)])
+    assert format_ship_spatial_text(objects) == baseline_spatial_text(objects)
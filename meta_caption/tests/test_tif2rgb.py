@@ -0,0 +1,74 @@
+import os, json
+import pytest
+from PIL import Image
+
+from synth_data import generate_dataset
+from utils import tif2rgb
+
+
+@pytest.fixture
+def tifs(tmp_path):
+    root = str(tmp_path / "data")
+    generate_dataset(root, num_images=3, num_ships=2, size=128)
+    return os.path.join(root, "images")
+
+
+def test_convert_writes_jpegs_and_manifest(tmp_path, tifs):
+    dst = str(tmp_path / "rgb")
+    tif2rgb.convert(tifs, dst, workers=2, scales=(2,), check="hash")
+    names = sorted(os.listdir(dst))
+    assert names == sorted([tif2rgb.MANIFEST] + [f"SYN{i:06d}.jpg" for i in range(3)])
+    assert Image.open(os.path.join(dst, "SYN000000.jpg")).size == (128, 128)
+    assert Image.open(os.path.join(tif2rgb.scaled_dir(dst, 2), "SYN000000.jpg")).size == (64, 64)
+    with open(os.path.join(dst, tif2rgb.MANIFEST), encoding="utf-8") as f:
+        assert len(json.load(f)) == 3
+
+
+def test_interrupted_write_leaves_no_final_jpeg(tmp_path, tifs, monkeypatch):
+    dst = str(tmp_path / "rgb")
+    os.makedirs(dst)
+    src = os.path.join(tifs, "SYN000000.tif")
+    save = Image.Image.save
+
+    def crash(self, fp, *args, **kwargs):
+        save(self, fp, *args, **kwargs)
+        with open(fp, "r+b") as f:
+            f.truncate(100)
+        raise KeyboardInterrupt
+    monkeypatch.setattr(Image.Image, "save", crash)
+    with pytest.raises(KeyboardInterrupt):
+        tif2rgb.convert_one(src, dst)
+    assert not os.path.exists(os.path.join(dst, "SYN000000.jpg"))
+    monkeypatch.undo()
+    assert not tif2rgb.is_up_to_date(src, dst, (), {})
+
+
+def test_manifest_saved_on_interrupt(tmp_path, tifs, monkeypatch):
+    dst = str(tmp_path / "rgb")
+
+    class Pool:
+        """同步执行的进程池，取第二个文件的结果时模拟中断"""
+        def __init__(self, workers):
+            self.calls = 0
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def submit(self, fn, *args):
+            self.calls += 1
+            interrupt = self.calls == 2
+
+            class Future:
+                def result(_):
+                    if interrupt:
+                        raise KeyboardInterrupt
+                    return fn(*args)
+            return Future()
+    monkeypatch.setattr(tif2rgb, "ProcessPoolExecutor", Pool)
+    with pytest.raises(KeyboardInterrupt):
+        tif2rgb.convert(tifs, dst, check="hash")
+    with open(os.path.join(dst, tif2rgb.MANIFEST), encoding="utf-8") as f:
+        assert list(json.load(f)) == ["SYN000000.tif"]
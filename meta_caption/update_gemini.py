@@ -1,47 +1,63 @@
-import os, json
+import os, json, asyncio
 from tqdm import tqdm
 from PIL import Image
 import dotenv
 
 from prompt.utils import format_ship_spatial_text
+from metrics import METRICS
 from prompt.prompt import (GENERAL_SYS_PROMPT, GENERAL_USER_PROMPT, 
-                           POSITION_SYS_PROMPT, POSITION_USER_PROMPT, 
+                           POSITION_SYS_PROMPT, POSITION_USER_PROMPT,
+                           SCENE_SYS_PROMPT, SCENE_USER_PROMPT, 
                            APPEARANCE_SYS_PROMPT)
 from gemini_handler import GeminiSDKHandler
 
 UPDATE_GENERAL = False
 UPDATE_POSITION = False
 UPDATE_APPEARANCE = True
+FUSE_SCENE = False  # 同时更新 general 与 position 时合并为一次全图请求 (融合场景任务)；默认关闭 (原有的 general + position 两次请求)，先用 bench_scene_fusion.py 比较两种模式再决定是否开启
+MAX_CONCURRENT_TASKS = 16   # 全局在途请求上限
+MAX_INFLIGHT_IMAGES = 8     # 同时处于处理中的图像数 (跨图像流水)
 
 dotenv.load_dotenv()
 
 data_dir = "data/metadata/train"
 rgb_dir = "data/imgs/train/rgb_images"
-handler = GeminiSDKHandler(data_dir=data_dir)
+store_path = None  # 例如 "data/metadata/train.sqlite"；None 时沿用 data_dir 下逐文件 result_{seq}.json
+cache_path = "data/cache/llm_cache.sqlite"  # LLM 响应缓存，None 不启用
+metrics_path = "data/metrics/update_gemini"  # 各阶段耗时 / 任务计数 / token 统计写入 {metrics_path}.json 与 .prom，None 不写
+handler = GeminiSDKHandler(data_dir=data_dir, store_path=store_path, cache_path=cache_path, max_concurrent=MAX_CONCURRENT_TASKS)
 
 seqs_all = sorted([os.path.splitext(f)[0] for f in os.listdir(rgb_dir) if f.lower().endswith('.jpg')])
-seqs = [s for s in seqs_all if os.path.exists(os.path.join(data_dir, f"result_{s}.json"))]
+seqs = [s for s in seqs_all if handler.store.has(s)]
 
 progress = tqdm(total=len(seqs), desc="Updating via Gemini SDK")
 handler.set_progress_bar(progress)
 
-for seq in seqs[:10]:
-    output_path = os.path.join(data_dir, f"result_{seq}.json")
-    with open(output_path, "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    
-    full_img = Image.open(os.path.join(rgb_dir, f"{seq}.jpg")).convert("RGB")
+def build_tasks(seq, meta):
+    with METRICS.timer("decode_jpeg"):
+        full_img = Image.open(os.path.join(rgb_dir, f"{seq}.jpg")).convert("RGB")
     W, H = full_img.size
     tasks = []
 
-    if UPDATE_GENERAL:
+    # 融合场景任务：一次全图请求同时生成 scene_context / activity_status / immediate_surroundings
+    fused = FUSE_SCENE and UPDATE_GENERAL and UPDATE_POSITION
+    if fused:
+        ship_info = "\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in meta["objects_enrichment"].items()])
+        with METRICS.timer("spatial_text"):
+            spatial_text = "\n".join(format_ship_spatial_text(meta["objects_enrichment"], top_k=8).values())
+        usr = SCENE_USER_PROMPT.format(imaging_time=meta["metadata"]["imaging_time"], resolution=meta["metadata"]["resolution"], 
+                                       center_coords=meta["metadata"]["center_coordinates"], ship_info=ship_info, ship_data=spatial_text)
+        tasks.append({'type': 'scene', 'sys': SCENE_SYS_PROMPT, 'usr': usr, 'img': full_img})
+
+    if not fused and UPDATE_GENERAL:
         ship_info = "\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in meta["objects_enrichment"].items()])
         usr = GENERAL_USER_PROMPT.format(imaging_time=meta["metadata"]["imaging_time"], resolution=meta["metadata"]["resolution"], 
                                          center_coords=meta["metadata"]["center_coordinates"], ship_info=ship_info)
         tasks.append({'type': 'general', 'sys': GENERAL_SYS_PROMPT, 'usr': usr, 'img': full_img})
 
-    if UPDATE_POSITION:
-        spatial_text = "\n".join(format_ship_spatial_text(meta["objects_enrichment"], top_k=8).values())
+    if not fused and UPDATE_POSITION:
+        with METRICS.timer("spatial_text"):
+            spatial_text = "\n".join(format_ship_spatial_text(meta["objects_enrichment"], top_k=8).values())
         tasks.append({'type': 'position', 'sys': POSITION_SYS_PROMPT, 'usr': POSITION_USER_PROMPT.format(ship_data=spatial_text), 'img': full_img})
 
     if UPDATE_APPEARANCE:
@@ -51,4 +67,29 @@ for seq in seqs[:10]:
             patch = full_img.crop((max(0, xc*W-side/2), max(0, yc*H-side/2), min(W, xc*W+side/2), min(H, yc*H+side/2)))
             tasks.append({'type': 'appearance', 'sys': APPEARANCE_SYS_PROMPT, 'usr': "Describe this ship", 'img': patch, 'ship_id': s_id})
 
-    handler.update_seq(seq, meta, tasks)
+    return tasks
+
+async def process_seq(seq, image_slots):
+    # 限制同时在途的图像数，既能跨图像流水又不会一次载入全部图像
+    async with image_slots:
+        try:
+            meta = handler.store.get(seq)
+            tasks = await asyncio.to_thread(build_tasks, seq, meta)
+        except Exception as e:
+            print(f"\nError preparing {seq}: {e}")
+            progress.update(1)
+            return
+        await handler.update_seq(seq, meta, tasks)
+
+async def main():
+    image_slots = asyncio.Semaphore(MAX_INFLIGHT_IMAGES)
+    await asyncio.gather(*[process_seq(seq, image_slots) for seq in seqs])
+    if handler.cache is not None:
+        print(f"LLM cache: {handler.cache.stats()}")
+    print(f"Image payload: {handler.payloads.stats()}")
+    print(f"Metrics: {json.dumps(METRICS.summary(), ensure_ascii=False)}")
+    if metrics_path:
+        METRICS.write(metrics_path)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -4,69 +4,114 @@ from PIL import Image
 import dotenv
 
 from prompt.utils import format_ship_spatial_text
+from metrics import METRICS
 from prompt.prompt import (GENERAL_SYS_PROMPT, GENERAL_USER_PROMPT, 
-                           POSITION_SYS_PROMPT, POSITION_USER_PROMPT, 
-                           APPEARANCE_SYS_PROMPT)
+                           POSITION_SYS_PROMPT, POSITION_USER_PROMPT,
+                           SCENE_SYS_PROMPT, SCENE_USER_PROMPT)
 from openai_handler import OpenAIHandler
 
 UPDATE_GENERAL = False
 UPDATE_POSITION = False
 UPDATE_APPEARANCE = True
-MAX_CONCURRENT_TASKS = 6
+FUSE_SCENE = False  # 同时更新 general 与 position 时合并为一次全图请求 (融合场景任务)；默认关闭 (原有的 general + position 两次请求)，先用 bench_scene_fusion.py 比较两种模式再决定是否开启
+MAX_CONCURRENT_TASKS = 6   # 初始并发，运行中按延迟与 429/5xx 自适应调整
+NUM_CONSUMERS = 8     # 同时处理中的图像数
+QUEUE_SIZE = 8        # 已载入、等待处理的图像上限 (背压)
+APPEARANCE_GROUP_SIZE = 1  # 每个外观请求打包的舰船切片数；1 为逐船请求 (默认，原有行为)，设为 >1 (如 8) 启用多图打包，启用前先抽样对比两种输出的描述质量
+SEQ_RANGE = slice(None)  # 例如 slice(400, 500) 只处理部分图像
 
 dotenv.load_dotenv()
 
 data_dir = "/root/autodl-tmp/wd/4x_caption/data/metadata/train"
 rgb_dir = "/root/autodl-fs/data/imgs/train/rgb_images"
-handler = OpenAIHandler(data_dir=data_dir, max_concurrent=MAX_CONCURRENT_TASKS)
+store_path = None  # 例如 ".../train.sqlite"；None 时沿用 data_dir 下逐文件 result_{seq}.json
+cache_path = "data/cache/llm_cache.sqlite"  # LLM 响应缓存，None 不启用
+metrics_path = "data/metrics/update_openai"  # 各阶段耗时 / 任务计数 / token 统计写入 {metrics_path}.json 与 .prom，None 不写
+handler = OpenAIHandler(data_dir=data_dir, max_concurrent=MAX_CONCURRENT_TASKS, journal_path=os.path.join(data_dir, "journal.jsonl"), store_path=store_path, cache_path=cache_path,
+                        appearance_group_size=APPEARANCE_GROUP_SIZE)
 
 seqs_all = sorted([os.path.splitext(f)[0] for f in os.listdir(rgb_dir) if f.lower().endswith('.jpg')])
-seqs = [s for s in seqs_all if os.path.exists(os.path.join(data_dir, f"result_{s}.json"))]
+seqs = [s for s in seqs_all if handler.store.has(s)]
 
-progress = tqdm(total=len(seqs), desc="Updating via OpenAI (Async)")
+progress = tqdm(total=len(seqs[SEQ_RANGE]), desc="Updating via OpenAI (Async)")
 handler.set_progress_bar(progress)
 
-async def main():
-    all_tasks = []
-    for seq in seqs[400:500]:
+def prepare(seq):
+    """载入图像并构建子任务 (在线程中执行)；无需处理时返回 None"""
+    meta = handler.store.get(seq)
+    # 从 journal 回放上次中断前已完成的子任务，只重发缺失的部分
+    done = handler.resume(seq, meta)
+    
+    with METRICS.timer("decode_jpeg"):
+        full_img = Image.open(os.path.join(rgb_dir, f"{seq}.jpg")).convert("RGB")
+    W, H = full_img.size
+    tasks_data = []
+
+    # 融合场景任务：一次全图请求同时生成 scene_context / activity_status / immediate_surroundings
+    fused = FUSE_SCENE and UPDATE_GENERAL and UPDATE_POSITION and ("general", None) not in done and ("position", None) not in done
+    if fused:
+        ship_info = "\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in meta["objects_enrichment"].items()])
+        with METRICS.timer("spatial_text"):
+            spatial_text = "\n".join(format_ship_spatial_text(meta["objects_enrichment"], top_k=8).values())
+        usr = SCENE_USER_PROMPT.format(imaging_time=meta["metadata"]["imaging_time"], resolution=meta["metadata"]["resolution"], 
+                                       center_coords=meta["metadata"]["center_coordinates"], ship_info=ship_info, ship_data=spatial_text)
+        tasks_data.append({'type': 'scene', 'sys': SCENE_SYS_PROMPT, 'usr': usr, 'img': full_img})
+
+    if not fused and UPDATE_GENERAL and ("general", None) not in done:
+        ship_info = "\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in meta["objects_enrichment"].items()])
+        usr = GENERAL_USER_PROMPT.format(imaging_time=meta["metadata"]["imaging_time"], resolution=meta["metadata"]["resolution"], 
+                                         center_coords=meta["metadata"]["center_coordinates"], ship_info=ship_info)
+        tasks_data.append({'type': 'general', 'sys': GENERAL_SYS_PROMPT, 'usr': usr, 'img': full_img})
+
+    if not fused and UPDATE_POSITION and ("position", None) not in done:
+        with METRICS.timer("spatial_text"):
+            spatial_text = "\n".join(format_ship_spatial_text(meta["objects_enrichment"], top_k=8).values())
+        tasks_data.append({'type': 'position', 'sys': POSITION_SYS_PROMPT, 'usr': POSITION_USER_PROMPT.format(ship_data=spatial_text), 'img': full_img})
+
+    if UPDATE_APPEARANCE:
+        patches = {}
+        for s_id, info in meta["objects_enrichment"].items():
+            if ("appearance", s_id) in done: continue
+            xc, yc, w_norm, h_norm = info["position"]
+            side = max(w_norm * W, h_norm * H) * 1.15
+            patches[s_id] = full_img.crop((max(0, xc*W-side/2), max(0, yc*H-side/2), min(W, xc*W+side/2), min(H, yc*H+side/2)))
+        # 每 APPEARANCE_GROUP_SIZE 艘船一个多图请求
+        tasks_data += handler.build_appearance_tasks(patches)
+
+    if not tasks_data and not done:
+        return None
+    return meta, tasks_data
+
+async def producer(queue):
+    # 逐张载入图像，队列满时等待，内存中最多 QUEUE_SIZE + NUM_CONSUMERS 张图像
+    for seq in seqs[SEQ_RANGE]:
         try:
-            output_path = os.path.join(data_dir, f"result_{seq}.json")
-            with open(output_path, "r", encoding="utf-8") as f:
-                meta = json.load(f)
-            
-            full_img = Image.open(os.path.join(rgb_dir, f"{seq}.jpg")).convert("RGB")
-            W, H = full_img.size
-            tasks_data = []
-
-            if UPDATE_GENERAL:
-                ship_info = "\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in meta["objects_enrichment"].items()])
-                usr = GENERAL_USER_PROMPT.format(imaging_time=meta["metadata"]["imaging_time"], resolution=meta["metadata"]["resolution"], 
-                                                 center_coords=meta["metadata"]["center_coordinates"], ship_info=ship_info)
-                tasks_data.append({'type': 'general', 'sys': GENERAL_SYS_PROMPT, 'usr': usr, 'img': full_img})
-
-            if UPDATE_POSITION:
-                spatial_text = "\n".join(format_ship_spatial_text(meta["objects_enrichment"], top_k=8).values())
-                tasks_data.append({'type': 'position', 'sys': POSITION_SYS_PROMPT, 'usr': POSITION_USER_PROMPT.format(ship_data=spatial_text), 'img': full_img})
-
-            if UPDATE_APPEARANCE:
-                for s_id, info in meta["objects_enrichment"].items():
-                    xc, yc, w_norm, h_norm = info["position"]
-                    side = max(w_norm * W, h_norm * H) * 1.15
-                    patch = full_img.crop((max(0, xc*W-side/2), max(0, yc*H-side/2), min(W, xc*W+side/2), min(H, yc*H+side/2)))
-                    tasks_data.append({'type': 'appearance', 'sys': APPEARANCE_SYS_PROMPT, 'usr': "Describe this ship", 'img': patch, 'ship_id': s_id})
-
-            if not tasks_data:
-                progress.update(1)
-                continue
-
-            all_tasks.append(handler.update_seq(seq, meta, tasks_data))
-                
+            item = await asyncio.to_thread(prepare, seq)
         except Exception as e:
             print(f"\nError preparing {seq}: {e}")
+            item = None
+        if item is None:
             progress.update(1)
-    
-    if all_tasks:
-        await asyncio.gather(*all_tasks)
+            continue
+        await queue.put((seq, *item))
+    for _ in range(NUM_CONSUMERS):
+        await queue.put(None)
+
+async def consumer(queue):
+    while (item := await queue.get()) is not None:
+        seq, meta, tasks_data = item
+        await handler.update_seq(seq, meta, tasks_data)
+
+async def main():
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    await asyncio.gather(producer(queue), *[consumer(queue) for _ in range(NUM_CONSUMERS)])
+    if handler.cache is not None:
+        print(f"LLM cache: {handler.cache.stats()}")
+    print(f"Rate control: {handler.limiter.stats()}")
+    print(f"Image payload: {handler.payloads.stats()}")
+    print(f"Metrics: {json.dumps(METRICS.summary(), ensure_ascii=False)}")
+    if metrics_path:
+        METRICS.write(metrics_path)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -2,10 +2,12 @@ import os, json
 from tqdm import tqdm
 from PIL import Image
 from prompt.utils import format_ship_spatial_text
+from metrics import METRICS
+from pipeline import crop_ship_patch, MIN_PATCH_SIZE
 from prompt.prompt import (GENERAL_SYS_PROMPT, GENERAL_USER_PROMPT, 
-                           POSITION_SYS_PROMPT, POSITION_USER_PROMPT, 
-                           APPEARANCE_SYS_PROMPT)
-from vllm_handler import VLLMTaskHandler
+                           POSITION_SYS_PROMPT, POSITION_USER_PROMPT,
+                           SCENE_SYS_PROMPT, SCENE_USER_PROMPT)
+from vllm_server import server_url, server_handler
 
 # ==========================================
 # 更新配置 (设置为 True 以重新运行对应任务)
@@ -14,11 +16,26 @@ UPDATE_GENERAL = False    # 更新场景上下文 (scene_context)
 UPDATE_POSITION = True    # 更新空间环境 (immediate_surroundings)
 UPDATE_APPEARANCE = False  # 更新视觉外观 (visual_appearance)
 UPDATE_SPATIAL_RULE = True # 更新基于规则的方位推导 (spatial_context)
+FUSE_SCENE = False  # 同时更新 general 与 position 时合并为一次全图请求 (融合场景任务)；默认关闭 (原有的 general + position 两次请求)，先用 bench_scene_fusion.py 比较两种模式再决定是否开启
+APPEARANCE_GROUP_SIZE = 1  # 每个外观请求打包的舰船切片数；1 为逐船请求 (默认，原有行为)，设为 >1 (如 8) 启用多图打包，启用前先抽样对比两种输出的描述质量
+ORDER_WINDOW = 64  # 每攒够 N 个任务按类型排序后提交，使共享系统 prompt 的请求相邻 (配合 vLLM 前缀缓存)
 # ==========================================
 
 # 1. 初始化任务处理器
 data_dir = "data/metadata/test"
-handler = VLLMTaskHandler(data_dir=data_dir)
+store_path = None  # 例如 "data/metadata/test.sqlite"；None 时沿用 data_dir 下逐文件 result_{seq}.json
+cache_path = "data/cache/llm_cache.sqlite"  # LLM 响应缓存，None 不启用
+metrics_path = "data/metrics/update_vllm"  # 各阶段耗时 / 任务计数 / token 统计写入 {metrics_path}.json 与 .prom，None 不写
+# 设置环境变量 VLLM_SERVER_URL 时作为客户端连接常驻 vllm serve (见 vllm_server.py)，免去每次运行的模型加载
+server = server_url()
+if server:
+    handler = server_handler(data_dir=data_dir, journal_path=os.path.join(data_dir, "journal.jsonl"), store_path=store_path, cache_path=cache_path,
+                             appearance_group_size=APPEARANCE_GROUP_SIZE)
+    print(f"Client mode: {server} ({handler.model})")
+else:
+    from vllm_handler import VLLMTaskHandler  # 客户端模式无需安装 vllm
+    handler = VLLMTaskHandler(data_dir=data_dir, scheduler="stream", journal_path=os.path.join(data_dir, "journal.jsonl"), store_path=store_path, cache_path=cache_path,
+                              appearance_group_size=APPEARANCE_GROUP_SIZE, order_window=ORDER_WINDOW)
 
 rgb_dir = "/root/autodl-fs/data/imgs/test/rgb_images"
 try:
@@ -28,7 +45,7 @@ except Exception as e:
     seqs_all = []
 
 # 仅处理已有结果的文件进行更新
-seqs = [s for s in seqs_all if os.path.exists(os.path.join(data_dir, f"result_{s}.json"))]
+seqs = [s for s in seqs_all if handler.store.has(s)]
 
 if not seqs:
     print("No existing result files found in data/ to update.")
@@ -38,40 +55,63 @@ progress = tqdm(total=len(seqs), desc="Updating metadata")
 handler.set_progress_bar(progress)
 
 for seq in seqs[:]:
-    output_path = os.path.join(data_dir, f"result_{seq}.json")
     jpg = os.path.join(rgb_dir, f"{seq}.jpg")
     
-    with open(output_path, "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    handler.all_metas[seq] = meta
+    meta = handler.store.get(seq)
+    if not server:
+        handler.all_metas[seq] = meta
     
     # 0. 更新基于规则的方位推导 (不依赖 LLM)
     if UPDATE_SPATIAL_RULE:
-        spatial_dict = format_ship_spatial_text(meta["objects_enrichment"], top_k=20) # 这里的 top_k 可以根据需求设置
+        with METRICS.timer("spatial_text"):
+            spatial_dict = format_ship_spatial_text(meta["objects_enrichment"], top_k=20) # 这里的 top_k 可以根据需求设置
         for s_id, spatial_text in spatial_dict.items():
             meta["objects_enrichment"][s_id]["spatial_context"] = spatial_text
 
-    # 计算需要运行的任务数
+    # 从 journal 回放上次中断前已完成的子任务
+    done = handler.resume(seq, meta)
+
+    # 计算需要运行的任务数 (扣除 journal 中已完成的)
     task_count = 0
-    if UPDATE_GENERAL: task_count += 1
-    if UPDATE_POSITION: task_count += 1
-    if UPDATE_APPEARANCE: task_count += len(meta["objects_enrichment"])
+    if UPDATE_GENERAL and ("general", None) not in done: task_count += 1
+    if UPDATE_POSITION and ("position", None) not in done: task_count += 1
+    if UPDATE_APPEARANCE: task_count += sum(1 for s_id in meta["objects_enrichment"] if ("appearance", s_id) not in done)
     
-    handler.tasks_remaining[seq] = task_count
+    if not server:
+        handler.tasks_remaining[seq] = task_count
     
     if task_count == 0:
-        if UPDATE_SPATIAL_RULE:
-            handler.save_result(seq)
+        if UPDATE_SPATIAL_RULE or done:
+            if server:
+                handler.submit_seq(seq, meta, [])
+            else:
+                handler.save_result(seq)
         else:
             print(f"No update tasks selected for {seq}, skipping.")
             progress.update(1)
         continue
 
-    full_img = Image.open(jpg).convert("RGB")
-    W, H = full_img.size
+    with METRICS.timer("decode_jpeg"):
+        full_img = Image.open(jpg).convert("RGB")
+    specs = []  # (任务类型, 系统 prompt, 用户 prompt)，全部使用全图
+    patches = {}
+
+    # 1+2. 融合场景任务：一次全图请求同时生成 scene_context / activity_status / immediate_surroundings
+    fused = FUSE_SCENE and UPDATE_GENERAL and UPDATE_POSITION and ("general", None) not in done and ("position", None) not in done
+    if fused:
+        with METRICS.timer("spatial_text"):
+            ship_data = "\n".join(format_ship_spatial_text(meta["objects_enrichment"], top_k=8).values())
+        scene_user_content = SCENE_USER_PROMPT.format(
+            imaging_time=meta["metadata"]["imaging_time"],
+            resolution=meta["metadata"]["resolution"],
+            center_coords=meta["metadata"]["center_coordinates"],
+            ship_info="\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in meta["objects_enrichment"].items()]),
+            ship_data=ship_data
+        )
+        specs.append(("scene", SCENE_SYS_PROMPT, scene_user_content))
 
     # 1. General 描述任务
-    if UPDATE_GENERAL:
+    if not fused and UPDATE_GENERAL and ("general", None) not in done:
         ship_info_text = "\n".join([f"- {s_id}: {info['class']}, {info['position']}" for s_id, info in meta["objects_enrichment"].items()])
         general_user_content = GENERAL_USER_PROMPT.format(
             imaging_time=meta["metadata"]["imaging_time"],
@@ -79,26 +119,46 @@ for seq in seqs[:]:
             center_coords=meta["metadata"]["center_coordinates"],
             ship_info=ship_info_text
         )
-        handler.add_task({"type": "general", "seq": seq, "input": handler.make_input(GENERAL_SYS_PROMPT, general_user_content, full_img)})
+        specs.append(("general", GENERAL_SYS_PROMPT, general_user_content))
     
     # 2. 空间描述任务
-    if UPDATE_POSITION:
-        spatial_dict_for_llm = format_ship_spatial_text(meta["objects_enrichment"], top_k=8)
+    if not fused and UPDATE_POSITION and ("position", None) not in done:
+        with METRICS.timer("spatial_text"):
+            spatial_dict_for_llm = format_ship_spatial_text(meta["objects_enrichment"], top_k=8)
         full_spatial_text = "\n".join(spatial_dict_for_llm.values())
-        handler.add_task({"type": "position", "seq": seq, "input": handler.make_input(POSITION_SYS_PROMPT, POSITION_USER_PROMPT.format(ship_data=full_spatial_text), full_img)})
+        specs.append(("position", POSITION_SYS_PROMPT, POSITION_USER_PROMPT.format(ship_data=full_spatial_text)))
 
     # 3. 视觉外观描述任务
     if UPDATE_APPEARANCE:
         for s_id, info in meta["objects_enrichment"].items():
-            xc, yc, w_norm, h_norm = info["position"]
-            side = max(w_norm * W, h_norm * H) * 1.15
-            patch = full_img.crop((max(0, xc*W-side/2), max(0, yc*H-side/2), min(W, xc*W+side/2), min(H, yc*H+side/2)))
-            if max(patch.size) < 224:
-                scale = 224 / max(patch.size)
-                patch = patch.resize((int(patch.width*scale), int(patch.height*scale)), Image.LANCZOS)
-            handler.add_task({"type": "appearance", "seq": seq, "ship_id": s_id, "input": handler.make_input(APPEARANCE_SYS_PROMPT, "Describe this ship", patch)})
+            if ("appearance", s_id) in done: continue
+            # 本地模式的放大及 patch 网格对齐由 make_input 按 appearance 像素预算完成；客户端模式上传前只缩小，在此按 MIN_PATCH_SIZE 放大
+            patches[s_id] = crop_ship_patch(full_img, info["position"], min_size=MIN_PATCH_SIZE if server else 0)
+
+    if server:
+        tasks = [{'type': t_type, 'sys': sys_p, 'usr': usr_p, 'img': full_img} for t_type, sys_p, usr_p in specs]
+        handler.submit_seq(seq, meta, tasks + handler.build_appearance_tasks(patches))
+    else:
+        for t_type, sys_p, usr_p in specs:
+            handler.add_task({"type": t_type, "seq": seq, "input": handler.make_input(sys_p, usr_p, full_img, t_type)})
+        handler.add_appearance_tasks(seq, patches)
 
-handler.flush_all()
+if server:
+    handler.drain()
+else:
+    handler.flush_all()
+if handler.cache is not None:
+    print(f"LLM cache: {handler.cache.stats()}")
+if server:
+    print(f"Rate control: {handler.limiter.stats()}")
+else:
+    print(f"Vision tokens: {handler.vision_token_stats()}")
+    print(f"Prefix cache: {handler.prefix_cache_stats()}")
+    if handler.quarantined:
+        print(f"Quarantined {handler.quarantined} tasks, see {handler.dead_letter_path}")
+print(f"Metrics: {json.dumps(METRICS.summary(), ensure_ascii=False)}")
+if metrics_path:
+    METRICS.write(metrics_path)
 try:
     progress.close()
 except Exception:
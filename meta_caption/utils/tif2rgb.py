@@ -1,11 +1,138 @@
-import os, glob
+import os, glob, time, json, hashlib, argparse
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 
-def convert(src_dir, dst_dir):
+MANIFEST = ".tif2rgb_manifest.json"
+MANIFEST_SAVE_EVERY = 100  # hash 模式每完成 N 个文件写一次 manifest，中断后已转换的文件不必重新转换
+
+
+def _to_rgb(block):
+    """(bands, h, w) -> (h, w, 3) uint8；单波段复制为三通道，非 uint8 截断到 0-255"""
+    if block.shape[0] < 3:
+        block = np.repeat(block[:1], 3, axis=0)
+    if block.dtype != np.uint8:
+        block = np.clip(block, 0, 255).astype(np.uint8)
+    return np.moveaxis(block, 0, -1)
+
+
+def read_rgb(ds, block_rows=1024):
+    """按行窗口分块读取并转换，避免整幅原始数据与转换结果同时驻留内存"""
+    bands = [1, 2, 3] if ds.count >= 3 else [1]
+    out = np.empty((ds.height, ds.width, 3), np.uint8)
+    for row in range(0, ds.height, block_rows):
+        h = min(block_rows, ds.height - row)
+        out[row:row+h] = _to_rgb(ds.read(bands, window=Window(0, row, ds.width, h)))
+    return out
+
+
+def read_rgb_scaled(ds, factor):
+    """降采样读取 (有金字塔时直接读 overview)"""
+    bands = [1, 2, 3] if ds.count >= 3 else [1]
+    shape = (len(bands), max(1, ds.height // factor), max(1, ds.width // factor))
+    return _to_rgb(ds.read(bands, out_shape=shape, resampling=Resampling.average))
+
+
+def file_hash(path, chunk=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while data := f.read(chunk):
+            h.update(data)
+    return h.hexdigest()
+
+
+def scaled_dir(dst_dir, factor):
+    return f"{dst_dir.rstrip(os.sep)}_x{factor}"
+
+
+def save_jpeg(rgb, path, quality=75):
+    """先写临时文件再 os.replace，进程中途退出不会留下 mtime 较新的截断 JPEG (否则 mtime 模式会一直跳过它)"""
+    tmp = f"{path}.tmp"
+    Image.fromarray(rgb).save(tmp, format="JPEG", quality=quality)
+    os.replace(tmp, path)
+
+
+def write_manifest(path, manifest):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp, path)
+
+
+def convert_one(src, dst_dir, scales=(), quality=75):
+    """转换单个 tif，返回读取的字节数"""
+    name = os.path.splitext(os.path.basename(src))[0] + ".jpg"
+    with rasterio.open(src) as ds:
+        save_jpeg(read_rgb(ds), os.path.join(dst_dir, name), quality)
+        for factor in scales:
+            save_jpeg(read_rgb_scaled(ds, factor), os.path.join(scaled_dir(dst_dir, factor), name), quality)
+    return os.path.getsize(src)
+
+
+def is_up_to_date(src, dst_dir, scales, manifest, src_hash=None):
+    name = os.path.splitext(os.path.basename(src))[0] + ".jpg"
+    outs = [os.path.join(dst_dir, name)] + [os.path.join(scaled_dir(dst_dir, f), name) for f in scales]
+    if not all(os.path.exists(o) for o in outs):
+        return False
+    if src_hash is not None:
+        return manifest.get(os.path.basename(src)) == src_hash
+    return all(os.path.getmtime(o) >= os.path.getmtime(src) for o in outs)
+
+
+def convert(src_dir, dst_dir, workers=8, scales=(), check="mtime", quality=75):
+    """
+    并行将 src_dir 下的 GeoTIFF 转换为 JPEG
+    - check: "mtime" 输出比源文件新则跳过；"hash" 按源文件 sha1 与 manifest 比对 (manifest 增量写入，中断时也会保存)
+    - scales: 额外写出的降采样倍数，输出到 {dst_dir}_x{factor}
+    """
     os.makedirs(dst_dir, exist_ok=True)
-    for f in glob.glob(os.path.join(src_dir, "*.tif")):
-        name = os.path.splitext(os.path.basename(f))[0] + ".jpg"
-        Image.open(f).convert("RGB").save(os.path.join(dst_dir, name))
+    for factor in scales:
+        os.makedirs(scaled_dir(dst_dir, factor), exist_ok=True)
+
+    manifest_path = os.path.join(dst_dir, MANIFEST)
+    manifest = {}
+    if check == "hash" and os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    srcs = sorted(glob.glob(os.path.join(src_dir, "*.tif")))
+    hashes = {f: file_hash(f) for f in srcs} if check == "hash" else {}
+    todo = [f for f in srcs if not is_up_to_date(f, dst_dir, scales, manifest, hashes.get(f))]
+    print(f"{len(srcs)} tif found, {len(srcs) - len(todo)} up to date, {len(todo)} to convert")
+
+    start, total_bytes, done = time.time(), 0, 0
+    try:
+        with ProcessPoolExecutor(workers) as ex:
+            futures = {f: ex.submit(convert_one, f, dst_dir, scales, quality) for f in todo}
+            for f, fut in futures.items():
+                try:
+                    total_bytes += fut.result()
+                    done += 1
+                    if check == "hash":
+                        manifest[os.path.basename(f)] = hashes[f]
+                        if done % MANIFEST_SAVE_EVERY == 0:
+                            write_manifest(manifest_path, manifest)
+                except Exception as e:
+                    print(f"Error converting {f}: {e}")
+    finally:
+        # 正常结束或中断 (KeyboardInterrupt 等) 都保存已完成部分
+        if check == "hash":
+            write_manifest(manifest_path, manifest)
+
+    elapsed = max(time.time() - start, 1e-9)
+    print(f"Converted {done} images in {elapsed:.1f}s: {done / elapsed:.2f} images/s, {total_bytes / 2**20 / elapsed:.1f} MB/s")
+
 
 if __name__ == "__main__":
-    convert("/autodl-fs/data/RGB/test/images", "/autodl-fs/data/RGB/test/rgb_images")
+    parser = argparse.ArgumentParser(description="GeoTIFF -> JPEG")
+    parser.add_argument("src_dir", nargs="?", default="/autodl-fs/data/RGB/test/images")
+    parser.add_argument("dst_dir", nargs="?", default="/autodl-fs/data/RGB/test/rgb_images")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--scales", type=int, nargs="*", default=[], help="额外输出的降采样倍数，如 2 4")
+    parser.add_argument("--check", choices=["mtime", "hash"], default="mtime")
+    parser.add_argument("--quality", type=int, default=75)
+    args = parser.parse_args()
+    convert(args.src_dir, args.dst_dir, workers=args.workers, scales=args.scales, check=args.check, quality=args.quality)
@@ -1,102 +1,521 @@
 import os
 import json
+import time
+import math
+import itertools
+import resource
 import json_repair
 from vllm import LLM, SamplingParams
 from transformers import AutoProcessor
+from journal import TaskJournal
+from result_store import open_result_store
+from llm_cache import ResponseCache
+from metrics import METRICS
+from chat_template import ChatTemplateCache, SINGLE_IMAGE, multi_image_layout
+from image_payload import QWEN_VL_FACTOR, QWEN_VL_PIXEL_BUDGETS, resize_to_grid
+from prompt.prompt import APPEARANCE_SYS_PROMPT, APPEARANCE_MULTI_SYS_PROMPT, APPEARANCE_MULTI_USER_PROMPT
+from prompt.utils import parse_appearance_map, split_scene_result
+from prompt.schema import task_schema, task_max_tokens, MAX_MODEL_LEN
+try:
+    from vllm.sampling_params import StructuredOutputsParams
+except ImportError:  # vLLM < 0.11 只有 GuidedDecodingParams
+    StructuredOutputsParams = None
+    from vllm.sampling_params import GuidedDecodingParams
+
+
+def structured_output_kwargs(schema):
+    """SamplingParams 的 JSON Schema 约束参数，兼容新旧两套 vLLM 接口"""
+    if StructuredOutputsParams is not None:
+        return {"structured_outputs": StructuredOutputsParams(json=schema)}
+    return {"guided_decoding": GuidedDecodingParams(json=schema)}
+
 
 class VLLMTaskHandler:
-    def __init__(self, model_id="Qwen/Qwen3-VL-32B-Instruct", chunk_size=8, gpu_memory_utilization=0.9, data_dir="data/metadata/train"):
+    def __init__(self, model_id="Qwen/Qwen3-VL-32B-Instruct", chunk_size=8, gpu_memory_utilization=0.9, data_dir="data/metadata/train",
+                 scheduler="per_type", max_inflight=256, journal_path=None, store_path=None, cache_path=None,
+                 max_inflight_bytes=None, pixel_budgets=None, appearance_group_size=1, enable_prefix_caching=True, order_window=0,
+                 guided_decoding=True, dead_letter_path=None):
+        """
+        scheduler:
+          - "per_type": 按任务类型分别缓存，每满 chunk_size 条调用一次 llm.generate (旧行为)
+          - "stream": 所有类型的任务直接送入 vLLM 引擎队列，由引擎连续调度，
+            在途请求达到 max_inflight 时才推进引擎，完成一条即回写一条
+        store_path: 结果存储位置，默认 data_dir 下逐文件 result_{seq}.json；以 .sqlite 结尾则写入 SQLite 结果库
+        journal_path: 子任务结果日志，完成即落盘；重启后用 resume() 回放，只重发缺失的子任务
+        cache_path: LLM 响应缓存 (SQLite)，相同 prompt + 图像不再重复生成；None 不启用
+        max_inflight_bytes: 已提交但未完成任务的图像像素总字节上限，超出时 add_task 阻塞推进引擎 (对生产者形成背压)；
+            同一图像被多个任务引用时重复计算，偏保守。seq 保存后立即从 all_metas / tasks_remaining 中移除
+        pixel_budgets: {任务类型: (min_pixels, max_pixels)}，覆盖 image_payload.QWEN_VL_PIXEL_BUDGETS；
+            make_input 按任务类型把图像缩放到 patch 网格对齐的尺寸，控制每个任务的视觉 token 数
+        appearance_group_size: add_appearance_tasks 每个请求打包的舰船切片数 (多图输入，返回 {ship_id: visual_appearance})，
+            1 为逐船请求；响应缺失或无法解析的舰船回退为单切片请求
+        enable_prefix_caching: 开启 vLLM 自动前缀缓存，同一系统 prompt 的请求复用已计算的 KV 块
+        order_window: stream 模式下每攒够 order_window 个任务按 (任务类型, seq) 排序后再提交，使共享系统 prompt 的请求相邻、
+            前缀块在缓存中保持热；0 为到达即提交。per_type 模式本身按类型成批，无需重排
+        guided_decoding: 按 prompt/schema.py 中的任务 schema 约束解码，并按 schema 最长合法输出设置每个任务的 max_tokens；
+            False 时所有任务沿用 self.sampling_params (max_tokens=2048，自由生成)
+        dead_letter_path: 隔离任务记录 (JSONL)，默认 data_dir/dead_letter.jsonl。llm.generate 失败时二分重试定位出错请求，
+            生成失败或输出无法解析的任务写入该文件并计为已完成，同一 seq 的其余结果照常保存
+        """
+        assert scheduler in ("per_type", "stream"), f"Unknown scheduler: {scheduler}"
         os.environ["VLLM_USE_MODELSCOPE"] = "False"
         self.model_id = model_id
+        self.appearance_group_size = max(1, appearance_group_size)
         self.chunk_size = chunk_size
+        self.scheduler = scheduler
+        self.max_inflight = max_inflight
         self.data_dir = data_dir
         os.makedirs(self.data_dir, exist_ok=True)
+        self.store = open_result_store(store_path or data_dir)
         self.llm = LLM(
             model=model_id, 
-            limit_mm_per_prompt={"image": 1}, 
-            max_model_len=9216, 
+            limit_mm_per_prompt={"image": self.appearance_group_size}, 
+            max_model_len=MAX_MODEL_LEN, 
             gpu_memory_utilization=gpu_memory_utilization, 
             swap_space=24, 
             enable_chunked_prefill=True, 
-            max_num_batched_tokens=2048
+            max_num_batched_tokens=2048,
+            enable_prefix_caching=enable_prefix_caching
         )
         self.processor = AutoProcessor.from_pretrained(model_id)
+        # 模板静态片段按 (系统 prompt, 内容布局) 缓存，每个任务只拼接用户文本
+        self.templates = ChatTemplateCache(lambda msg: self.processor.apply_chat_template(msg, tokenize=False, add_generation_prompt=True))
         self.sampling_params = SamplingParams(max_tokens=2048, temperature=0.01)
+        self.guided_decoding = guided_decoding
         
         self.all_metas = {}
         self.tasks_remaining = {}
-        self.buffers = {"general": [], "position": [], "appearance": []}
+        self.buffers = {"general": [], "position": [], "scene": [], "appearance": [], "appearance_multi": []}
+        self.inflight = {}
+        self.order_window = order_window
+        self.reorder = []
+        # 前缀缓存统计：完成请求的 prompt token 总数与命中缓存的 token 数
+        self.prefix_stats = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+        self._request_ids = itertools.count()
+        self.journal = TaskJournal(journal_path) if journal_path else None
+        self.dead_letter_path = dead_letter_path or os.path.join(data_dir, "dead_letter.jsonl")
+        self.quarantined = 0
+        self.cache = ResponseCache(cache_path) if cache_path else None
+        self.max_inflight_bytes = max_inflight_bytes
+        # 各阶段在途图像字节数及峰值：buffered (per_type 缓冲区) / engine (已送入 vLLM)
+        self.stage_bytes = {"buffered": 0, "engine": 0}
+        self.stage_peak = {"buffered": 0, "engine": 0}
+        self.metas_peak = 0
+        self.pixel_budgets = {**QWEN_VL_PIXEL_BUDGETS, **(pixel_budgets or {})}
+        # 各任务类型的视觉 token 统计：任务数 / 总 token / 单任务最大 token
+        self.vision_tokens = {}
         self.progress = None
+        # 结果落盘后的回调 on_saved(seq)，例如守护进程统计入库延迟
+        self.on_saved = None
 
     def set_progress_bar(self, progress_bar):
         self.progress = progress_bar
 
-    def make_input(self, sys_p, usr_p, img):
-        msg = [
-            {"role": "system", "content": [{"type": "text", "text": sys_p}]},
-            {"role": "user", "content": [{"type": "image", "image": img}, {"type": "text", "text": usr_p}]}
-        ]
-        return {
-            "prompt": self.processor.apply_chat_template(msg, tokenize=False, add_generation_prompt=True),
-            "multi_modal_data": {"image": img}
+    def make_input(self, sys_p, usr_p, img, task_type=None, prompt=None):
+        """
+        task_type 有像素预算时先把图像缩放到对齐 patch 网格的尺寸 (worker 已缩放过的图像原样通过)，再做模板化。
+        prompt 为 worker 进程用 worker_templates() 预先拼好的完整 prompt，给出时跳过模板化
+        """
+        budget = self.pixel_budgets.get(task_type)
+        if budget is not None:
+            with METRICS.timer("resize"):
+                img = resize_to_grid(img, *budget)
+        if prompt is None:
+            prompt = self.templates.prompt(sys_p, SINGLE_IMAGE, [usr_p])
+        return self._build_input(prompt, img, budget)
+
+    def make_multi_input(self, sys_p, usr_p, imgs, labels, task_type=None):
+        """多图输入：每张图前插入其标签文本，multi_modal_data 按顺序传图像列表"""
+        budget = self.pixel_budgets.get(task_type)
+        if budget is not None:
+            with METRICS.timer("resize"):
+                imgs = [resize_to_grid(img, *budget) for img in imgs]
+        prompt = self.templates.prompt(sys_p, multi_image_layout(len(imgs)), [f"ship_id: {label}" for label in labels] + [usr_p])
+        return self._build_input(prompt, imgs, budget)
+
+    def worker_templates(self, sys_prompts):
+        """
+        sys_prompts: {任务类型: 系统 prompt}。返回单图布局的模板片段 {任务类型: segments}，供 SeqPipeline worker 用 fill_template 直接生成 prompt；
+        模板会改写用户文本的任务类型不在其中，仍由 make_input 逐任务渲染
+        """
+        templates = {}
+        for t_type, sys_p in sys_prompts.items():
+            segments = self.templates.get(sys_p, SINGLE_IMAGE)
+            if segments is not None:
+                templates[t_type] = segments
+        return templates
+
+    def _build_input(self, prompt, image, budget):
+        inp = {"prompt": prompt, "multi_modal_data": {"image": image}}
+        if budget is not None:
+            # 同步处理器的像素范围，否则其默认 min_pixels 会把小切片再次放大
+            inp["mm_processor_kwargs"] = {"min_pixels": budget[0], "max_pixels": budget[1]}
+        return inp
+
+    def appearance_task(self, seq, s_id, patch):
+        return {"type": "appearance", "seq": seq, "ship_id": s_id,
+                "input": self.make_input(APPEARANCE_SYS_PROMPT, "Describe this ship", patch, "appearance")}
+
+    def add_appearance_tasks(self, seq, patches):
+        """patches: {ship_id: 切片}；每 appearance_group_size 艘船打包为一个多图请求，tasks_remaining 仍按船计数"""
+        items = list(patches.items())
+        n = self.appearance_group_size
+        for i in range(0, len(items), n):
+            group = dict(items[i:i + n])
+            if len(group) == 1:
+                self.add_task(self.appearance_task(seq, *items[i]))
+                continue
+            ship_ids = list(group)
+            usr = APPEARANCE_MULTI_USER_PROMPT.format(num_ships=len(ship_ids), ship_ids=", ".join(ship_ids))
+            self.add_task({"type": "appearance_multi", "seq": seq, "ship_ids": ship_ids, "patches": group,
+                           "input": self.make_multi_input(APPEARANCE_MULTI_SYS_PROMPT, usr, list(group.values()), ship_ids, "appearance")})
+
+    @staticmethod
+    def task_images(task):
+        img = task["input"]["multi_modal_data"]["image"]
+        return img if isinstance(img, list) else [img]
+
+    @classmethod
+    def task_vision_tokens(cls, task):
+        return sum(math.ceil(img.width / QWEN_VL_FACTOR) * math.ceil(img.height / QWEN_VL_FACTOR) for img in cls.task_images(task))
+
+    def record_vision_tokens(self, task):
+        tokens = self.task_vision_tokens(task)
+        stats = self.vision_tokens.setdefault(task["type"], {"tasks": 0, "tokens": 0, "max": 0})
+        stats["tasks"] += 1
+        stats["tokens"] += tokens
+        stats["max"] = max(stats["max"], tokens)
+
+    def vision_token_stats(self):
+        """各任务类型的视觉 token：任务数、均值与最大值"""
+        return {t_type: {"tasks": s["tasks"], "avg": round(s["tokens"] / s["tasks"], 1), "max": s["max"]}
+                for t_type, s in self.vision_tokens.items()}
+
+    @classmethod
+    def task_nbytes(cls, task):
+        return sum(img.width * img.height * len(img.getbands()) for img in cls.task_images(task))
+
+    def track_bytes(self, stage, delta):
+        self.stage_bytes[stage] += delta
+        self.stage_peak[stage] = max(self.stage_peak[stage], self.stage_bytes[stage])
+
+    def memory_stats(self):
+        """各阶段当前/峰值图像字节、驻留 meta 数以及进程 RSS"""
+        stats = {
+            "image_bytes": dict(self.stage_bytes),
+            "image_peak_bytes": dict(self.stage_peak),
+            "metas": len(self.all_metas),
+            "metas_peak": self.metas_peak,
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
         }
+        try:
+            with open("/proc/self/statm") as f:
+                stats["rss_mb"] = round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+        except OSError:
+            pass
+        return stats
+
+    def evict(self, seq):
+        """seq 已持久化，释放其 meta 与计数"""
+        self.all_metas.pop(seq, None)
+        self.tasks_remaining.pop(seq, None)
 
     def save_result(self, seq):
         meta = self.all_metas.get(seq)
         if not meta: return
-        output_path = os.path.join(self.data_dir, f"result_{seq}.json")
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(meta, f, indent=4, ensure_ascii=False)
-        print(f"Saved: {output_path}")
+        with METRICS.timer("save_result"):
+            self.store.put(seq, meta)
+        print(f"Saved: {seq}")
+        if self.journal is not None:
+            self.journal.mark_saved(seq)
+        self.evict(seq)
+        if self.on_saved is not None:
+            self.on_saved(seq)
         if self.progress is not None:
             self.progress.update(1)
 
+    def apply_task_result(self, task, meta, data):
+        if task["type"] == "position":
+            for item in data:
+                s_id = item.get("ship_id")
+                if s_id in meta["objects_enrichment"]:
+                    meta["objects_enrichment"][s_id]["immediate_surroundings"] = item.get("immediate_surroundings", "")
+        elif task["type"] == "general":
+            if "scene_context" in data:
+                meta["scene_context"].update(data["scene_context"])
+            if "objects_enrichment" in data:
+                for s_id, ob in data["objects_enrichment"].items():
+                    if s_id in meta["objects_enrichment"]:
+                        meta["objects_enrichment"][s_id].update(ob)
+        elif task["type"] == "appearance":
+            meta["objects_enrichment"][task["ship_id"]]["visual_appearance"] = data.get("visual_appearance", "")
+
+    def resume(self, seq, meta):
+        """把 journal 中该 seq 已完成的子任务结果回放到 meta，返回已完成的 {(type, ship_id)}"""
+        if self.journal is None:
+            return set()
+        done = self.journal.completed(seq)
+        for (t_type, s_id), data in done.items():
+            self.apply_task_result({"type": t_type, "ship_id": s_id}, meta, data)
+        return set(done)
+
+    def complete_task(self, task, data):
+        seq = task["seq"]
+        self.apply_task_result(task, self.all_metas[seq], data)
+        if self.journal is not None:
+            self.journal.record(seq, task["type"], task.get("ship_id"), data)
+        
+        self.tasks_remaining[seq] -= 1
+        if self.tasks_remaining[seq] == 0:
+            self.save_result(seq)
+
+    def handle_multi_output(self, task, data):
+        """多船外观结果按船拆成单船结果记入 journal；缺失的舰船回退为单切片请求"""
+        seq = task["seq"]
+        found, missing = parse_appearance_map(data, task["ship_ids"])
+        for s_id, text in found.items():
+            self.complete_task({"type": "appearance", "seq": seq, "ship_id": s_id}, {"visual_appearance": text})
+        if missing:
+            print(f"Multi-ship appearance for {seq} missing {missing}, falling back to single patches")
+            for s_id in missing:
+                self.requeue(self.appearance_task(seq, s_id, task["patches"][s_id]))
+
+    def quarantine(self, task, reason):
+        """把无法完成的任务写入 dead-letter 文件并计为已完成，使该 seq 的其余结果照常保存"""
+        seq = task["seq"]
+        if task["type"] == "appearance_multi":
+            # 多船请求先回退为逐船请求，单船仍失败才隔离
+            print(f"Multi-ship appearance for {seq} failed ({reason}), falling back to single patches")
+            for s_id in task["ship_ids"]:
+                self.requeue(self.appearance_task(seq, s_id, task["patches"][s_id]))
+            return
+        print(f"Quarantined {task['type']} task of {seq}: {reason}")
+        self.quarantined += 1
+        record = {"seq": seq, "type": task["type"], "ship_id": task.get("ship_id"), "reason": reason, "time": time.time()}
+        with open(self.dead_letter_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if seq in self.tasks_remaining:
+            # scene 任务代表 general + position 两个子任务
+            self.tasks_remaining[seq] -= 2 if task["type"] == "scene" else 1
+            if self.tasks_remaining[seq] <= 0:
+                self.save_result(seq)
+
+    def handle_output(self, task, res_text):
+        """解析并回写一条输出，成功返回 True；解析失败的任务被隔离"""
+        seq = task["seq"]
+        try:
+            with METRICS.timer("parse_json"):
+                data = json_repair.loads(res_text)
+            if task["type"] == "appearance_multi":
+                self.handle_multi_output(task, data)
+            elif task["type"] == "scene":
+                # 融合场景任务拆成 general + position 两条结果记入 journal，tasks_remaining 仍按两个任务计数
+                general, position = split_scene_result(data)
+                self.complete_task({"type": "general", "seq": seq}, general)
+                self.complete_task({"type": "position", "seq": seq}, position)
+            else:
+                self.complete_task(task, data)
+            METRICS.count_task(task["type"], "ok")
+            return True
+        except Exception as e:
+            METRICS.count_task(task["type"], "parse_fail")
+            self.quarantine(task, f"parse error: {e}")
+            return False
+
+    def prompt_tokens(self, task):
+        """任务 prompt 的 token 数：模板文本 token (每张图的占位 token 计 1 个) 加上展开后的视觉 token"""
+        with METRICS.timer("count_prompt_tokens"):
+            text = len(self.processor.tokenizer(task["input"]["prompt"], add_special_tokens=False).input_ids)
+        return text - len(self.task_images(task)) + self.task_vision_tokens(task)
+
+    def params_for(self, task):
+        """任务的 SamplingParams：schema 约束解码 + 由 schema 推出的 max_tokens (不超过上下文余量)，结果记在 task 上"""
+        if not self.guided_decoding:
+            return self.sampling_params
+        if "sampling_params" not in task:
+            t_type = task["type"]
+            if t_type == "appearance_multi":
+                ship_ids = task["ship_ids"]
+            elif t_type in ("general", "position", "scene"):
+                ship_ids = list(self.all_metas[task["seq"]]["objects_enrichment"])
+            else:
+                ship_ids = None
+            kwargs = {"max_tokens": task_max_tokens(t_type, ship_ids, MAX_MODEL_LEN - self.prompt_tokens(task)), "temperature": 0.01}
+            schema = task_schema(t_type, ship_ids)
+            if schema is not None:
+                kwargs.update(structured_output_kwargs(schema))
+            task["sampling_params"] = SamplingParams(**kwargs)
+        return task["sampling_params"]
+
+    def cache_lookup(self, task):
+        """命中缓存返回模型原始输出，否则返回 None；缓存键记在 task 上供生成后写回"""
+        if self.cache is None: return None
+        task["cache_key"] = ResponseCache.make_key(self.model_id, str(self.params_for(task)), None, task["input"]["prompt"],
+                                                   self.task_images(task))
+        return self.cache.get(task["cache_key"])
+
+    def record_prefix_stats(self, task, out):
+        METRICS.add_tokens(task["type"], len(out.prompt_token_ids or []), len(out.outputs[0].token_ids or []))
+        self.prefix_stats["requests"] += 1
+        self.prefix_stats["prompt_tokens"] += len(out.prompt_token_ids or [])
+        self.prefix_stats["cached_tokens"] += getattr(out, "num_cached_tokens", None) or 0
+
+    def prefix_cache_stats(self):
+        """本次运行的前缀缓存命中率 (命中 token / prompt token)"""
+        stats = dict(self.prefix_stats)
+        stats["hit_rate"] = round(stats["cached_tokens"] / stats["prompt_tokens"], 4) if stats["prompt_tokens"] else 0.0
+        return stats
+
+    def cache_store(self, task, res_text):
+        if self.cache is not None and "cache_key" in task:
+            self.cache.put(task["cache_key"], res_text)
+
     def run_batch(self, buffer_type):
         buffer = self.buffers[buffer_type]
         if not buffer: return
         
-        try:
-            outputs = self.llm.generate([t["input"] for t in buffer], self.sampling_params)
-            for task, out in zip(buffer, outputs):
-                seq = task["seq"]
-                try:
-                    res_text = out.outputs[0].text
-                    data = json_repair.loads(res_text)
-                    meta = self.all_metas[seq]
-                    
-                    if task["type"] == "position":
-                        for item in data:
-                            s_id = item.get("ship_id")
-                            if s_id in meta["objects_enrichment"]:
-                                meta["objects_enrichment"][s_id]["immediate_surroundings"] = item.get("immediate_surroundings", "")
-                    elif task["type"] == "general":
-                        if "scene_context" in data:
-                            meta["scene_context"].update(data["scene_context"])
-                        if "objects_enrichment" in data:
-                            for s_id, ob in data["objects_enrichment"].items():
-                                if s_id in meta["objects_enrichment"]:
-                                    meta["objects_enrichment"][s_id].update(ob)
-                    else:
-                        meta["objects_enrichment"][task["ship_id"]]["visual_appearance"] = data.get("visual_appearance", "")
-                    
-                    self.tasks_remaining[seq] -= 1
-                    if self.tasks_remaining[seq] == 0:
-                        self.save_result(seq)
-                except Exception as e:
-                    print(f"Error parsing LLM output for {seq}: {e}")
-        except Exception as e:
-            print(f"CRITICAL: llm.generate failed for batch: {e}")
-            for task in buffer:
-                print(f"Error processing {task['seq']}: {e}")
+        # 命中缓存的任务直接回写，只把未命中的送入 llm.generate
+        pending = []
+        for task in buffer:
+            cached = self.cache_lookup(task)
+            if cached is None:
+                pending.append(task)
+            else:
+                self.handle_output(task, cached)
+        
+        for task in buffer:
+            self.track_bytes("buffered", -task["nbytes"])
+            self.track_bytes("engine", task["nbytes"])
+
+        if pending:
+            self.generate_bisect(pending)
         
+        for task in buffer:
+            self.track_bytes("engine", -task["nbytes"])
         buffer.clear()
 
+    def generate_bisect(self, tasks):
+        """llm.generate 整批失败时对半拆分重试，直到定位出单个出错请求并隔离，其余请求照常回写"""
+        try:
+            with METRICS.timer("llm_generate"):
+                outputs = self.llm.generate([t["input"] for t in tasks], [self.params_for(t) for t in tasks])
+        except Exception as e:
+            if len(tasks) == 1:
+                METRICS.count_task(tasks[0]["type"], "exception")
+                self.quarantine(tasks[0], f"generate failed: {e}")
+                return
+            print(f"CRITICAL: llm.generate failed for batch of {len(tasks)}: {e}, bisecting")
+            mid = len(tasks) // 2
+            self.generate_bisect(tasks[:mid])
+            self.generate_bisect(tasks[mid:])
+            return
+        for task, out in zip(tasks, outputs):
+            self.record_prefix_stats(task, out)
+            if self.handle_output(task, out.outputs[0].text):
+                self.cache_store(task, out.outputs[0].text)
+
+    def submit(self, task):
+        """stream 模式：直接把请求加入引擎队列，不等待同类任务凑批"""
+        cached = self.cache_lookup(task)
+        if cached is not None:
+            self.handle_output(task, cached)
+            return
+        request_id = str(next(self._request_ids))
+        self.inflight[request_id] = task
+        self.track_bytes("engine", task["nbytes"])
+        try:
+            self.llm.llm_engine.add_request(request_id, task["input"], self.params_for(task))
+        except Exception as e:
+            self.inflight.pop(request_id, None)
+            self.track_bytes("engine", -task["nbytes"])
+            METRICS.count_task(task["type"], "exception")
+            self.quarantine(task, f"submit failed: {e}")
+
+    def step(self):
+        """推进一次引擎，把已完成的请求回写到 all_metas"""
+        try:
+            with METRICS.timer("engine_step"):
+                outputs = self.llm.llm_engine.step()
+        except Exception as e:
+            # 无法得知是哪条请求导致失败：中止全部在途请求，改走 llm.generate 二分重试定位
+            print(f"CRITICAL: engine step failed: {e}, retrying {len(self.inflight)} in-flight requests with bisection")
+            tasks = list(self.inflight.values())
+            try:
+                self.llm.llm_engine.abort_request(list(self.inflight))
+            except Exception:
+                pass
+            self.inflight.clear()
+            self.generate_bisect(tasks)
+            for task in tasks:
+                self.track_bytes("engine", -task["nbytes"])
+            return
+        for out in outputs:
+            if not out.finished: continue
+            task = self.inflight.pop(out.request_id, None)
+            if task is not None:
+                self.track_bytes("engine", -task["nbytes"])
+                self.record_prefix_stats(task, out)
+                if self.handle_output(task, out.outputs[0].text):
+                    self.cache_store(task, out.outputs[0].text)
+
     def add_task(self, task):
-        b_type = task["type"]
-        self.buffers[b_type].append(task)
-        if len(self.buffers[b_type]) >= self.chunk_size:
-            self.run_batch(b_type)
+        task["nbytes"] = self.task_nbytes(task)
+        self.record_vision_tokens(task)
+        self.metas_peak = max(self.metas_peak, len(self.all_metas))
+        if self.scheduler == "stream":
+            if self.order_window > 1:
+                self.reorder.append(task)
+                self.track_bytes("buffered", task["nbytes"])
+                if len(self.reorder) >= self.order_window:
+                    self.submit_reordered()
+            else:
+                self.submit(task)
+            while len(self.inflight) >= self.max_inflight:
+                self.step()
+        else:
+            b_type = task["type"]
+            self.buffers[b_type].append(task)
+            self.track_bytes("buffered", task["nbytes"])
+            if len(self.buffers[b_type]) >= self.chunk_size:
+                self.run_batch(b_type)
+        self.apply_backpressure()
+
+    def submit_reordered(self):
+        """按 (任务类型, seq) 排序后提交重排窗口中的任务：同一系统 prompt 的请求相邻，共享前缀在 prefix cache 中保持热"""
+        tasks = sorted(self.reorder, key=lambda t: (t["type"], t["seq"]))
+        self.reorder.clear()
+        for task in tasks:
+            self.track_bytes("buffered", -task["nbytes"])
+            self.submit(task)
+
+    def requeue(self, task):
+        """回退产生的任务：只入队不推进引擎 (调用方可能正处于 step / run_batch 中)，由后续 step / flush_all 完成"""
+        task["nbytes"] = self.task_nbytes(task)
+        self.record_vision_tokens(task)
+        if self.scheduler == "stream":
+            self.submit(task)
+        else:
+            self.buffers[task["type"]].append(task)
+            self.track_bytes("buffered", task["nbytes"])
+
+    def apply_backpressure(self):
+        """在途图像字节超出上限时阻塞调用方，推进引擎 / 提前执行最满的缓冲区直到回落"""
+        if self.max_inflight_bytes is None: return
+        while sum(self.stage_bytes.values()) > self.max_inflight_bytes:
+            if self.reorder:
+                self.submit_reordered()
+            elif self.inflight:
+                self.step()
+            elif any(self.buffers.values()):
+                self.run_batch(max(self.buffers, key=lambda t: len(self.buffers[t])))
+            else:
+                break
 
     def flush_all(self):
-        for b_type in self.buffers:
-            self.run_batch(b_type)
+        # 循环直到没有在途/缓冲任务：收尾时仍可能有回退产生的新任务
+        self.submit_reordered()
+        while self.inflight or any(self.buffers.values()):
+            while self.inflight:
+                self.step()
+            for b_type in self.buffers:
+                self.run_batch(b_type)
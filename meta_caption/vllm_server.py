@@ -0,0 +1,87 @@
+"""
+常驻 vLLM 服务：模型只在 `vllm serve` 进程中加载一次，main_vllm.py / update_vllm.py / gen_ist 等作为轻量客户端
+经 OpenAI 兼容接口复用 OpenAIHandler 的并发与重试路径。
+
+    # 启动服务 (配置与 VLLMTaskHandler 本地加载时一致)
+    python vllm_server.py --port 8000
+    # 运行客户端
+    VLLM_SERVER_URL=http://localhost:8000/v1 python main_vllm.py
+"""
+import os, json, time, argparse, shlex, urllib.request
+from image_payload import QWEN_VL_PIXEL_BUDGETS
+from prompt.schema import MAX_MODEL_LEN
+from openai_handler import OpenAIHandler
+
+DEFAULT_MODEL = "Qwen/Qwen3-VL-32B-Instruct"
+
+
+def server_url():
+    """VLLM_SERVER_URL (例如 http://localhost:8000/v1)，未设置时返回 None，runner 走本地加载模型"""
+    return os.getenv("VLLM_SERVER_URL") or None
+
+
+def serve_command(model_id=DEFAULT_MODEL, host="0.0.0.0", port=8000, gpu_memory_utilization=0.9, max_images=8,
+                  enable_prefix_caching=True, extra_args=()):
+    """与 VLLMTaskHandler 中 LLM(...) 相同配置的 `vllm serve` 命令行 (参数列表)"""
+    min_pixels = min(b[0] for b in QWEN_VL_PIXEL_BUDGETS.values())
+    max_pixels = max(b[1] for b in QWEN_VL_PIXEL_BUDGETS.values())
+    cmd = [
+        "vllm", "serve", model_id,
+        "--host", host, "--port", str(port),
+        "--limit-mm-per-prompt", json.dumps({"image": max_images}),
+        "--max-model-len", str(MAX_MODEL_LEN),
+        "--gpu-memory-utilization", str(gpu_memory_utilization),
+        "--swap-space", "24",
+        "--enable-chunked-prefill",
+        "--max-num-batched-tokens", "2048",
+        # 客户端已按任务预算缩放，处理器端只需保证小切片不被放大到默认 min_pixels 之上
+        "--mm-processor-kwargs", json.dumps({"min_pixels": min_pixels, "max_pixels": max_pixels}),
+    ]
+    cmd.append("--enable-prefix-caching" if enable_prefix_caching else "--no-enable-prefix-caching")
+    return cmd + list(extra_args)
+
+
+def wait_until_ready(base_url, timeout=600, interval=2.0):
+    """轮询 {base_url}/models 直到服务可用，超时抛出 TimeoutError"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen(f"{base_url.rstrip('/')}/models", timeout=5) as resp:
+                if resp.status == 200:
+                    return json.loads(resp.read())
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"vLLM server at {base_url} not ready after {timeout}s")
+        time.sleep(interval)
+
+
+def server_handler(base_url=None, model=None, max_concurrent=32, **kwargs):
+    """
+    连接常驻服务的 OpenAIHandler：上传前按 QWEN_VL_PIXEL_BUDGETS 的上限缩放，max_tokens 不超过 MAX_MODEL_LEN 减去 prompt 估计长度，
+    其余参数 (data_dir / journal_path / store_path / cache_path / appearance_group_size 等) 原样传入
+    """
+    return OpenAIHandler(
+        api_key=os.getenv("VLLM_API_KEY", "EMPTY"),
+        base_url=base_url or server_url(),
+        model=model or os.getenv("VLLM_SERVER_MODEL", DEFAULT_MODEL),
+        max_concurrent=max_concurrent,
+        max_pixels={t_type: b[1] for t_type, b in QWEN_VL_PIXEL_BUDGETS.items()},
+        context_length=MAX_MODEL_LEN,
+        **kwargs,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Launch a persistent vLLM OpenAI-compatible server for meta_caption runners")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--gpu-memory-utilization", type=float, default=0.9)
+    parser.add_argument("--max-images", type=int, default=8, help="每个请求的最大图像数 (多船外观请求)")
+    parser.add_argument("--dry-run", action="store_true", help="只打印命令")
+    args, extra = parser.parse_known_args()
+    cmd = serve_command(args.model, args.host, args.port, args.gpu_memory_utilization, args.max_images, extra_args=extra)
+    print(shlex.join(cmd))
+    if not args.dry_run:
+        os.execvp(cmd[0], cmd)
@@ -0,0 +1,294 @@
+"""
+常驻入库模式：持续监视 img_root 下的 rgb_images / images / labels，新图像三个文件都写完 (大小与 mtime 在 debounce 秒内不变) 后
+送入同一个已预热的 handler (本地 VLLMTaskHandler 或 VLLM_SERVER_URL 指向的常驻服务)，避免每批重新加载模型。
+同时提供 HTTP /health 与 /metrics (队列深度、入库延迟、各阶段耗时等)，/metrics/prometheus 为 Prometheus 文本格式。
+
+    python watch_ingest.py --img-root /root/autodl-fs/data/imgs/train --port 9100
+    curl localhost:9100/metrics
+"""
+import os, json, time, signal, argparse, threading, statistics
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from pipeline import SeqPipeline
+from vllm_server import server_url
+import main_vllm
+from main_vllm import make_handler, make_prepare_fn, submit_item, finish, print_stats
+from metrics import METRICS, percentile
+
+MAX_ATTEMPTS = 3  # 准备或推理失败的图像最多重新入队次数
+
+
+def seq_paths(img_root, seq):
+    return (f"{img_root}/images/{seq}.tif", f"{img_root}/labels/{seq}.json", f"{img_root}/rgb_images/{seq}.jpg")
+
+
+class DirectoryWatcher:
+    """
+    轮询 rgb_images 目录发现新 seq；tif / json / jpg 均存在、非空且 (size, mtime) 连续 debounce 秒不变才视为写完。
+    skip(seq) 为 True 的 seq (已有结果) 直接忽略
+    """
+    def __init__(self, img_root, debounce=10.0, skip=None):
+        self.img_root = img_root
+        self.debounce = debounce
+        self.skip = skip or (lambda seq: False)
+        self.candidates = {}  # seq -> (文件签名, 该签名首次出现的时间)
+        self.emitted = set()
+        self.first_seen = {}
+
+    def signature(self, seq):
+        sig = []
+        for path in seq_paths(self.img_root, seq):
+            try:
+                st = os.stat(path)
+            except OSError:
+                return None
+            if st.st_size == 0:
+                return None
+            sig.append((st.st_size, st.st_mtime_ns))
+        return tuple(sig)
+
+    def scan(self):
+        """返回本轮新就绪的 seq 列表"""
+        now = time.monotonic()
+        try:
+            names = os.listdir(os.path.join(self.img_root, "rgb_images"))
+        except OSError:
+            return []
+        ready = []
+        for name in sorted(names):
+            seq, ext = os.path.splitext(name)
+            if ext.lower() != ".jpg" or seq in self.emitted:
+                continue
+            if self.skip(seq):
+                self.emitted.add(seq)
+                continue
+            sig = self.signature(seq)
+            self.first_seen.setdefault(seq, now)
+            prev = self.candidates.get(seq)
+            if sig is None or prev is None or prev[0] != sig:
+                self.candidates[seq] = (sig, now)
+                continue
+            if now - prev[1] >= self.debounce:
+                del self.candidates[seq]
+                self.emitted.add(seq)
+                ready.append(seq)
+        return ready
+
+    def forget(self, seq):
+        """允许该 seq 在之后的扫描中重新入队 (处理失败重试)"""
+        self.emitted.discard(seq)
+        self.first_seen.pop(seq, None)
+
+
+class IngestMetrics:
+    """守护进程运行指标：计数、队列深度、入库延迟 (首次发现 -> 结果落盘，以及文件最后写入 -> 结果落盘)"""
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counts = {"discovered": 0, "submitted": 0, "saved": 0, "prepare_errors": 0, "failed": 0, "dropped": 0}
+        self.latency = deque(maxlen=window)
+        self.file_latency = deque(maxlen=window)
+        self.last_scan = None
+        self.last_saved = None
+
+    def inc(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def record_saved(self, detect_latency, file_latency):
+        with self.lock:
+            self.counts["saved"] += 1
+            self.last_saved = time.monotonic()
+            if detect_latency is not None:
+                self.latency.append(detect_latency)
+            if file_latency is not None:
+                self.file_latency.append(file_latency)
+
+    @staticmethod
+    def summarize(values):
+        if not values:
+            return None
+        return {"p50_s": round(percentile(values, 50), 3), "p90_s": round(percentile(values, 90), 3),
+                "max_s": round(max(values), 3), "mean_s": round(statistics.mean(values), 3)}
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "uptime_s": round(now - self.started, 1),
+                **self.counts,
+                "last_scan_age_s": round(now - self.last_scan, 1) if self.last_scan else None,
+                "last_saved_age_s": round(now - self.last_saved, 1) if self.last_saved else None,
+                "latency_to_result": self.summarize(list(self.latency)),
+                "latency_from_file_write": self.summarize(list(self.file_latency)),
+            }
+
+
+class IngestDaemon:
+    def __init__(self, img_root, poll_interval=5.0, debounce=10.0, num_workers=8, max_ready=16):
+        self.img_root = img_root
+        self.poll_interval = poll_interval
+        self.server = server_url()
+        self.handler = make_handler(self.server)
+        self.handler.on_saved = self.on_saved
+        self.metrics = IngestMetrics()
+        self.watcher = DirectoryWatcher(img_root, debounce=debounce, skip=self.handler.store.has)
+        self.pipeline = SeqPipeline(prepare_fn=make_prepare_fn(self.handler, self.server), num_workers=num_workers, max_ready=max_ready, streaming=True)
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.awaiting = set()  # 已提交给 handler、结果尚未落盘的 seq
+        self.attempts = {}
+
+    def on_saved(self, seq):
+        now = time.monotonic()
+        with self.lock:
+            self.awaiting.discard(seq)
+            self.attempts.pop(seq, None)
+        first_seen = self.watcher.first_seen.pop(seq, None)
+        try:
+            written = max(os.stat(p).st_mtime for p in seq_paths(self.img_root, seq))
+            file_latency = time.time() - written
+        except OSError:
+            file_latency = None
+        self.metrics.record_saved(now - first_seen if first_seen is not None else None, file_latency)
+
+    def queue_depth(self):
+        """各阶段排队数：debouncing 等待文件写完，pipeline 各阶段，awaiting_result 已提交待落盘"""
+        with self.lock:
+            awaiting = len(self.awaiting)
+        return {"debouncing": len(self.watcher.candidates), **self.pipeline.stats(), "awaiting_result": awaiting}
+
+    def handler_stats(self):
+        if self.server:
+            return {"rate_control": self.handler.limiter.stats(), "image_payload": self.handler.payloads.stats()}
+        return {"memory": self.handler.memory_stats(), "vision_tokens": self.handler.vision_token_stats(),
+                "prefix_cache": self.handler.prefix_cache_stats(), "chat_templates": self.handler.templates.stats(),
+                "quarantined": self.handler.quarantined}
+
+    def metrics_snapshot(self):
+        snapshot = {**self.metrics.snapshot(), "queue_depth": self.queue_depth(), "pipeline": METRICS.summary()}
+        try:
+            snapshot["handler"] = self.handler_stats()
+        except Exception as e:
+            snapshot["handler"] = {"error": str(e)}
+        return snapshot
+
+    def healthy(self):
+        """扫描线程在 3 个轮询周期 (至少 30s) 内有进展即视为健康"""
+        last_scan = self.metrics.last_scan
+        return last_scan is not None and time.monotonic() - last_scan < max(3 * self.poll_interval, 30.0)
+
+    def scan_loop(self):
+        while not self.stop.is_set():
+            try:
+                for seq in self.watcher.scan():
+                    self.metrics.inc("discovered")
+                    self.pipeline.put((seq, *seq_paths(self.img_root, seq)))
+            except Exception as e:
+                print(f"Scan error: {e}")
+            self.metrics.last_scan = time.monotonic()
+            self.stop.wait(self.poll_interval)
+        self.pipeline.close()
+
+    def retry_or_drop(self, seq):
+        """失败的 seq 在重试次数内交还 watcher，下轮扫描重新入队"""
+        with self.lock:
+            self.awaiting.discard(seq)
+            self.attempts[seq] = self.attempts.get(seq, 0) + 1
+            drop = self.attempts[seq] >= MAX_ATTEMPTS
+        if drop:
+            self.metrics.inc("dropped")
+            print(f"Giving up on {seq} after {MAX_ATTEMPTS} attempts")
+        else:
+            self.watcher.forget(seq)
+
+    def settle(self):
+        """空闲时完成全部在途任务；仍未落盘的 seq 视为失败"""
+        with self.lock:
+            if not self.awaiting:
+                return
+        finish(self.handler, self.server)
+        with self.lock:
+            failed = list(self.awaiting)
+        for seq in failed:
+            self.metrics.inc("failed")
+            self.retry_or_drop(seq)
+
+    def run(self):
+        scanner = threading.Thread(target=self.scan_loop, daemon=True)
+        scanner.start()
+        for item in self.pipeline:
+            # None: 暂无就绪图像，趁空闲把已提交的任务跑完，保证结果及时落盘
+            if item is None:
+                self.settle()
+                continue
+            seq = item["seq"]
+            if "error" in item:
+                print(f"Error preparing {seq}: {item['error']}")
+                self.metrics.inc("prepare_errors")
+                self.retry_or_drop(seq)
+                continue
+            with self.lock:
+                self.awaiting.add(seq)
+            self.metrics.inc("submitted")
+            submit_item(self.handler, item, self.server)
+        self.settle()
+        scanner.join()
+        print_stats(self.handler, self.server)
+
+    def shutdown(self, *_):
+        print("Stopping: finishing in-flight images ...")
+        self.stop.set()
+
+
+def make_http_server(daemon, host, port):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            pass
+
+        def send_json(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                ok = daemon.healthy()
+                self.send_json(200 if ok else 503, {"status": "ok" if ok else "stalled", **daemon.metrics.snapshot()})
+            elif self.path == "/metrics":
+                self.send_json(200, daemon.metrics_snapshot())
+            elif self.path == "/metrics/prometheus":
+                data = METRICS.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self.send_json(404, {"error": "not found"})
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watch image/label directories and caption new images with a warm handler")
+    parser.add_argument("--img-root", default=main_vllm.img_root)
+    parser.add_argument("--poll-interval", type=float, default=5.0, help="目录轮询间隔 (秒)")
+    parser.add_argument("--debounce", type=float, default=10.0, help="文件大小与 mtime 保持不变多久才视为写完 (秒)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9100, help="/health 与 /metrics 端口")
+    args = parser.parse_args()
+
+    daemon = IngestDaemon(args.img_root, poll_interval=args.poll_interval, debounce=args.debounce,
+                          num_workers=main_vllm.NUM_WORKERS, max_ready=main_vllm.MAX_READY)
+    signal.signal(signal.SIGINT, daemon.shutdown)
+    signal.signal(signal.SIGTERM, daemon.shutdown)
+    http = make_http_server(daemon, args.host, args.port)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    print(f"Watching {args.img_root}, metrics on http://{args.host}:{args.port}/metrics")
+    daemon.run()
+    http.shutdown()